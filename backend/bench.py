@@ -0,0 +1,1857 @@
+"""Micro-benchmarks for the LumoPack backend.
+
+Run from the backend directory, e.g.:
+
+    python bench.py batch --rows 10000 --http 2000
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from types import SimpleNamespace
+
+import numpy as np
+
+import main
+
+SAMPLE_REPLY = (
+    "สวัสดีครับ ผมลูโม่ ผู้ช่วยออกแบบบรรจุภัณฑ์ของ LumoPack 😊 "
+    "วันนี้จะช่วยออกแบบกล่องให้นะครับ ขอทราบก่อนว่าสินค้าของคุณเป็นประเภทไหนครับ?\n\n"
+    "<extracted_data>\n"
+    + json.dumps({
+        "product_type": None,
+        "box_type": None,
+        "current_step": 2,
+        "is_checkpoint": False,
+        "quick_replies": ["สินค้าทั่วไป", "Non-food", "Food-grade", "เครื่องสำอาง"],
+    }, ensure_ascii=False, indent=2)
+    + "\n</extracted_data>"
+)
+
+
+class FakeModels:
+    """Local stand-in for genai ``client.models`` with a fixed reply and token rate."""
+
+    def __init__(self, reply: str = SAMPLE_REPLY, first_token_latency: float = 0.3,
+                 tokens_per_second: float = 200.0, chars_per_token: int = 4):
+        self.reply = reply
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.chars_per_token = chars_per_token
+        self.last_request = None
+
+    def reply_for(self, contents) -> str:
+        """คำตอบของ request นี้ (subclass เลือกตาม contents ได้)"""
+        return self.reply
+
+    def _chunks(self, reply: str):
+        step = self.chars_per_token
+        return [reply[i:i + step] for i in range(0, len(reply), step)]
+
+    def generate_content(self, model, contents, config=None):
+        self.last_request = {"model": model, "contents": contents, "config": config}
+        reply = self.reply_for(contents)
+        time.sleep(self.first_token_latency + len(self._chunks(reply)) / self.tokens_per_second)
+        return SimpleNamespace(text=reply)
+
+    def generate_content_stream(self, model, contents, config=None):
+        self.last_request = {"model": model, "contents": contents, "config": config}
+        reply = self.reply_for(contents)
+        time.sleep(self.first_token_latency)
+        for chunk in self._chunks(reply):
+            time.sleep(1 / self.tokens_per_second)
+            yield SimpleNamespace(text=chunk)
+
+
+class FakeCaches:
+    def __init__(self):
+        self.created = []
+
+    def create(self, model, config):
+        cache = SimpleNamespace(name=f"cachedContents/fake-{len(self.created)}", model=model, config=config)
+        self.created.append(cache)
+        return cache
+
+
+class FakeGenaiClient:
+    def __init__(self, models_class=FakeModels, **kwargs):
+        self.models = models_class(**kwargs)
+        self.caches = FakeCaches()
+
+
+def _timeit(fn, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@contextlib.contextmanager
+def _serve(app):
+    """Run the app under a real uvicorn server in a background thread; yields the base URL."""
+    import uvicorn
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+def _random_requirements(rng: random.Random) -> dict:
+    return {
+        "product_type": rng.choice(list(main.PRODUCT_TYPE_MATERIALS)),
+        "box_type": rng.choice(["RSC", "Die-cut"]),
+        "dimensions": {
+            "width": rng.randint(5, 60),
+            "length": rng.randint(5, 60),
+            "height": rng.randint(5, 60),
+        },
+        "quantity": rng.choice([500, 1000, 2000, 5000]),
+        "inner": {
+            "cushioning": rng.choice([None, *main.INNER_PRICES]),
+            "moisture_coating": rng.choice([None, *main.MOISTURE_COATING_PRICES]),
+            "food_coating": rng.choice([None, *main.FOOD_COATING_PRICES]),
+        },
+        "special_features": {
+            "gloss_coating": rng.choice([None, *main.GLOSS_COATING_PRICES]),
+            "matte_coating": rng.choice([None, *main.MATTE_COATING_PRICES]),
+            "emboss": {"type": rng.choice([None, "ปั๊มนูน"]), "has_block": rng.random() < 0.5},
+            "foil": {"type": rng.choice([None, "ทอง", *main.FOIL_BLOCK_PRICES]), "has_block": rng.random() < 0.5},
+        },
+    }
+
+
+def _catalog_rows(count: int, rng: random.Random) -> list:
+    """SKU x quantity x finish rows, shaped like a re-priced sales catalog."""
+    finishes = [_random_requirements(rng) for _ in range(40)]
+    rows = []
+    while len(rows) < count:
+        finish = rng.choice(finishes)
+        rows.append({
+            **finish,
+            "dimensions": {"width": rng.randint(5, 60), "length": rng.randint(5, 60), "height": rng.randint(5, 60)},
+            "quantity": rng.choice([500, 1000, 2000, 5000, 10000]),
+        })
+    return rows
+
+
+def bench_batch(args):
+    rng = random.Random(42)
+    rows = _catalog_rows(args.rows, rng)
+
+    loop = _timeit(lambda: [main._compute_quotation(r) for r in rows])
+    batch = _timeit(lambda: main.generate_quotations_batch(rows))
+    assert main.generate_quotations_batch(rows) == [main.generate_quotation(r) for r in rows]
+
+    print(f"rows:        {args.rows}")
+    print(f"scalar loop: {args.rows / loop:12,.0f} rows/s")
+    print(f"batch:       {args.rows / batch:12,.0f} rows/s  ({loop / batch:.1f}x)")
+
+    # batch แยกเป็น 3 ช่วง: อ่าน/จัดกลุ่มแถว, คำนวณด้วย numpy, แปลงกลับเป็น dict รายแถว (ส่วนที่เหลือ)
+    row_configs = [main._quotation_config(r) for r in rows]
+    configs = {c: main._resolve_quotation_config(c, main.pricing_catalog.tables) for c in row_configs}
+    columns = main._BATCH_COST_COLUMNS
+    cost = dict(zip(columns, np.array([[configs[c][col] for col in columns] for c in row_configs]).T))
+    qty = np.array([r.get("quantity", 500) for r in rows], dtype=np.float64)
+    raw_factor = np.ones(len(rows))
+    parse = _timeit(lambda: [main._quotation_config(r) for r in rows])
+    numeric = _timeit(lambda: main._price_totals(cost, raw_factor, qty))
+    assemble = max(batch - parse - numeric, 0.0)
+    print(f"batch time:  parse+group {parse / batch:.0%}, numpy {numeric / batch:.0%}, "
+          f"per-row output (tolist + result dicts) {assemble / batch:.0%}")
+    print("             (both paths build the same per-row dicts in Python, which bounds the speedup)")
+
+    if args.http:
+        from fastapi.testclient import TestClient
+
+        http = TestClient(main.app)
+        sample = rows[: args.http]
+        start = time.perf_counter()
+        for row in sample:
+            http.post("/api/calculate-price", json=row).raise_for_status()
+        per_request = time.perf_counter() - start
+        start = time.perf_counter()
+        http.post("/api/calculate-price/batch", json={"items": sample}).raise_for_status()
+        batch_request = time.perf_counter() - start
+        print(f"HTTP per-request: {len(sample) / per_request:9,.0f} rows/s")
+        print(f"HTTP batch:       {len(sample) / batch_request:9,.0f} rows/s  ({per_request / batch_request:.1f}x)")
+
+
+def bench_stream(args):
+    import httpx
+
+    main.client = FakeGenaiClient(first_token_latency=args.latency, tokens_per_second=args.tps)
+    body = {"message": "อยากได้กล่องใส่ขนมครับ"}
+
+    with _serve(main.app) as url, httpx.Client(base_url=url, timeout=30) as http:
+        start = time.perf_counter()
+        blocking = http.post("/api/chat", json=body).json()
+        blocking_total = time.perf_counter() - start
+
+        start = time.perf_counter()
+        first_token = None
+        done = None
+        with http.stream("POST", "/api/chat/stream", json=body) as response:
+            event = None
+            for line in response.iter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: ") and event == "token" and first_token is None:
+                    first_token = time.perf_counter() - start
+                elif line.startswith("data: ") and event == "done":
+                    done = json.loads(line[len("data: "):])
+        stream_total = time.perf_counter() - start
+
+    assert done["response"] == blocking["response"]
+    assert first_token < blocking_total, "first token arrived no earlier than the blocking reply"
+    print(f"/api/chat         time-to-first-token: {blocking_total * 1000:7.1f} ms")
+    print(f"/api/chat/stream  time-to-first-token: {first_token * 1000:7.1f} ms  (total {stream_total * 1000:.1f} ms)")
+
+
+def bench_load(args):
+    import asyncio
+    import httpx
+
+    main.client = FakeGenaiClient(first_token_latency=args.latency, tokens_per_second=1e9)
+
+    async def run(url):
+        async with httpx.AsyncClient(base_url=url, timeout=60) as http:
+            health = []
+            stop = asyncio.Event()
+
+            async def probe():
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    await http.get("/health")
+                    health.append(time.perf_counter() - start)
+                    await asyncio.sleep(0.02)
+
+            async def chat():
+                response = await http.post("/api/chat", json={"message": "อยากได้กล่องใส่ขนมครับ"})
+                return response.status_code
+
+            prober = asyncio.create_task(probe())
+            start = time.perf_counter()
+            statuses = await asyncio.gather(*(chat() for _ in range(args.requests)))
+            elapsed = time.perf_counter() - start
+            stop.set()
+            await prober
+            return statuses, elapsed, health
+
+    with _serve(main.app) as url:
+        statuses, elapsed, health = asyncio.run(run(url))
+
+    ok = statuses.count(200)
+    print(f"concurrency limit:   {main.LLM_MAX_CONCURRENCY} (LLM_MAX_CONCURRENCY)")
+    print(f"requests:            {args.requests} concurrent, fake model latency {args.latency * 1000:.0f} ms")
+    print(f"completed:           {ok} ok, {statuses.count(429)} rejected with 429")
+    print(f"wall time:           {elapsed:.2f} s  (serialized would be {ok * args.latency:.2f} s)")
+    print(f"chat throughput:     {ok / elapsed:.1f} req/s")
+    print(f"/health during load: max {max(health) * 1000:.1f} ms over {len(health)} probes")
+    limit = main.LLM_MAX_CONCURRENCY
+    assert set(statuses) <= {200, 429}, statuses
+    # ไม่เกิน limit ต้องผ่านทั้งหมด เกิน limit ต้องผ่านอย่างน้อย limit ตัว ที่เหลือได้ 429 (ไม่ต่อคิว)
+    assert ok == args.requests if args.requests <= limit else ok >= limit, statuses
+    # model call ไม่บล็อก event loop: request ที่ผ่านรันพร้อมกัน และ /health ตอบได้ระหว่างรอโมเดล
+    assert elapsed < -(-ok // limit) * args.latency + 1.0, f"chat calls ran serially ({elapsed:.2f} s)"
+    assert max(health) < args.latency, f"/health waited {max(health) * 1000:.0f} ms behind the model calls"
+
+
+def bench_sessions(args):
+    from fastapi.testclient import TestClient
+
+    main.client = FakeGenaiClient(first_token_latency=0, tokens_per_second=1e9)
+    http = TestClient(main.app)
+    checkpoints = sorted(set(args.turns))
+
+    def converse(use_session: bool) -> dict:
+        history, requirements, session_id = [], {}, None
+        stats = {}
+        for turn in range(1, max(checkpoints) + 1):
+            message = f"ข้อความรอบที่ {turn}"
+            if use_session and session_id:
+                body = {"message": message, "session_id": session_id}
+            else:
+                body = {"message": message, "conversation_history": history, "current_requirements": requirements}
+            payload = json.dumps(body, ensure_ascii=False).encode()
+            start = time.perf_counter()
+            response = http.post("/api/chat", content=payload, headers={"Content-Type": "application/json"})
+            elapsed = time.perf_counter() - start
+            assert response.status_code == 200, response.text
+            data = response.json()
+            # ใช้ session เดิมต่อทุก turn ต้องได้ id เดิมกลับมา
+            assert not (use_session and session_id) or data["session_id"] == session_id
+            session_id = data["session_id"]
+            history += [{"role": "user", "content": message}, {"role": "assistant", "content": data["response"]}]
+            requirements = {**requirements, **data["extracted_data"]}
+            if turn in checkpoints:
+                stats[turn] = (len(payload), elapsed)
+        if use_session:
+            # ประวัติและ requirements ที่ server เก็บต้องตรงกับที่ client สะสมเองทุกตัวอักษร
+            stored = main.session_store.get(session_id)
+            assert stored["history"] == history and stored["requirements"] == requirements
+        return stats
+
+    def best_of(use_session: bool, repeat: int = 5) -> dict:
+        runs = [converse(use_session) for _ in range(repeat)]
+        return {turn: (runs[0][turn][0], min(run[turn][1] for run in runs)) for turn in checkpoints}
+
+    legacy = best_of(use_session=False)
+    session = best_of(use_session=True)
+    # body ของ session ไม่โตตามจำนวน turn และเล็กกว่าการส่งประวัติทั้งหมด
+    sizes = [session[turn][0] for turn in checkpoints]
+    assert max(sizes) - min(sizes) < 16, sizes
+    assert all(session[turn][0] < legacy[turn][0] for turn in checkpoints if turn > 1)
+    expired = http.post("/api/chat", json={"message": "ต่อครับ", "session_id": "expired-session"})
+    assert expired.status_code == 410, expired.status_code
+    # session ที่ได้จาก store เป็นสำเนา แก้แล้วไม่กระทบของที่เก็บไว้
+    main.session_store.save("copy-check", {"history": [{"role": "user", "content": "x"}], "requirements": {}})
+    main.session_store.get("copy-check")["history"].clear()
+    assert main.session_store.get("copy-check")["history"], "session store returned its own dict"
+    health_max, chat_wait = _sqlite_session_contention(args.lock_seconds)
+    print(f"{'turn':>5} {'full-history bytes':>19} {'session bytes':>14} {'full-history ms':>16} {'session ms':>11}")
+    for turn in checkpoints:
+        print(f"{turn:>5} {legacy[turn][0]:>19,} {session[turn][0]:>14,} "
+              f"{legacy[turn][1] * 1000:>16.2f} {session[turn][1] * 1000:>11.2f}")
+    print(f"sqlite store locked by another writer for {args.lock_seconds:g} s: chat waited {chat_wait:.2f} s, "
+          f"/health max {health_max * 1000:.1f} ms")
+
+
+def _sqlite_session_contention(lock_seconds: float) -> tuple:
+    """chat ที่รอ lock ของ SQLite (อีก worker กำลังเขียน) ต้องไม่บล็อก event loop: /health ยังตอบทันที"""
+    import asyncio
+    import sqlite3
+    import tempfile
+    import httpx
+
+    workdir = tempfile.mkdtemp(prefix="lumopack-sessions-")
+    saved = main.session_store
+    main.session_store = main.SQLiteSessionStore(os.path.join(workdir, "sessions.db"))
+    blocker = sqlite3.connect(os.path.join(workdir, "sessions.db"), isolation_level=None, check_same_thread=False)
+
+    async def run(url):
+        async with httpx.AsyncClient(base_url=url, timeout=30) as http:
+            blocker.execute("BEGIN IMMEDIATE")
+            threading.Timer(lock_seconds, blocker.execute, ("COMMIT",)).start()
+            started = time.perf_counter()
+            chat = asyncio.ensure_future(http.post("/api/chat", json={"message": "อยากได้กล่องใส่ขนมครับ"}))
+            health = []
+            while not chat.done():
+                probe = time.perf_counter()
+                await http.get("/health")
+                health.append(time.perf_counter() - probe)
+                await asyncio.sleep(0.02)
+            response = await chat
+            assert response.status_code == 200, response.text
+            return max(health), time.perf_counter() - started
+
+    try:
+        with _serve(main.app) as url:
+            health_max, chat_wait = asyncio.run(run(url))
+    finally:
+        blocker.close()
+        main.session_store = saved
+        shutil.rmtree(workdir, ignore_errors=True)
+    assert chat_wait >= lock_seconds * 0.9, "chat did not wait for the sqlite write lock"
+    assert health_max < lock_seconds / 4, f"event loop blocked {health_max:.2f}s behind a sqlite write"
+    return health_max, chat_wait
+
+
+def bench_context(args):
+    from fastapi.testclient import TestClient
+
+    fake = FakeGenaiClient(first_token_latency=0, tokens_per_second=1e9)
+    main.client = fake
+    main.prompt_cache.enabled = args.cache
+    main.CHAT_TOKEN_BUDGET = args.budget
+    http = TestClient(main.app)
+
+    def sent_tokens() -> int:
+        request = fake.models.last_request
+        return sum(main.estimate_tokens(part["text"]) for msg in request["contents"] for part in msg["parts"])
+
+    session_id = None
+    full_history = 0
+    print(f"{'turn':>5} {'uncompacted':>12} {'sent':>8} {'saved':>8}")
+    for turn in range(1, args.turns + 1):
+        message = f"ข้อความรอบที่ {turn}"
+        body = {"message": message, "session_id": session_id} if session_id else {"message": message}
+        data = http.post("/api/chat", json=body).json()
+        session_id = data["session_id"]
+        last = main.context_stats["last_turn"]
+        uncompacted = last["prompt_tokens"] + last["tokens_saved_compaction"]
+        sent = sent_tokens()
+        if turn in (1, 5, 10, 20, args.turns):
+            print(f"{turn:>5} {uncompacted:>12,} {sent:>8,} {uncompacted - sent:>8,}")
+        full_history += uncompacted
+
+    stats = main.context_stats
+    print(f"total over {args.turns} turns: {full_history:,} tokens uncompacted, "
+          f"saved {stats['tokens_saved_compaction']:,} by compaction and {stats['tokens_saved_cache']:,} by prompt cache "
+          f"({len(fake.caches.created)} cache created)")
+
+
+# A full quick-reply conversation; only the free-text size answer needs the model.
+QUICK_REPLY_SCRIPT = [
+    "เริ่มต้น", "Food-grade", "Die-cut (ไดคัท)", "บับเบิ้ล", "ไม่ต้องการ", "PLA/Bio",
+    "20 x 30 x 10 ซม.", "1000", "ยืนยัน ✓", "พรีเมียม", "มีโลโก้", "ด้านบน",
+    "ปั๊มฟอยล์", "ทอง", "ยังไม่เคย", "เคลือบด้าน", "ลามิเนตด้าน", "ไม่ต้องการ",
+    "ยืนยัน ✓", "ยืนยันคำสั่งซื้อ ✓",
+]
+
+DIMENSIONS_REPLY = (
+    "รับทราบครับ กล่องขนาด 20 x 30 x 10 ซม. 📏 ต้องการผลิตกี่ชิ้นครับ?\n"
+    "<extracted_data>"
+    + json.dumps({
+        "dimensions": {"width": 20, "length": 30, "height": 10},
+        "current_step": 6,
+        "quick_replies": ["500", "1000", "2000", "5000"],
+    }, ensure_ascii=False)
+    + "</extracted_data>"
+)
+
+
+def bench_fastpath(args):
+    from fastapi.testclient import TestClient
+
+    main.client = FakeGenaiClient(reply=DIMENSIONS_REPLY, first_token_latency=args.latency, tokens_per_second=1e9)
+    http = TestClient(main.app)
+
+    latencies = {True: [], False: []}
+    for _ in range(args.conversations):
+        session_id, data = None, None
+        for message in QUICK_REPLY_SCRIPT:
+            body = {"message": message, "session_id": session_id} if session_id else {"message": message}
+            served_locally = main.fast_path_stats["local_turns"]
+            start = time.perf_counter()
+            data = http.post("/api/chat", json=body).json()
+            elapsed = time.perf_counter() - start
+            latencies[main.fast_path_stats["local_turns"] > served_locally].append(elapsed * 1000)
+            session_id = data["session_id"]
+        assert data["extracted_data"]["confirmed_order"], "conversation did not reach the order"
+
+    local, model = latencies[True], latencies[False]
+    total = len(local) + len(model)
+    print(f"turns:          {total} ({args.conversations} conversations x {len(QUICK_REPLY_SCRIPT)} messages)")
+    print(f"served locally: {len(local) / total:.0%}")
+    print(f"local turns:    p50 {statistics.median(local):.2f} ms, p95 {statistics.quantiles(local, n=20)[-1]:.2f} ms")
+    print(f"model turns:    p50 {statistics.median(model):.2f} ms (fake latency {args.latency * 1000:.0f} ms)")
+    print(f"/health:        {main.fast_path_summary()}")
+
+
+def bench_quote(args):
+    rng = random.Random(7)
+    rows = _catalog_rows(args.rows, rng)
+    assert args.rows <= main.quotation_cache.max_size, "rows must fit in QUOTATION_CACHE_SIZE"
+
+    uncached = _timeit(lambda: [main._compute_quotation(r) for r in rows])
+
+    def cold():
+        main.quotation_cache.clear()
+        for r in rows:
+            main.generate_quotation(r)
+
+    cold_time = _timeit(cold)
+    warm_time = _timeit(lambda: [main.generate_quotation(r) for r in rows])
+
+    per_quote = lambda seconds: seconds / args.rows * 1e6
+    print(f"uncached compute: {per_quote(uncached):7.2f} us/quote")
+    print(f"cold (miss+fill): {per_quote(cold_time):7.2f} us/quote")
+    print(f"warm (cache hit): {per_quote(warm_time):7.2f} us/quote  ({uncached / warm_time:.1f}x)")
+    print(f"cache:            {main.quotation_cache.stats()}")
+
+
+def bench_sweep(args):
+    request = main.SweepRequest(
+        length=main.SweepRange(start=10, stop=100, steps=args.steps),
+        width=main.SweepRange(start=10, stop=100, steps=args.steps),
+        weight=main.SweepRange(start=1, stop=40, steps=args.weights),
+    )
+    sweep = main.analyze_sweep(request)
+    axes = sweep["axes"]
+    flutes = list(main.FLUTE_SPECS)
+    designs = [
+        main.BoxDesign(length=length, width=width, height=20, flute_type=flute, weight=weight)
+        for weight in axes["weight"] for length in axes["length"] for width in axes["width"] for flute in flutes
+    ]
+
+    # ทุกช่องของ sweep ต้องเท่ากับ analyze_box ของแบบเดียวกัน
+    mismatches = 0
+    for design, expected in zip(designs, map(main.analyze_box, designs)):
+        w = axes["weight"].index(design.weight)
+        i, j = axes["length"].index(design.length), axes["width"].index(design.width)
+        got = (sweep["max_load_kg"][design.flute_type][i][j], sweep["safety_score"][design.flute_type][w][i][j])
+        mismatches += got != (expected["max_load_kg"], expected["safety_score"])
+    assert not mismatches, f"{mismatches} of {len(designs)} sweep cells differ from analyze_box"
+
+    loop_time = _timeit(lambda: [main.analyze_box(d) for d in designs])
+    sweep_time = _timeit(lambda: main.analyze_sweep(request))
+    print(f"cells:            {len(designs)} ({args.weights} weights x {args.steps}x{args.steps} sizes x {len(flutes)} flutes)")
+    print(f"analyze_box loop: {loop_time * 1000:8.2f} ms")
+    print(f"analyze_sweep:    {sweep_time * 1000:8.2f} ms  ({loop_time / sweep_time:.1f}x)")
+
+    if args.http:
+        from fastapi.testclient import TestClient
+
+        http = TestClient(main.app)
+        sample = designs[:args.http]
+        body = request.model_dump()
+        loop_http = _timeit(lambda: [http.post("/analyze", json=d.model_dump()) for d in sample], repeat=1)
+        sweep_http = _timeit(lambda: http.post("/analyze/sweep", json=body), repeat=1)
+        print(f"HTTP /analyze x{len(sample)}: {loop_http * 1000:8.2f} ms "
+              f"(~{loop_http / len(sample) * len(designs) * 1000:.0f} ms for all cells)")
+        print(f"HTTP /analyze/sweep: {sweep_http * 1000:8.2f} ms for all cells")
+
+
+def _optimize_by_trial(request) -> list:
+    """What a customer does today: /analyze and a box price for every option, then keep the Pareto front."""
+    tables = main.pricing_catalog.tables
+    candidates = []
+    steps = int(request.tolerance / request.tolerance_step + 1e-9) + 1
+    for box_type in ["RSC", "Die-cut"]:
+        board = tables["board"][box_type]["ลูกฟูก"]
+        for flute in main.FLUTE_SPECS:
+            for i in range(steps):
+                for j in range(steps):
+                    length = request.length + i * request.tolerance_step
+                    width = request.width + j * request.tolerance_step
+                    design = main.BoxDesign(length=length, width=width, height=request.height,
+                                            flute_type=flute, weight=request.product_weight)
+                    safety = main.analyze_box(design)["safety_score"]
+                    if safety < main.SAFETY_SAFE:
+                        continue
+                    factor = main.calculate_factor(width, length, request.height, box_type)
+                    candidates.append((round(main.flute_board_price(board, flute) * factor, 2), -safety))
+    front, best = [], float("-inf")
+    for price, negative_safety in sorted(candidates):
+        if -negative_safety > best:
+            front.append((price, -negative_safety))
+            best = -negative_safety
+    return front
+
+
+def bench_optimize(args):
+    typical = main.OptimizeRequest(product_weight=2, length=30, width=20, height=15, tolerance=10, tolerance_step=0.5)
+    loop_time = _timeit(lambda: _optimize_by_trial(typical), repeat=1)
+    fast_time = _timeit(lambda: main.optimize_box(typical))
+    result = main.optimize_box(typical)
+    # การตัดแบบที่แพ้แน่ (ขนาด/ความแข็งแรง) ต้องได้ front เดียวกับการลองทุกแบบ
+    # การลองทุกแบบเห็นแค่ safety ที่ปัด 2 ตำแหน่งจาก /analyze จึงยุบ front ของ optimize_box ให้ละเอียดเท่ากันก่อนเทียบ
+    for weight, tolerance, step in itertools.product((0.5, 2, 4, 8), (3, 10, 20), (0.25, 0.5, 1)):
+        request = main.OptimizeRequest(product_weight=weight, length=30, width=20, height=15,
+                                       tolerance=tolerance, tolerance_step=step)
+        front, best = [], float("-inf")
+        for option in main.optimize_box(request)["pareto_front"]:
+            if option["safety_score"] > best:
+                front.append((option["price_per_box"], option["safety_score"]))
+                best = option["safety_score"]
+        assert front == _optimize_by_trial(request), f"front differs from brute force for {request}"
+    print(f"typical search:  {result['searched']} candidates, front {len(result['pareto_front'])}")
+    print(f"  trial loop:    {loop_time * 1000:8.2f} ms")
+    print(f"  optimize_box:  {fast_time * 1000:8.2f} ms  ({loop_time / fast_time:.0f}x)")
+
+    for tolerance, step in args.spaces:
+        request = main.OptimizeRequest(product_weight=2, length=30, width=20, height=15,
+                                       tolerance=tolerance, tolerance_step=step)
+        elapsed = _timeit(lambda: main.optimize_box(request))
+        result = main.optimize_box(request)
+        print(f"tolerance {tolerance:g} cm step {step:g}: {result['searched']:>9} candidates "
+              f"({result['evaluated']} after pruning), front {len(result['pareto_front']):4}, {elapsed * 1000:7.2f} ms")
+
+
+FULL_EXTRACTED = {
+    "product_type": "Food-grade", "box_type": "Die-cut",
+    "inner": {"cushioning": "บับเบิ้ล", "moisture_coating": None, "food_coating": "PLA/Bio Coating"},
+    "dimensions": {"width": 20, "length": 30.5, "height": 10}, "quantity": 1000, "mood_tone": "มินิมอล",
+    "logo": {"has_logo": True, "position": "ด้านบน"},
+    "special_features": {
+        "gloss_coating": None, "matte_coating": "UV ด้าน",
+        "emboss": {"type": None, "has_block": False}, "foil": {"type": "ทอง", "color": None, "has_block": True},
+    },
+    "current_step": 10, "is_checkpoint": False, "confirmed_structure": True, "confirmed_design": True,
+    "confirmed_order": False, "quick_replies": ["ยืนยัน ✓", "ขอแก้ไข"],
+}
+
+
+def _regex_parse(text: str):
+    """The parser main.py used before parse_model_reply (two regex passes)."""
+    import re
+
+    match = re.search(r"<extracted_data>\s*(\{.*?\})\s*</extracted_data>", text, re.DOTALL)
+    data = {}
+    if match:
+        try:
+            data = json.loads(match.group(1))
+        except json.JSONDecodeError:
+            pass
+    return re.sub(r"<extracted_data>.*?</extracted_data>", "", text, flags=re.DOTALL).strip(), data
+
+
+def _model_reply(rng: random.Random, prose_chars: int) -> str:
+    words = ["กล่อง", "ขนาด", "{ตัวอย่าง}", "ราคา", "ครับ", "😊", "<b>", "RSC", "\n", "}", "จำนวน"]
+    prose = []
+    while sum(map(len, prose)) < prose_chars:
+        prose.append(rng.choice(words))
+    block = json.dumps(FULL_EXTRACTED, ensure_ascii=False, indent=rng.choice([None, 2]))
+    return " ".join(prose) + "\n\n<extracted_data>\n" + block + "\n</extracted_data>"
+
+
+def bench_extract(args):
+    rng = random.Random(12)
+    # truncated replies: how many turns keep usable data
+    truncated = [(t := _model_reply(rng, 200))[:rng.randint(t.index("<extracted_data>"), len(t) - 1)]
+                 for _ in range(2000)]
+    kept_new = sum(bool(main.parse_model_reply(t)[1]) for t in truncated)
+    kept_old = sum(bool(_regex_parse(t)[1]) for t in truncated)
+    print(f"truncated replies with usable data: regex {kept_old / len(truncated):.0%}, parser {kept_new / len(truncated):.0%}")
+
+    for label, text, repeat in (
+        ("typical reply", _model_reply(rng, 600), 2000),
+        (f"{args.kb} KB reply", _model_reply(rng, args.kb * 1024), 20),
+        ("32 KB, unclosed tags", "ข้อความ <extracted_data>{" * (32 * 1024 // 26), 1),
+    ):
+        old = _timeit(lambda: [_regex_parse(text) for _ in range(repeat)], repeat=1) / repeat
+        new = _timeit(lambda: [main.parse_model_reply(text) for _ in range(repeat)], repeat=1) / repeat
+        megabytes = len(text.encode()) / 1e6
+        print(f"{label:22} regex {old * 1e6:10.1f} us ({megabytes / old:7.1f} MB/s)  "
+              f"parser {new * 1e6:10.1f} us ({megabytes / new:7.1f} MB/s)")
+
+
+IMPORT_PROBE = """
+import resource, sys, time
+started = time.perf_counter()
+if sys.argv[1] == "eager":
+    from google import genai  # what main.py did at import time before get_client()
+import main
+print(time.perf_counter() - started, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+      int("google.genai" in sys.modules))
+"""
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _child_pids(parent: int) -> list:
+    pids = []
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == parent:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    return pids
+
+
+def _memory_kb(pid: int) -> dict:
+    """Rss/Pss/Private/Shared (kB) from /proc/<pid>/smaps_rollup."""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return {
+        "rss": fields["Rss"],
+        "pss": fields["Pss"],
+        "private": fields["Private_Clean"] + fields["Private_Dirty"],
+        "shared": fields["Shared_Clean"] + fields["Shared_Dirty"],
+    }
+
+
+def _measure_serve(workers: int, preload: bool) -> dict:
+    port = _free_port()
+    command = [sys.executable, "serve.py", "--workers", str(workers), "--host", "127.0.0.1",
+               "--port", str(port), "--log-level", "warning"]
+    if not preload:
+        command.append("--no-preload")
+    started = time.perf_counter()
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, env={**os.environ, "GEMINI_API_KEY": ""})
+    try:
+        while True:
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1).read()
+                break
+            except OSError:
+                if proc.poll() is not None:
+                    raise RuntimeError("serve.py exited before serving")
+                time.sleep(0.005)
+        ready = time.perf_counter() - started
+        # ให้ทุก worker ผ่าน startup และรับ request สักหน่อยก่อนวัดหน่วยความจำ
+        for _ in range(workers * 20):
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/api/pricing-info").read()
+        time.sleep(0.5)
+        memory = [_memory_kb(pid) for pid in _child_pids(proc.pid)]
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=30)
+    average = {key: sum(m[key] for m in memory) / len(memory) / 1024 for key in memory[0]}
+    return {"ready": ready, "workers": len(memory), **average}
+
+
+def bench_startup(args):
+    print("import main (fresh interpreter, best of 3):")
+    imports = {}
+    for mode in ("eager", "lazy"):
+        runs = [
+            subprocess.run([sys.executable, "-c", IMPORT_PROBE, mode], capture_output=True, text=True,
+                           check=True, env={**os.environ, "GEMINI_API_KEY": ""}).stdout.split()
+            for _ in range(3)
+        ]
+        seconds = min(float(r[0]) for r in runs)
+        max_rss_mb = min(int(r[1]) for r in runs) / 1024
+        label = "genai imported at startup" if mode == "eager" else "genai deferred (get_client)"
+        print(f"  {label:28} {seconds * 1000:7.0f} ms  max RSS {max_rss_mb:6.1f} MB")
+        imports[mode] = {"rss": max_rss_mb, "genai": {r[2] for r in runs}}
+    # import main ต้องไม่ลาก genai มาด้วย (import ตอนเรียกโมเดลครั้งแรกเท่านั้น)
+    assert imports["lazy"]["genai"] == {"0"}, "import main loaded google.genai"
+    assert imports["lazy"]["rss"] < imports["eager"]["rss"], imports
+
+    print(f"serve.py --workers {args.workers} (per worker averages, MB):")
+    serve = {}
+    for preload in (False, True):
+        m = serve[preload] = _measure_serve(args.workers, preload)
+        label = "preload in master" if preload else "import per worker"
+        print(f"  {label:18} ready {m['ready'] * 1000:6.0f} ms  RSS {m['rss']:6.1f}  PSS {m['pss']:6.1f}  "
+              f"private {m['private']:6.1f}  shared {m['shared']:6.1f}  ({m['workers']} workers)")
+        assert m["workers"] == args.workers, f"expected {args.workers} workers, found {m['workers']}"
+    # preload: ข้อมูลที่ import ใน master ต้องแชร์ข้าม worker (private ต่อ worker ลดลง)
+    if args.workers > 1:
+        assert serve[True]["private"] < serve[False]["private"], serve
+        assert serve[True]["pss"] < serve[False]["pss"], serve
+
+
+def bench_respcache(args):
+    from fastapi.testclient import TestClient
+
+    main.client = FakeGenaiClient(reply=DIMENSIONS_REPLY, first_token_latency=args.latency, tokens_per_second=1e9)
+    http = TestClient(main.app)
+    cache = main.chat_response_cache
+
+    # ไม่มี session_id และไม่มี pending_question จึงไม่เข้า fast path ทุก turn ไปถึง cache
+    requirements = {"product_type": "Food-grade", "box_type": "Die-cut", "current_step": 5,
+                    "quick_replies": ["บับเบิ้ล"], "inner": {"cushioning": None}}
+    body = {"message": "บับเบิ้ล", "current_requirements": requirements}
+
+    cache.clear()
+    start = time.perf_counter()
+    http.post("/api/chat", json=body)
+    model_ms = (time.perf_counter() - start) * 1000
+
+    hits = []
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        http.post("/api/chat", json=body)
+        hits.append((time.perf_counter() - start) * 1000)
+
+    # ใน process: เวลา lookup + ประกอบ ChatResponse (ไม่รวม HTTP)
+    session = {"history": [], "requirements": dict(requirements)}
+    lookup = _timeit(lambda: [main.cached_chat_turn(session, "บับเบิ้ล") for _ in range(1000)]) / 1000 * 1e6
+
+    print(f"model turn:    {model_ms:.1f} ms (fake latency {args.latency * 1000:.0f} ms)")
+    print(f"cached turn:   p50 {statistics.median(hits):.2f} ms, p95 {statistics.quantiles(hits, n=20)[-1]:.2f} ms over HTTP "
+          f"({args.requests} requests)")
+    print(f"cache lookup:  {lookup:.1f} us in process")
+    print(f"/health:       {cache.summary()}")
+
+
+def _asgi_post(app, path: str, payload: dict):
+    """POST ตรงเข้า ASGI app (ไม่ผ่าน socket/TestClient) เพื่อให้เห็น overhead ของ middleware ชัด ๆ"""
+    body = json.dumps(payload).encode()
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+             "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+             "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+             "client": ("127.0.0.1", 1234), "server": ("127.0.0.1", 80), "state": {}}
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            assert message["status"] == 200, message
+
+    return app(scope, receive, send)
+
+
+def bench_metrics(args):
+    import asyncio
+
+    rng = random.Random(3)
+    rows = _catalog_rows(args.distinct, rng)
+    loop = asyncio.new_event_loop()
+    # A/B ของ app เดียวกัน: มี MetricsMiddleware + span เทียบกับ stack ที่ไม่มี middleware และปิด span
+    with_metrics = main.app.build_middleware_stack()
+    saved = main.app.user_middleware
+    main.app.user_middleware = [m for m in saved if m.cls is not main.MetricsMiddleware]
+    without_metrics = main.app.build_middleware_stack()
+    main.app.user_middleware = saved
+    # งบ 2% วัดกับเส้นทางที่คำนวณราคาจริง (response cache ปิด) ส่วน cache hit แสดงแยก
+    main.coalesced_responses.enabled = False
+
+    def run(enabled: bool, app=None) -> float:
+        main.METRICS_ENABLED = enabled
+        app = app or (with_metrics if enabled else without_metrics)
+
+        async def batch():
+            for i in range(args.requests):
+                await _asgi_post(app, "/api/calculate-price", rows[i % len(rows)])
+
+        start = time.perf_counter()
+        loop.run_until_complete(batch())
+        return (time.perf_counter() - start) / args.requests
+
+    async def paired(count: int) -> list:
+        # สลับ off/on ทีละ request (สลับลำดับในคู่ทุกครั้ง) body เดียวกันทั้งคู่
+        # noise ของเครื่องจึงตกทั้งสองฝั่งเท่า ๆ กัน
+        timings = []
+        for i in range(count):
+            row = rows[i % len(rows)]
+            pair = {}
+            for enabled in ((False, True) if i % 2 == 0 else (True, False)):
+                main.METRICS_ENABLED = enabled
+                app = with_metrics if enabled else without_metrics
+                start = time.perf_counter()
+                await _asgi_post(app, "/api/calculate-price", row)
+                pair[enabled] = time.perf_counter() - start
+            timings.append((pair[False], pair[True]))
+        return timings
+
+    run(False), run(True)
+    overheads, off_rounds, on_rounds = [], [], []
+    for _ in range(args.rounds):
+        timings = loop.run_until_complete(paired(args.requests))
+        off = statistics.median(t[0] for t in timings)
+        on = statistics.median(t[1] for t in timings)
+        off_rounds.append(off), on_rounds.append(on), overheads.append(on / off - 1)
+    off, on = statistics.median(off_rounds), statistics.median(on_rounds)
+    overhead = statistics.median(overheads)
+
+    main.coalesced_responses.enabled = True
+    run(True)
+    cached = statistics.median(run(True) for _ in range(5))
+    main.METRICS_ENABLED = True
+    main.coalesced_responses.enabled = main.COALESCE_REQUESTS
+    scrape = _timeit(main.render_metrics, repeat=20)
+
+    print(f"/api/calculate-price ({args.rounds} rounds x {args.requests} request pairs interleaved off/on, "
+          f"{args.distinct} distinct bodies, ASGI direct, response cache off)")
+    spread = lambda values: f"{min(values) * 1e6:.0f}-{max(values) * 1e6:.0f}"
+    print(f"metrics off:     {off * 1e6:7.1f} us/request (median request, rounds {spread(off_rounds)})")
+    print(f"metrics on:      {on * 1e6:7.1f} us/request (median request, rounds {spread(on_rounds)})")
+    print(f"overhead:        {overhead:+.2%} (median of rounds, range {min(overheads):+.2%} .. {max(overheads):+.2%})")
+    print(f"response cache hit with metrics: {cached * 1e6:6.1f} us/request")
+    print(f"/metrics render: {scrape * 1000:.2f} ms")
+    assert overhead < 0.02, "metrics overhead on /api/calculate-price above 2%"
+
+
+BULK_HEADER = ["sku", "product_type", "box_type", "width", "length", "height", "quantity",
+               "cushioning", "gloss_coating", "foil", "foil_has_block", "note"]
+
+
+def _write_bulk_csv(path: str, count: int, seed: int = 11) -> None:
+    """แถวสุ่มแบบไฟล์จากฝ่ายจัดซื้อ ปนแถวที่ผิด (ตัวเลขเสีย, จำนวน 0) และข้อความหลายบรรทัด"""
+    import csv
+
+    rng = random.Random(seed)
+    products = list(main.PRODUCT_TYPE_MATERIALS)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(BULK_HEADER)
+        for i in range(count):
+            quantity = rng.choice(["500", "1,000", "2000", "5000"])
+            width = str(rng.randint(5, 60))
+            if i % 997 == 0:
+                width = "n/a"
+            elif i % 1009 == 0:
+                quantity = "0"
+            writer.writerow([
+                f"SKU-{i}", rng.choice(products), rng.choice(["RSC", "Die-cut"]), width,
+                str(rng.randint(5, 60)), str(rng.randint(5, 60)), quantity,
+                rng.choice(["", *main.INNER_PRICES]), rng.choice(["", *main.GLOSS_COATING_PRICES]),
+                rng.choice(["", "ทอง", *main.FOIL_BLOCK_PRICES]), rng.choice(["", "yes", "no"]),
+                "ส่งด่วน\nชั้น 2" if i % 50 == 0 else "",
+            ])
+
+
+BULK_MEMORY_PROBE = """
+import os, shutil, sys
+import main
+
+def status_kb(field):
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith(field))
+
+# ล้าง high-water mark ของ RSS หลัง import เพื่อให้ค่าสูงสุดเป็นของ job เท่านั้น
+with open("/proc/self/clear_refs", "w") as f:
+    f.write("5")
+baseline = status_kb("VmRSS:")
+job = main.BulkQuotationJob.create("csv")
+shutil.copyfile(sys.argv[1], job.input_path)
+job.state["input_size"] = os.path.getsize(job.input_path)
+job.run()
+assert job.state["status"] == "done", job.state
+print(baseline, status_kb("VmHWM:"), job.state["rows_done"], job.state["elapsed_seconds"])
+"""
+
+
+def bench_bulk(args):
+    import csv
+    import io
+    import tempfile
+    from fastapi.testclient import TestClient
+
+    workdir = tempfile.mkdtemp(prefix="lumopack-bulk-")
+    main.BULK_JOB_DIR = os.path.join(workdir, "jobs")
+    main.BULK_CHUNK_ROWS = 1000
+    http = TestClient(main.app)
+
+    # 1) อัปโหลดผ่าน HTTP แล้วเทียบทุกแถวกับ generate_quotation
+    sample = os.path.join(workdir, "sample.csv")
+    _write_bulk_csv(sample, args.check)
+    with open(sample, "rb") as f:
+        job_id = http.post("/api/calculate-price/jobs", content=f.read()).json()["job_id"]
+    while http.get(f"/api/calculate-price/jobs/{job_id}").json()["status"] in ("queued", "running"):
+        time.sleep(0.01)
+    status = http.get(f"/api/calculate-price/jobs/{job_id}").json()
+    output = http.get(f"/api/calculate-price/jobs/{job_id}/result").content.decode("utf-8-sig")
+    with open(sample, newline="", encoding="utf-8") as f:
+        source = list(csv.reader(f))[1:]
+    results = list(csv.reader(io.StringIO(output)))[1:]
+    assert status["status"] == "done" and status["rows_done"] == len(source) == len(results), status
+    fields = main.bulk_row_fields(BULK_HEADER)
+    failed = 0
+    for row, result in zip(source, results):
+        assert result[:len(row)] == row
+        try:
+            expected = main.generate_quotation(main.bulk_row_requirements(fields, row))
+        except Exception:
+            assert result[-1], row
+            failed += 1
+            continue
+        priced = [str(value) for value in main._pricing_values(expected["pricing"])]
+        assert result[len(row):-1] == [expected["material"], expected["catalog_version"], *priced], row
+    assert failed == status["rows_failed"]
+
+    # 2) ตายกลาง chunk แล้ว resume ต้องได้ไฟล์เดียวกับที่รันรวดเดียว
+    job = main.BulkQuotationJob.load(job_id)
+    reference = output.encode("utf-8-sig")
+    interrupted = main.BulkQuotationJob.create("csv")
+    os.replace(job.input_path, interrupted.input_path)
+    interrupted.state["input_size"] = os.path.getsize(interrupted.input_path)
+    chunks = interrupted._chunks
+
+    def crash_after_three():
+        for i, item in enumerate(chunks()):
+            if i == 3:
+                with open(interrupted.output_path, "a", encoding="utf-8") as out:
+                    out.write("half-written row,")
+                raise MemoryError("simulated crash")
+            yield item
+
+    interrupted._chunks = crash_after_three
+    interrupted.run()
+    crashed = dict(interrupted.state)
+    interrupted._chunks = chunks
+    resumed = http.post(f"/api/calculate-price/jobs/{interrupted.id}/resume").json()
+    while http.get(f"/api/calculate-price/jobs/{interrupted.id}").json()["status"] in ("queued", "running"):
+        time.sleep(0.01)
+    with open(interrupted.output_path, "rb") as f:
+        assert f.read() == reference, "resumed output differs"
+    print(f"correctness: {len(source):,} rows match generate_quotation ({failed} rejected with an error column); "
+          f"crash after {crashed['chunks_done']} chunks ({crashed['status']}) -> resume ({resumed['status']}) gives identical output")
+
+    # 3) หน่วยความจำสูงสุดต่อจำนวนแถว (process แยก ใช้ chunk ปกติ)
+    print(f"{'rows':>10} {'file MB':>8} {'time s':>7} {'rows/s':>8} {'peak RSS MB':>12} {'above import':>13}")
+    for count in args.rows:
+        path = os.path.join(workdir, f"rows-{count}.csv")
+        _write_bulk_csv(path, count)
+        env = {**os.environ, "BULK_JOB_DIR": os.path.join(workdir, "probe")}
+        baseline, peak, rows, seconds = subprocess.run(
+            [sys.executable, "-c", BULK_MEMORY_PROBE, path], capture_output=True, text=True, check=True, env=env,
+        ).stdout.split()
+        size_mb = os.path.getsize(path) / 1e6
+        print(f"{int(rows):>10,} {size_mb:>8.1f} {float(seconds):>7.1f} {int(rows) / float(seconds):>8,.0f} "
+              f"{int(peak) / 1024:>12.1f} {(int(peak) - int(baseline)) / 1024:>13.1f}")
+        os.remove(path)
+        shutil.rmtree(env["BULK_JOB_DIR"], ignore_errors=True)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_breaks(args):
+    from fastapi.testclient import TestClient
+
+    rng = random.Random(5)
+    designs = [_random_requirements(rng) for _ in range(args.designs)]
+    tiers = sorted(rng.sample(range(100, 50001, 100), args.tiers))
+    fields = ("box_total", "inner_total", "features_total", "grand_total", "price_per_unit")
+
+    points = 0
+    for requirements in designs:
+        table = main.generate_price_breaks(requirements, tiers, args.curve)
+        for quantity, row in zip(tiers, table["tiers"]):
+            expected = main.generate_quotation({**requirements, "quantity": quantity})["pricing"]
+            assert {f: row[f] for f in fields} == {f: expected[f] for f in fields}, (requirements, quantity)
+        for quantity, price in zip(table["curve"]["quantities"], table["curve"]["price_per_unit"]):
+            expected = main.generate_quotation({**requirements, "quantity": quantity})["pricing"]
+            assert price == expected["price_per_unit"], (requirements, quantity)
+        points = len(tiers) + len(table["curve"]["quantities"])
+
+    def per_point(quantities_of):
+        # cache ว่างทุกรอบ: ทุกจำนวนคิดใหม่จริง ไม่ได้จาก quotation_cache
+        main.quotation_cache.clear()
+        for r in designs:
+            for q in quantities_of(r):
+                main.generate_quotation({**r, "quantity": q})
+
+    curves = {id(r): main.generate_price_breaks(r, tiers, args.curve)["curve"]["quantities"] for r in designs}
+    tiers_cold = _timeit(lambda: per_point(lambda r: tiers))
+    full_cold = _timeit(lambda: per_point(lambda r: [*tiers, *curves[id(r)]]))
+    table = _timeit(lambda: [main.generate_price_breaks(r, tiers, 0) for r in designs])
+    with_curve = _timeit(lambda: [main.generate_price_breaks(r, tiers, args.curve) for r in designs])
+    per_design = lambda seconds: seconds / args.designs * 1e6
+
+    http = TestClient(main.app)
+    body = designs[0]
+    main.quotation_cache.clear()
+    start = time.perf_counter()
+    for q in tiers:
+        http.post("/api/calculate-price", json={**body, "quantity": q}).raise_for_status()
+    loop_http = time.perf_counter() - start
+    start = time.perf_counter()
+    http.post("/api/calculate-price", json={**body, "quantities": tiers}).raise_for_status()
+    one_http = time.perf_counter() - start
+
+    print(f"{args.designs} designs x {len(tiers)} tiers: every tier field and {args.curve}-point curve price "
+          f"equals generate_quotation")
+    print("generate_quotation per quantity, cold quotation cache:")
+    print(f"  {f'{len(tiers)} tiers:':28} {per_design(tiers_cold):8.1f} us/design")
+    print(f"  {f'tiers + curve ({points} points):':28} {per_design(full_cold):8.1f} us/design")
+    print("generate_price_breaks (one _price_totals call):")
+    print(f"  {f'{len(tiers)} tiers:':28} {per_design(table):8.1f} us/design  ({tiers_cold / table:.1f}x)")
+    print(f"  {'tiers + curve:':28} {per_design(with_curve):8.1f} us/design  ({full_cold / with_curve:.1f}x)")
+    print(f"HTTP: {len(tiers)} calls {loop_http * 1000:.1f} ms vs one call with quantities {one_http * 1000:.1f} ms")
+
+
+def _toggle_option(requirements: dict, rng: random.Random) -> dict:
+    """หนึ่งการคลิกบนหน้าใบเสนอราคา: เปลี่ยนตัวเลือกเดียว (บางครั้งเปลี่ยนขนาด/ชนิดกล่อง)"""
+    changed = json.loads(json.dumps(requirements))
+    inner, features = changed["inner"], changed["special_features"]
+    choice = rng.randrange(9)
+    if choice == 0:
+        changed["product_type"] = rng.choice(list(main.PRODUCT_TYPE_MATERIALS))
+    elif choice == 1:
+        inner["cushioning"] = rng.choice([None, *main.INNER_PRICES])
+    elif choice == 2:
+        inner["moisture_coating"] = rng.choice([None, *main.MOISTURE_COATING_PRICES])
+    elif choice == 3:
+        features["gloss_coating"] = rng.choice([None, *main.GLOSS_COATING_PRICES])
+    elif choice == 4:
+        features["matte_coating"] = rng.choice([None, *main.MATTE_COATING_PRICES])
+    elif choice == 5:
+        features["emboss"] = {"type": rng.choice([None, "ปั๊มนูน"]), "has_block": rng.random() < 0.5}
+    elif choice == 6:
+        features["foil"] = {"type": rng.choice([None, "ทอง", *main.FOIL_BLOCK_PRICES]), "has_block": rng.random() < 0.5}
+    elif choice == 7:
+        changed["quantity"] = rng.choice([300, 500, 1000, 2000, 5000, 10000])
+    elif rng.random() < 0.5:
+        changed["dimensions"] = {k: v + rng.choice([-2, 2]) for k, v in changed["dimensions"].items()}
+    else:
+        changed["box_type"] = "Die-cut" if changed["box_type"] == "RSC" else "RSC"
+    return changed
+
+
+def bench_kernel(args):
+    from fastapi.testclient import TestClient
+
+    rng = random.Random(17)
+    http = TestClient(main.app)
+    old = {"requests": 0, "bytes": 0, "seconds": 0.0}
+    new = {"requests": 0, "bytes": 0, "seconds": 0.0, "local_quotes": 0, "not_modified": 0}
+
+    def call(stats, method, url, **kwargs):
+        start = time.perf_counter()
+        response = http.request(method, url, **kwargs)
+        stats["seconds"] += time.perf_counter() - start
+        stats["requests"] += 1
+        stats["bytes"] += len(response.content) + (len(json.dumps(kwargs["json"]).encode()) if "json" in kwargs else 0)
+        return response
+
+    local_seconds = 0.0
+    for _ in range(args.sessions):
+        requirements = _random_requirements(rng)
+        states = [requirements]
+        for _ in range(rng.randint(args.toggles // 2, args.toggles * 3 // 2)):
+            states.append(_toggle_option(states[-1], rng))
+
+        # เดิม: ทุกการคลิกเรียก /api/calculate-price
+        for state in states:
+            call(old, "POST", "/api/calculate-price", json=state).raise_for_status()
+
+        # kernel: โหลดเมื่อขนาด/ชนิดกล่องเปลี่ยน คิดราคาเองทุกคลิก แล้วตรวจยอดสุดท้ายครั้งเดียว
+        kernel, etags, key = None, {}, None
+        for state in states:
+            dims = state["dimensions"]
+            state_key = (dims["width"], dims["length"], dims["height"], state["box_type"])
+            if state_key != key:
+                key = state_key
+                params = dict(zip(("width", "length", "height", "box_type"), state_key))
+                headers = {"If-None-Match": etags[key][0]} if key in etags else {}
+                response = call(new, "GET", "/api/pricing-kernel", params=params, headers=headers)
+                if response.status_code == 304:
+                    new["not_modified"] += 1
+                    kernel = etags[key][1]
+                else:
+                    kernel = response.json()
+                    etags[key] = (response.headers["etag"], kernel)
+            start = time.perf_counter()
+            local = main.quote_from_kernel(kernel, state)
+            local_seconds += time.perf_counter() - start
+            new["local_quotes"] += 1
+            assert local["pricing"] == main.generate_quotation(state)["pricing"], state
+        pricing = local["pricing"]
+        verdict = call(new, "POST", "/api/pricing-kernel/verify", json={
+            "requirements": states[-1], "checksum": kernel["checksum"],
+            "grand_total": pricing["grand_total"], "price_per_unit": pricing["price_per_unit"],
+        }).json()
+        assert verdict["valid"], verdict
+
+    # ขนาดที่ไม่ใช่จำนวนบวกจำกัดต้องถูกปฏิเสธ ไม่ใช่ได้ kernel ที่เป็น NaN
+    for bad in ("nan", "inf", "0", "-1"):
+        params = {"width": 10, "length": 10, "height": bad}
+        assert http.get("/api/pricing-kernel", params=params).status_code == 422, bad
+    bad_requirements = dict(states[-1], dimensions={"width": -5, "length": 10, "height": 10})
+    response = http.post("/api/pricing-kernel/verify", json={"requirements": bad_requirements, "checksum": ""})
+    assert response.status_code == 400, response.text
+
+    per = lambda stats, key: stats[key] / args.sessions
+    print(f"{args.sessions} quoting sessions, {new['local_quotes']:,} option states; every local quote equals "
+          f"generate_quotation and every final total verified")
+    print(f"{'':28} {'requests':>9} {'KB':>8} {'server ms':>10}   (per session)")
+    print(f"{'calculate-price per click':28} {per(old, 'requests'):>9.1f} {per(old, 'bytes') / 1024:>8.1f} "
+          f"{per(old, 'seconds') * 1000:>10.1f}")
+    print(f"{'kernel + local + verify':28} {per(new, 'requests'):>9.1f} {per(new, 'bytes') / 1024:>8.1f} "
+          f"{per(new, 'seconds') * 1000:>10.1f}   ({new['not_modified']} kernel refetches answered 304)")
+    print(f"request volume: -{1 - new['requests'] / old['requests']:.0%}; "
+          f"local recalculation {local_seconds / new['local_quotes'] * 1e6:.1f} us per click")
+
+
+# บันทึกจาก CHAT_TRANSCRIPT_DIR: <session_id>.jsonl บรรทัดละ {"user": ..., "model": คำตอบดิบ หรือ null}
+TRANSCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcripts")
+REQUIREMENTS_MARKER = "\n\n[ข้อมูลที่เก็บได้:"
+
+
+def load_transcripts(paths: list) -> list:
+    """[(ชื่อ, [turn, ...]), ...] จากไฟล์ .jsonl หรือโฟลเดอร์ที่มีไฟล์ .jsonl"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".jsonl"))
+        else:
+            files.append(path)
+    transcripts = []
+    for path in files:
+        with open(path, encoding="utf-8") as f:
+            turns = [json.loads(line) for line in f if line.strip()]
+        if turns:
+            transcripts.append((os.path.splitext(os.path.basename(path))[0], turns))
+    return transcripts
+
+
+class ReplayModels(FakeModels):
+    """FakeModels ที่ตอบด้วยคำตอบที่บันทึกไว้ของแต่ละบทสนทนา
+
+    คำตอบถูกจับคู่ด้วย (คำตอบล่าสุดของ assistant, ข้อความผู้ใช้) จึง replay หลายบทสนทนาพร้อมกันได้
+    ถ้าโมเดลถูกเรียกใน turn ที่ตอนบันทึก server ตอบเอง จะ raise ให้ request นั้นล้ม
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(reply="", **kwargs)
+        self._expected = {}
+        self._lock = threading.Lock()
+        self.unexpected = 0
+
+    def expect(self, previous, message: str, reply: str) -> dict:
+        entry = {"reply": reply, "used": False}
+        with self._lock:
+            self._expected.setdefault((previous, message), []).append(entry)
+        return entry
+
+    def discard(self, previous, message: str, entry: dict) -> None:
+        with self._lock:
+            pending = self._expected.get((previous, message), [])
+            if entry in pending:
+                pending.remove(entry)
+
+    def reply_for(self, contents) -> str:
+        message = contents[-1]["parts"][0]["text"].split(REQUIREMENTS_MARKER)[0]
+        previous = next((msg["parts"][0]["text"] for msg in reversed(contents[:-1]) if msg["role"] == "model"), None)
+        if previous == main.PROMPT_PREFIX[1]["parts"][0]["text"]:
+            previous = None
+        with self._lock:
+            # ประวัติอาจถูกตัด (compaction) จนไม่เห็นคำตอบก่อนหน้า ให้จับคู่ด้วยข้อความอย่างเดียว
+            pending = self._expected.get((previous, message)) or next(
+                (entries for (_, text), entries in self._expected.items() if text == message and entries), None)
+            if not pending:
+                self.unexpected += 1
+                raise RuntimeError(f"no recorded model reply for {message!r}")
+            entry = pending.pop(0)
+        entry["used"] = True
+        return entry["reply"]
+
+
+def _percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def _replay_conversation(http, fake: ReplayModels, turns: list, stream: bool) -> dict:
+    path = "/api/chat/stream" if stream else "/api/chat"
+    session_id, previous, data = None, None, {}
+    records = []
+    for turn in turns:
+        message = turn["user"]
+        body = {"message": message, "session_id": session_id} if session_id else {"message": message}
+        payload = json.dumps(body, ensure_ascii=False).encode()
+        entry = fake.expect(previous, message, turn["model"]) if turn.get("model") is not None else None
+        start = time.perf_counter()
+        first_token, error = None, None
+        if stream:
+            size, done = 0, None
+            with http.stream("POST", path, content=payload, headers={"Content-Type": "application/json"}) as response:
+                status = response.status_code
+                event = None
+                for line in response.iter_lines():
+                    size += len(line.encode()) + 1
+                    if line.startswith("event: "):
+                        event = line[7:]
+                        if event == "token" and first_token is None:
+                            first_token = time.perf_counter() - start
+                    elif line.startswith("data: ") and event in ("done", "error"):
+                        done = json.loads(line[6:])
+                        error = done.get("detail") if event == "error" else None
+            data = done or {}
+        else:
+            response = http.post(path, content=payload, headers={"Content-Type": "application/json"})
+            status, size = response.status_code, len(response.content)
+            data = response.json()
+            error = data.get("detail") if status != 200 else None
+        elapsed = time.perf_counter() - start
+        if entry is not None:
+            fake.discard(previous, message, entry)
+        if status != 200 or error or not data:
+            return {"records": records, "error": f"{message!r}: {status} {error}", "confirmed_order": False}
+        records.append({
+            "step": data["current_step"],
+            "model": bool(entry and entry["used"]),
+            "latency": elapsed,
+            "first_token": first_token if first_token is not None else elapsed,
+            "request_bytes": len(payload),
+            "response_bytes": size,
+        })
+        session_id, previous = data["session_id"], data["response"]
+    return {"records": records, "error": None, "confirmed_order": bool(data["extracted_data"].get("confirmed_order"))}
+
+
+def _replay_summary(results: list, elapsed: float, extraction: dict) -> dict:
+    records = [record for result in results for record in result["records"]]
+    steps = {}
+    for record in records:
+        steps.setdefault(record["step"], []).append(record)
+    latencies = [record["latency"] * 1000 for record in records]
+    return {
+        "conversations": len(results),
+        "failed": sum(1 for result in results if result["error"]),
+        "confirmed_order": sum(1 for result in results if result["confirmed_order"]),
+        "turns": len(records),
+        "model_turns": sum(record["model"] for record in records),
+        "turns_per_second": round(len(records) / elapsed, 1),
+        "conversations_per_second": round(len(results) / elapsed, 2),
+        "p50_ms": round(_percentile(latencies, 50), 3) if latencies else 0.0,
+        "p99_ms": round(_percentile(latencies, 99), 3) if latencies else 0.0,
+        "extraction": extraction,
+        "steps": {
+            str(step): {
+                "turns": len(group),
+                "model_turns": sum(record["model"] for record in group),
+                "p50_ms": round(_percentile([r["latency"] * 1000 for r in group], 50), 3),
+                "p99_ms": round(_percentile([r["latency"] * 1000 for r in group], 99), 3),
+                "first_token_p50_ms": round(_percentile([r["first_token"] * 1000 for r in group], 50), 3),
+                "request_bytes": round(statistics.mean(r["request_bytes"] for r in group)),
+                "response_bytes": round(statistics.mean(r["response_bytes"] for r in group)),
+            }
+            for step, group in sorted(steps.items())
+        },
+    }
+
+
+def _compare_replay(summary: dict, baseline: dict, tolerance: float) -> list:
+    """เทียบกับผลที่บันทึกไว้ คืนรายการ regression (เวลาเกิน tolerance, payload โต, แยกข้อมูลล้มเหลวมากขึ้น)"""
+    regressions = []
+    for key in ("p50_ms", "p99_ms"):
+        if baseline.get(key) and summary[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key} {baseline[key]:.2f} -> {summary[key]:.2f}")
+    if summary["turns_per_second"] < baseline.get("turns_per_second", 0) * (1 - tolerance):
+        regressions.append(f"turns_per_second {baseline['turns_per_second']} -> {summary['turns_per_second']}")
+    if summary["extraction"]["failure_ratio"] > baseline.get("extraction", {}).get("failure_ratio", 1.0):
+        regressions.append(f"extraction failure_ratio {baseline['extraction']['failure_ratio']} "
+                           f"-> {summary['extraction']['failure_ratio']}")
+    for step, stats in summary["steps"].items():
+        old = baseline.get("steps", {}).get(step)
+        if old and stats["request_bytes"] > old["request_bytes"] * (1 + tolerance):
+            regressions.append(f"step {step} request_bytes {old['request_bytes']} -> {stats['request_bytes']}")
+        if old and stats["response_bytes"] > old["response_bytes"] * (1 + tolerance):
+            regressions.append(f"step {step} response_bytes {old['response_bytes']} -> {stats['response_bytes']}")
+    return regressions
+
+
+def bench_replay(args):
+    from concurrent.futures import ThreadPoolExecutor
+
+    import httpx
+
+    transcripts = load_transcripts(args.transcripts)
+    if not transcripts:
+        raise SystemExit(f"no transcripts found in {args.transcripts}")
+    fake = FakeGenaiClient(models_class=ReplayModels, first_token_latency=args.latency, tokens_per_second=args.tps)
+    main.client = fake
+    if not args.response_cache:
+        main.chat_response_cache.max_size = 0
+    workload = [turns for _ in range(args.repeat) for _, turns in transcripts]
+    local = threading.local()
+
+    def replay(turns):
+        if not hasattr(local, "http"):
+            local.http = httpx.Client(base_url=url, timeout=120)
+        return _replay_conversation(local.http, fake.models, turns, args.stream)
+
+    with _serve(main.app) as url:
+        # รอบอุ่นเครื่อง (import, cache ของ pydantic/numpy) ไม่นับรวม
+        with httpx.Client(base_url=url, timeout=120) as http:
+            _replay_conversation(http, fake.models, transcripts[0][1], args.stream)
+        before = dict(main.extraction_stats)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            results = list(pool.map(replay, workload))
+        elapsed = time.perf_counter() - start
+
+    extraction = {key: main.extraction_stats[key] - before[key] for key in before}
+    failures = extraction["failed"] + extraction["missing"]
+    extraction["failure_ratio"] = round(failures / extraction["replies"], 4) if extraction["replies"] else 0.0
+    summary = _replay_summary(results, elapsed, extraction)
+    summary["settings"] = {key: getattr(args, key) for key in ("repeat", "concurrency", "latency", "tps", "stream")}
+
+    print(f"transcripts:    {len(transcripts)} ({', '.join(name for name, _ in transcripts)}) x {args.repeat}, "
+          f"concurrency {args.concurrency}, {'/api/chat/stream' if args.stream else '/api/chat'}")
+    print(f"fake model:     first token {args.latency * 1000:.0f} ms, {args.tps:g} tokens/s")
+    print(f"conversations:  {summary['conversations'] - summary['failed']} ok, {summary['failed']} failed, "
+          f"{summary['confirmed_order']} reached confirmed_order")
+    print(f"throughput:     {summary['turns_per_second']} turns/s, {summary['conversations_per_second']} conversations/s "
+          f"({summary['turns']} turns in {elapsed:.2f} s, {summary['model_turns']} answered by the model)")
+    print(f"latency:        p50 {summary['p50_ms']:.2f} ms, p99 {summary['p99_ms']:.2f} ms")
+    print(f"{'step':>5} {'turns':>6} {'model':>6} {'p50 ms':>8} {'p99 ms':>8} {'ttft p50':>9} {'req B':>7} {'resp B':>7}")
+    for step, stats in summary["steps"].items():
+        print(f"{step:>5} {stats['turns']:>6} {stats['model_turns']:>6} {stats['p50_ms']:>8.2f} {stats['p99_ms']:>8.2f} "
+              f"{stats['first_token_p50_ms']:>9.2f} {stats['request_bytes']:>7,} {stats['response_bytes']:>7,}")
+    print(f"extraction:     {extraction}")
+    for result in results:
+        if result["error"]:
+            print(f"failed turn:    {result['error']}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"saved:          {args.save}")
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != summary["settings"]:
+            print(f"warning:        baseline settings {baseline.get('settings')} differ from this run")
+        regressions = _compare_replay(summary, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"regression:     {regression}")
+        if not regressions:
+            print(f"baseline:       no regression against {args.baseline} (tolerance {args.tolerance:.0%})")
+    if summary["failed"] or fake.models.unexpected or regressions:
+        sys.exit(1)
+
+
+def _cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _coalesce_waves(waves: int, rng: random.Random) -> list:
+    """ทุกคลื่นเป็น payload ใหม่ที่ยิงซ้ำกันพร้อมกัน (เหมือนหน้าแคมเปญเปิดตัว) สลับราคา / ราคา+ตาราง / /analyze"""
+    payloads = []
+    for wave in range(waves):
+        requirements = _random_requirements(rng)
+        if wave % 3 == 0:
+            payloads.append(("/api/calculate-price", requirements))
+        elif wave % 3 == 1:
+            payloads.append(("/api/calculate-price", {**requirements, "quantities": [500, 1000, 2000, 5000, 10000]}))
+        else:
+            dims = requirements["dimensions"]
+            payloads.append(("/analyze", {"length": dims["length"], "width": dims["width"], "height": dims["height"],
+                                          "flute_type": rng.choice(list(main.FLUTE_SPECS)), "weight": rng.randint(1, 30)}))
+    return payloads
+
+
+def _coalesce_run(waves: list, concurrency: int, coalesce: bool) -> dict:
+    import asyncio
+    import httpx
+
+    port = _free_port()
+    env = {**os.environ, "GEMINI_API_KEY": "", "COALESCE_REQUESTS": "1" if coalesce else "0", "METRICS_ENABLED": "0"}
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning",
+               "--backlog", "4096", "--timeout-keep-alive", "60"]
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, env=env)
+    url = f"http://127.0.0.1:{port}"
+
+    async def run():
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as http:
+            # เปิด connection ให้ครบก่อนวัด ไม่ให้เวลา handshake ปนกับเวลาคำนวณ
+            await asyncio.gather(*(http.get("/") for _ in range(concurrency)))
+            latencies, bodies = [], []
+            cpu_before = _cpu_seconds(proc.pid)
+            start = time.perf_counter()
+            for path, payload in waves:
+                async def one():
+                    sent = time.perf_counter()
+                    response = await http.post(path, json=payload)
+                    latencies.append(time.perf_counter() - sent)
+                    assert response.status_code == 200, response.text
+                    return response.content
+                results = await asyncio.gather(*(one() for _ in range(concurrency)))
+                assert len(set(results)) == 1, "identical requests got different bodies"
+                bodies.append(json.loads(results[0]))
+            elapsed = time.perf_counter() - start
+            cpu = _cpu_seconds(proc.pid) - cpu_before
+            health = (await http.get("/health")).json()
+            return latencies, bodies, elapsed, cpu, health
+
+    try:
+        while True:
+            try:
+                urllib.request.urlopen(f"{url}/", timeout=1).read()
+                break
+            except OSError:
+                if proc.poll() is not None:
+                    raise RuntimeError("uvicorn exited before serving")
+                time.sleep(0.01)
+        latencies, bodies, elapsed, cpu, health = asyncio.run(run())
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=30)
+    requests = len(latencies)
+    return {
+        "bodies": bodies,
+        "requests": requests,
+        "cpu_us": cpu / requests * 1e6,
+        "throughput": requests / elapsed,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "server": health["coalesced_responses"],
+    }
+
+
+def bench_coalesce(args):
+    waves = _coalesce_waves(args.waves, random.Random(19))
+    runs = {}
+    for coalesce in (False, True):
+        runs[coalesce] = _coalesce_run(waves, args.concurrency, coalesce)
+    assert runs[False]["bodies"] == runs[True]["bodies"], "coalesced responses differ"
+
+    print(f"load:          {args.waves} bursts x {args.concurrency} identical concurrent requests "
+          f"(price, price + breaks, /analyze), one uvicorn worker")
+    print(f"{'':14} {'server CPU/req':>15} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for coalesce, label in ((False, "independent"), (True, "coalesced")):
+        run = runs[coalesce]
+        print(f"{label:14} {run['cpu_us']:>12.0f} us {run['throughput']:>8.0f} {run['p50_ms']:>8.1f} {run['p99_ms']:>8.1f}")
+    print(f"CPU saved:     {1 - runs[True]['cpu_us'] / runs[False]['cpu_us']:.0%} per request, identical bodies")
+    print(f"server:        {runs[True]['server']}")
+
+
+def _persist_records(count: int, rng: random.Random) -> list:
+    """ใบเสนอราคาพร้อมตารางราคา (ขนาดเท่าที่แชทส่งจริง) วนใช้ซ้ำจากชุดเล็ก ๆ"""
+    samples = []
+    for _ in range(min(count, 200)):
+        requirements = _random_requirements(rng)
+        quotation = main.generate_quotation(requirements)
+        quotation["price_breaks"] = main.generate_price_breaks(
+            requirements, [*main.PRICE_BREAK_QUANTITIES, quotation["quantity"]])
+        samples.append((quotation, {**requirements, "confirmed_design": True, "current_step": 11}))
+    return [(rng.choice(("quotation", "order")), f"session-{i % 5000}", *samples[i % len(samples)], 11)
+            for i in range(count)]
+
+
+def bench_persist(args):
+    import tempfile
+
+    from fastapi.testclient import TestClient
+
+    records = _persist_records(args.rows, random.Random(20))
+    folder = tempfile.mkdtemp(prefix="lumopack-persist-")
+    try:
+        # 1) เขียนต่อเนื่อง: เวลาที่ request เสียไปกับ record() และจำนวนแถวที่ writer commit ได้ต่อวินาที
+        print(f"{'batch':>6} {'record() p50':>13} {'p99':>8} {'rows/s written':>15} {'commits':>8}")
+        for batch in args.batches:
+            store = main.QuotationStore(os.path.join(folder, f"batch-{batch}.db"), batch, 1.0, len(records))
+            store._connect().close()
+            enqueue = []
+            start = time.perf_counter()
+            for record in records:
+                began = time.perf_counter()
+                store.record(*record)
+                enqueue.append(time.perf_counter() - began)
+            assert store.flush(600)
+            elapsed = time.perf_counter() - start
+            assert store.stats["written"] == len(records) and not store.stats["dropped"]
+            print(f"{batch:>6} {_percentile(enqueue, 50) * 1e6:>10.1f} us {_percentile(enqueue, 99) * 1e6:>5.1f} us "
+                  f"{len(records) / elapsed:>15,.0f} {store.stats['batches']:>8,}")
+
+        # 2) ดิสก์ช้า: ทุก batch ค้าง --slow-disk-ms แต่ turn ที่ออกใบเสนอราคาต้องไม่ช้าลง
+        main.client = FakeGenaiClient(models_class=ReplayModels, first_token_latency=0, tokens_per_second=1e9)
+        main.chat_response_cache.max_size = 0
+        http = TestClient(main.app)
+        transcripts = load_transcripts([TRANSCRIPT_DIR])
+        slow = main.QuotationStore(os.path.join(folder, "slow.db"), 1, 1.0, 10000)
+        write = slow._write
+        slow._write = lambda db, batch: time.sleep(args.slow_disk_ms / 1000) or write(db, batch)
+        quote_turns = {}
+        for label, store in (("no store", main.QuotationStore("", 1, 1.0, 1)), ("slow store", slow)):
+            main.quotation_store = store
+            latencies = []
+            for _ in range(args.conversations):
+                for _, turns in transcripts:
+                    result = _replay_conversation(http, main.client.models, turns, stream=False)
+                    assert not result["error"], result["error"]
+                    latencies += [r["latency"] for r in result["records"] if r["step"] >= 11]
+            quote_turns[label] = latencies
+        pending = slow.summary()["pending"]
+        assert slow.flush(600) and slow.stats["written"] == len(quote_turns["slow store"])
+        for label, latencies in quote_turns.items():
+            print(f"quotation turns, {label + ':':<12} p50 {_percentile(latencies, 50) * 1000:.2f} ms, "
+                  f"p99 {_percentile(latencies, 99) * 1000:.2f} ms ({len(latencies)} turns)")
+        print(f"slow store:     {args.slow_disk_ms} ms per commit, {pending} rows still queued when the chats finished")
+
+        # 3) ค้นรายการล่าสุดจากตารางใหญ่ผ่าน index
+        main.quotation_store = main.QuotationStore(os.path.join(folder, f"batch-{args.batches[-1]}.db"), 1, 1.0, 1)
+        main.QUOTATIONS_ADMIN_TOKEN = "bench-admin"
+        assert http.get("/api/quotations").status_code == 401
+        headers = {"Authorization": "Bearer bench-admin"}
+        for label, params in (("latest 50", {}), ("latest 50 orders", {"kind": "order"}),
+                              ("one session", {"session_hash": main.session_hash("session-42")}),
+                              ("next page", {"before_id": args.rows // 2})):
+            response = http.get("/api/quotations", params=params, headers=headers)
+            assert response.status_code == 200 and response.json()["count"]
+            assert "session_id" not in response.json()["items"][0]
+            elapsed = _timeit(lambda: http.get("/api/quotations", params=params, headers=headers), repeat=20)
+            print(f"GET /api/quotations {label + ':':<18} {elapsed * 1000:.2f} ms over {args.rows:,} rows")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+class FakeAPIError(Exception):
+    """error แบบ google.genai.errors.APIError (มี .code)"""
+
+    def __init__(self, code: int):
+        super().__init__(f"{code} fake model error")
+        self.code = code
+
+
+class RouterModels(ReplayModels):
+    """ReplayModels ที่แต่ละโมเดลมี latency (พร้อมหาง) และอัตรา error ของตัวเอง
+
+    profiles: model -> {"latency": s, "tail": ความน่าจะเป็น, "tail_latency": s, "error_rate": 0..1}
+    """
+
+    def __init__(self, profiles: dict, seed: int = 21, **kwargs):
+        super().__init__(**kwargs)
+        self.profiles = profiles
+        self.calls = {}
+        self.order = []
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    def reply_for(self, contents) -> str:
+        # ไม่ได้ expect คำตอบไว้ (ยิงตรงเข้า router) ตอบด้วย SAMPLE_REPLY
+        return super().reply_for(contents) if self._expected else SAMPLE_REPLY
+
+    def _call(self, model):
+        profile = self.profiles.get(model, {})
+        with self._rng_lock:
+            self.calls[model] = self.calls.get(model, 0) + 1
+            self.order.append(model)
+            slow = self._rng.random() < profile.get("tail", 0.0)
+            failed = self._rng.random() < profile.get("error_rate", 0.0)
+        time.sleep(profile.get("tail_latency", 0.0) if slow else profile.get("latency", 0.0))
+        if failed:
+            raise FakeAPIError(503)
+
+    def generate_content(self, model, contents, config=None):
+        self._call(model)
+        return SimpleNamespace(text=self.reply_for(contents))
+
+    def generate_content_stream(self, model, contents, config=None):
+        self._call(model)
+        for chunk in self._chunks(self.reply_for(contents)):
+            yield SimpleNamespace(text=chunk)
+
+
+def _router_run(fake: RouterModels, router, requests: int, concurrency: int) -> dict:
+    """ยิง generate ตรงเข้า router (ไม่ผ่าน HTTP) คืน latency และจำนวนที่ล้ม"""
+    import asyncio
+
+    latencies, errors = [], {}
+
+    async def one(semaphore):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await router.generate([{"role": "user", "parts": [{"text": "ping"}]}], "light", "bench")
+            except Exception as e:
+                key = getattr(e, "status_code", None) or type(e).__name__
+                errors[key] = errors.get(key, 0) + 1
+                return
+            latencies.append(time.perf_counter() - started)
+
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*(one(semaphore) for _ in range(requests)))
+
+    fake.calls.clear()
+    fake.order.clear()
+    start = time.perf_counter()
+    asyncio.run(run())
+    return {
+        "elapsed": time.perf_counter() - start,
+        "ok": len(latencies),
+        "errors": errors,
+        "p50_ms": _percentile(latencies, 50) * 1000 if latencies else float("nan"),
+        "p99_ms": _percentile(latencies, 99) * 1000 if latencies else float("nan"),
+        "calls": dict(fake.calls),
+    }
+
+
+def bench_router(args):
+    light, strong = "fake-light", "fake-strong"
+    routes = {"light": (light, strong), "strong": (strong, light)}
+    main.LLM_TIMEOUT_SECONDS = 30
+    # call ที่แพ้ hedge ยังถือ slot จนเสร็จ ให้ slot พอสำหรับ call ช้าที่ค้างอยู่ ไม่ให้ผลปนกับ 429
+    from concurrent.futures import ThreadPoolExecutor
+    main._llm_slots = threading.BoundedSemaphore(args.slots)
+    main._llm_executor = ThreadPoolExecutor(args.slots, thread_name_prefix="llm")
+    print(f"llm slots:      {args.slots}, concurrency {args.concurrency}, {args.requests} requests")
+
+    def router(**overrides):
+        settings = {"hedge_after": 0.0, "retries": 2, "backoff_seconds": 0.05,
+                    "failure_threshold": 5, "reset_seconds": 30.0, **overrides}
+        return main.ModelRouter(routes, **settings)
+
+    # 1) หาง latency: โมเดลเบาช้า tail_latency อยู่ราว --tail ของ call
+    profiles = {light: {"latency": args.latency, "tail": args.tail, "tail_latency": args.tail_latency},
+                strong: {"latency": args.latency * 2}}
+    fake = FakeGenaiClient(models_class=RouterModels, profiles=profiles)
+    main.client = fake
+    print(f"\ntail latency:   {light} {args.latency * 1000:.0f} ms, {args.tail:.0%} of calls {args.tail_latency * 1000:.0f} ms; "
+          f"{strong} {args.latency * 2000:.0f} ms")
+    for label, hedge_after in (("no hedging", 0.0), (f"hedge {args.hedge_after * 1000:.0f} ms", args.hedge_after)):
+        r = router(hedge_after=hedge_after)
+        result = _router_run(fake.models, r, args.requests, args.concurrency)
+        extra = sum(result["calls"].values()) / args.requests - 1
+        print(f"  {label:<14} p50 {result['p50_ms']:7.1f} ms  p99 {result['p99_ms']:7.1f} ms  "
+              f"extra calls {extra:.1%}  hedge wins {r.stats['hedge_wins']}  errors {result['errors'] or 0}")
+
+    # 2) โมเดลหลักล่ม: ไม่มี fallback/retry เทียบกับ router เต็มรูปแบบ
+    profiles = {light: {"latency": args.latency, "error_rate": 1.0}, strong: {"latency": args.latency * 2}}
+    fake = FakeGenaiClient(models_class=RouterModels, profiles=profiles)
+    main.client = fake
+    print(f"\nprimary outage: every {light} call fails with 503")
+    for label, r in (("single model", main.ModelRouter({"light": (light,)}, 0.0, 0, 0.0, 10 ** 9, 30.0)),
+                     ("router", router())):
+        result = _router_run(fake.models, r, args.requests, args.concurrency)
+        error_rate = 1 - result["ok"] / args.requests
+        print(f"  {label:<14} error rate {error_rate:6.1%}  p50 {result['p50_ms']:7.1f} ms  p99 {result['p99_ms']:7.1f} ms  "
+              f"calls {result['calls']}  breakers "
+              f"{ {model: b.state for model, b in r.breakers.items()} }")
+
+    # 3) สัดส่วน route ของบทสนทนาจริง (replay ผ่าน /api/chat)
+    import httpx
+
+    transcripts = load_transcripts([TRANSCRIPT_DIR])
+    fake = FakeGenaiClient(models_class=RouterModels, profiles={})
+    main.client = fake
+    main.chat_response_cache.max_size = 0
+    main.model_router = router()
+    main.model_router.routes = routes
+    with _serve(main.app) as url, httpx.Client(base_url=url, timeout=60) as http:
+        failed = [r["error"] for _, turns in transcripts for r in [_replay_conversation(http, fake.models, turns, False)]
+                  if r["error"]]
+    stats = main.model_router.summary()
+    print(f"\nrouting mix:    {len(transcripts)} transcripts, {stats['turns']} model turns, "
+          f"{len(failed)} failed conversations, unexpected calls {fake.models.unexpected}")
+    for key, count in sorted(stats["routes"].items()):
+        print(f"  {key:<26} {count:>4} ({count / stats['turns']:.0%})")
+    print(f"  calls per model: {fake.models.calls}")
+    for error in failed:
+        print(f"failed turn:    {error}")
+    if failed or fake.models.unexpected:
+        sys.exit(1)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("batch", help="batch quotation vs per-request loop")
+    p.add_argument("--rows", type=int, default=10000)
+    p.add_argument("--http", type=int, default=0, metavar="N", help="also time N rows through the HTTP endpoints")
+    p.set_defaults(func=bench_batch)
+
+    p = sub.add_parser("stream", help="time-to-first-token of /api/chat/stream vs /api/chat (fake model)")
+    p.add_argument("--latency", type=float, default=0.3, help="fake model first-token latency (s)")
+    p.add_argument("--tps", type=float, default=200.0, help="fake model tokens per second")
+    p.set_defaults(func=bench_stream)
+
+    p = sub.add_parser("load", help="concurrent /api/chat throughput and /health latency (fake model)")
+    p.add_argument("--requests", type=int, default=8)
+    p.add_argument("--latency", type=float, default=0.5, help="fake model latency (s)")
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("sessions", help="request bytes/latency with full history vs server-side sessions")
+    p.add_argument("--turns", type=int, nargs="+", default=[5, 30])
+    p.add_argument("--lock-seconds", type=float, default=1.0, help="how long another writer holds the sqlite lock")
+    p.set_defaults(func=bench_sessions)
+
+    p = sub.add_parser("context", help="prompt tokens per turn with history compaction / prompt cache (stub model)")
+    p.add_argument("--turns", type=int, default=30)
+    p.add_argument("--cache", action="store_true", help="enable the system-prompt context cache")
+    p.add_argument("--budget", type=int, default=main.CHAT_TOKEN_BUDGET, help="CHAT_TOKEN_BUDGET for the run")
+    p.set_defaults(func=bench_context)
+
+    p = sub.add_parser("fastpath", help="share and latency of quick-reply turns answered without the model")
+    p.add_argument("--conversations", type=int, default=20)
+    p.add_argument("--latency", type=float, default=0.3, help="fake model latency (s)")
+    p.set_defaults(func=bench_fastpath)
+
+    p = sub.add_parser("quote", help="cold vs warm generate_quotation with the quotation cache")
+    p.add_argument("--rows", type=int, default=2000)
+    p.set_defaults(func=bench_quote)
+
+    p = sub.add_parser("sweep", help="/analyze/sweep vs looping analyze_box over every flute and size")
+    p.add_argument("--steps", type=int, default=40, help="length and width steps")
+    p.add_argument("--weights", type=int, default=10, help="weight steps")
+    p.add_argument("--http", type=int, default=0, metavar="N", help="also time N single /analyze requests over HTTP")
+    p.set_defaults(func=bench_sweep)
+
+    p = sub.add_parser("optimize", help="/api/optimize vs trying every option through /analyze + box price")
+    p.add_argument("--spaces", type=lambda v: tuple(map(float, v.split(":"))), nargs="+",
+                   default=[(20, 0.5), (20, 0.1), (50, 0.1), (50, 0.02)], metavar="TOL:STEP")
+    p.set_defaults(func=bench_optimize)
+
+    p = sub.add_parser("extract", help="throughput of the <extracted_data> parser vs the old regex pair")
+    p.add_argument("--kb", type=int, default=256, help="size of the large replies")
+    p.set_defaults(func=bench_extract)
+
+    p = sub.add_parser("startup", help="cold start and per-worker memory of serve.py, with and without preload")
+    p.add_argument("--workers", type=int, default=4)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("respcache", help="model vs cached latency of repeated quick-reply turns (fake model)")
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--latency", type=float, default=0.3, help="fake model latency (s)")
+    p.set_defaults(func=bench_respcache)
+
+    p = sub.add_parser("metrics", help="/api/calculate-price latency with and without the metrics middleware + spans")
+    p.add_argument("--requests", type=int, default=2000, help="request pairs per round")
+    p.add_argument("--rounds", type=int, default=9)
+    p.add_argument("--distinct", type=int, default=500, help="distinct request bodies (quotation cache hits after the first pass)")
+    p.set_defaults(func=bench_metrics)
+
+    p = sub.add_parser("bulk", help="CSV quotation job: correctness, crash/resume, peak memory vs file size")
+    p.add_argument("--check", type=int, default=5000, help="rows compared one by one with generate_quotation")
+    p.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+    p.set_defaults(func=bench_bulk)
+
+    p = sub.add_parser("breaks", help="price-break table vs one generate_quotation per quantity")
+    p.add_argument("--designs", type=int, default=300)
+    p.add_argument("--tiers", type=int, default=8)
+    p.add_argument("--curve", type=int, default=24, help="amortization curve points")
+    p.set_defaults(func=bench_breaks)
+
+    p = sub.add_parser("kernel", help="requests per quoting session: calculate-price per click vs pricing kernel")
+    p.add_argument("--sessions", type=int, default=200)
+    p.add_argument("--toggles", type=int, default=12, help="average option changes per session")
+    p.set_defaults(func=bench_kernel)
+
+    p = sub.add_parser("replay", help="replay recorded /api/chat conversations against a local model stub")
+    p.add_argument("transcripts", nargs="*", default=[TRANSCRIPT_DIR],
+                   help=".jsonl transcripts or folders of them (default: backend/transcripts)")
+    p.add_argument("--repeat", type=int, default=20, help="replays of every transcript")
+    p.add_argument("--concurrency", type=int, default=1, help="conversations replayed at the same time")
+    p.add_argument("--latency", type=float, default=0.0, help="fake model first-token latency (s)")
+    p.add_argument("--tps", type=float, default=float("inf"), help="fake model tokens per second")
+    p.add_argument("--stream", action="store_true", help="replay through /api/chat/stream")
+    p.add_argument("--response-cache", action="store_true", help="keep the chat response cache on")
+    p.add_argument("--save", metavar="JSON", help="write the summary for use as a baseline")
+    p.add_argument("--baseline", metavar="JSON", help="exit 1 if slower/larger/less reliable than this summary")
+    p.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown/growth against --baseline")
+    p.set_defaults(func=bench_replay)
+
+    p = sub.add_parser("coalesce", help="server CPU per request for bursts of identical pricing/analyze calls")
+    p.add_argument("--waves", type=int, default=30, help="bursts, each with a new payload")
+    p.add_argument("--concurrency", type=int, default=200, help="identical requests per burst")
+    p.set_defaults(func=bench_coalesce)
+
+    p = sub.add_parser("persist", help="write-behind quotation store: write throughput, slow disk, indexed reads")
+    p.add_argument("--rows", type=int, default=50000)
+    p.add_argument("--batches", type=int, nargs="+", default=[1, 20, 200], help="QUOTATION_STORE_BATCH values")
+    p.add_argument("--slow-disk-ms", type=int, default=50, help="delay added to every commit of the slow store")
+    p.add_argument("--conversations", type=int, default=5, help="replays of every transcript per store")
+    p.set_defaults(func=bench_persist)
+
+    p = sub.add_parser("router", help="model routing: hedged tail latency, primary outage fallback, route mix")
+    p.add_argument("--requests", type=int, default=400)
+    p.add_argument("--concurrency", type=int, default=4, help="requests in flight at the same time")
+    p.add_argument("--slots", type=int, default=32, help="LLM_MAX_CONCURRENCY for the run")
+    p.add_argument("--latency", type=float, default=0.05, help="light model latency (s); strong is twice this")
+    p.add_argument("--tail", type=float, default=0.05, help="share of light model calls that are slow")
+    p.add_argument("--tail-latency", type=float, default=1.0, help="latency of the slow calls (s)")
+    p.add_argument("--hedge-after", type=float, default=0.2, help="LLM_HEDGE_AFTER_SECONDS for the hedged run")
+    p.set_defaults(func=bench_router)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main_cli()
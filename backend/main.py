@@ -1,12 +1,49 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse, Response, FileResponse
+from pydantic import BaseModel, BeforeValidator, ConfigDict, Field, TypeAdapter, ValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple, Union, Annotated, Callable
 import os
 import json
 import re
+import time
+import logging
+import asyncio
+import threading
+import weakref
+import sqlite3
+import queue
+import uuid
+import copy
+import random
+import hashlib
+import hmac
+import bisect
+import itertools
+import sys
+import csv
+import math
+import shutil
+from types import MappingProxyType
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import numpy as np
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # เฝ้าไฟล์ราคาแล้วสลับเวอร์ชันใหม่ระหว่างรัน (ดู PRICING DATA)
+    stop_watcher = start_pricing_watcher()
+    if GEMINI_PREWARM:
+        _llm_executor.submit(warm_model_client)
+    yield
+    stop_watcher.set()
+    quotation_store.close()
+
+app = FastAPI(lifespan=lifespan)
+logger = logging.getLogger("lumopack")
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,11 +55,329 @@ app.add_middleware(
 # ==================== CONFIG GEMINI ====================
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 
-from google import genai
-
+# import google.genai ใช้เวลาราว 0.5 วินาที จึงสร้าง client ตอนเรียกโมเดลครั้งแรก (ดู get_client)
 client = None
-if GEMINI_API_KEY:
-    client = genai.Client(api_key=GEMINI_API_KEY)
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+
+# connection ไป Gemini ที่เปิดค้างไว้ใช้ซ้ำได้นานกี่วินาที (httpx ปิดหลัง 5 วินาทีถ้าไม่ตั้ง)
+GEMINI_KEEPALIVE_SECONDS = float(os.getenv("GEMINI_KEEPALIVE_SECONDS", "120"))
+# GEMINI_PREWARM=1 สร้าง client และเปิด connection แรกตั้งแต่ worker เริ่ม (ทำเบื้องหลัง ไม่หน่วง startup)
+GEMINI_PREWARM = os.getenv("GEMINI_PREWARM", "") == "1"
+
+# การเรียก Gemini เป็น sync จึงรันใน thread pool แยก จำกัดจำนวนพร้อมกัน
+# ถ้าเต็มให้ตอบ 429 ทันที (ไม่ต่อคิวจน event loop/threadpool ของ uvicorn ตัน)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+
+# เลือกโมเดลตาม turn (ดู MODEL ROUTER): LLM_ROUTING=0 ใช้ GEMINI_MODEL ทุก turn (ยังมี fallback)
+LLM_ROUTING = os.getenv("LLM_ROUTING", "1") == "1"
+GEMINI_LIGHT_MODEL = os.getenv("GEMINI_LIGHT_MODEL", "gemini-1.5-flash-8b")
+GEMINI_STRONG_MODEL = os.getenv("GEMINI_STRONG_MODEL", GEMINI_MODEL)
+# รอโมเดลแรกกี่วินาทีก่อนส่ง request เดียวกันไปโมเดลที่สองคู่ขนาน (0 = ไม่ hedge)
+LLM_HEDGE_AFTER_SECONDS = float(os.getenv("LLM_HEDGE_AFTER_SECONDS", "4"))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_RETRY_BACKOFF_SECONDS = float(os.getenv("LLM_RETRY_BACKOFF_SECONDS", "0.5"))
+# ล้มติดกันกี่ครั้งถึงหยุดส่งไปโมเดลนั้น และหยุดนานกี่วินาทีก่อนลองใหม่
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+
+# เก็บประวัติแชทไว้ฝั่ง server: "memory" (ค่าเริ่มต้น) หรือ "sqlite"
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "3600"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+# SQLite: ลบ session ที่หมดอายุ/เกิน SESSION_MAX ทุกกี่วินาที
+SESSION_SWEEP_SECONDS = float(os.getenv("SESSION_SWEEP_SECONDS", "60"))
+
+# จำนวนใบเสนอราคาที่ cache ไว้ (0 = ปิด cache)
+QUOTATION_CACHE_SIZE = int(os.getenv("QUOTATION_CACHE_SIZE", "4096"))
+
+# cache คำตอบของโมเดลสำหรับ turn ที่เหมือนกัน (0 = ปิด) ปกติ cache เฉพาะข้อความจากปุ่ม quick reply
+# CHAT_CACHE_FREE_TEXT=1 ให้ cache ข้อความที่พิมพ์เองด้วย
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "2048"))
+CHAT_CACHE_TTL_SECONDS = float(os.getenv("CHAT_CACHE_TTL_SECONDS", "600"))
+CHAT_CACHE_FREE_TEXT = os.getenv("CHAT_CACHE_FREE_TEXT", "") == "1"
+
+# CHAT_TRANSCRIPT_DIR=<โฟลเดอร์> บันทึกทุกรอบสนทนาเป็น <session_id>.jsonl ไว้ replay ด้วย bench.py replay
+CHAT_TRANSCRIPT_DIR = os.getenv("CHAT_TRANSCRIPT_DIR", "")
+
+# ขนาด prompt ต่อรอบ: เก็บประวัติล่าสุดกี่ข้อความ (เมื่อ requirements สรุปข้อมูลไว้แล้ว) และงบ token สูงสุด
+CHAT_KEEP_MESSAGES = int(os.getenv("CHAT_KEEP_MESSAGES", "8"))
+CHAT_TOKEN_BUDGET = int(os.getenv("CHAT_TOKEN_BUDGET", "8000"))
+# GEMINI_PROMPT_CACHE=1 เก็บ SYSTEM_PROMPT ไว้ใน context cache ของ Gemini (ใช้ร่วมทุก session)
+GEMINI_PROMPT_CACHE = os.getenv("GEMINI_PROMPT_CACHE", "") == "1"
+GEMINI_PROMPT_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_PROMPT_CACHE_TTL_SECONDS", "3600"))
+# สร้าง cache ไม่สำเร็จ รอกี่วินาทีก่อนลองใหม่ (เพิ่มเท่าตัวทุกครั้งที่ล้มติดกัน)
+GEMINI_PROMPT_CACHE_RETRY_SECONDS = float(os.getenv("GEMINI_PROMPT_CACHE_RETRY_SECONDS", "30"))
+
+# งานคิดราคาจากไฟล์ (ดู BULK QUOTATION JOBS): ที่เก็บไฟล์, จำนวนแถวต่อ chunk, จำนวน job ที่รันพร้อมกัน
+BULK_JOB_DIR = os.getenv("BULK_JOB_DIR", "bulk_jobs")
+BULK_CHUNK_ROWS = int(os.getenv("BULK_CHUNK_ROWS", "5000"))
+BULK_MAX_JOBS = int(os.getenv("BULK_MAX_JOBS", "2"))
+BULK_MAX_UPLOAD_MB = int(os.getenv("BULK_MAX_UPLOAD_MB", "512"))
+# job ที่จบแล้วเก็บไว้กี่ชั่วโมงนับจากไฟล์ที่แก้ล่าสุด, พื้นที่ดิสก์รวมของทุก job,
+# และจำนวน job ที่กำลังอัปโหลด/รอคิว/รันพร้อมกันต่อ process (เกินตอบ 429)
+BULK_JOB_RETENTION_HOURS = float(os.getenv("BULK_JOB_RETENTION_HOURS", "24"))
+BULK_MAX_DISK_MB = int(os.getenv("BULK_MAX_DISK_MB", "4096"))
+BULK_MAX_ACTIVE_JOBS = int(os.getenv("BULK_MAX_ACTIVE_JOBS", "8"))
+
+# ใบเสนอราคา/คำสั่งซื้อจากแชทบันทึกลง SQLite แบบ write-behind ("" = ไม่บันทึก)
+# commit ทุก QUOTATION_STORE_BATCH รายการหรือทุก QUOTATION_STORE_FLUSH_SECONDS คิวเต็มแล้วทิ้ง (ไม่ให้ request รอ)
+QUOTATION_DB_PATH = os.getenv("QUOTATION_DB_PATH", "quotations.db")
+QUOTATION_STORE_BATCH = int(os.getenv("QUOTATION_STORE_BATCH", "200"))
+QUOTATION_STORE_FLUSH_SECONDS = float(os.getenv("QUOTATION_STORE_FLUSH_SECONDS", "1"))
+QUOTATION_STORE_QUEUE_MAX = int(os.getenv("QUOTATION_STORE_QUEUE_MAX", "10000"))
+# /api/quotations เปิดเฉพาะเมื่อตั้ง token (ส่งเป็น Authorization: Bearer <token>) ค่าว่าง = ปิด endpoint
+QUOTATIONS_ADMIN_TOKEN = os.getenv("QUOTATIONS_ADMIN_TOKEN", "")
+
+# /api/calculate-price และ /analyze: request ที่ body ตรงกันและมาพร้อมกันใช้ผลคำนวณร่วมกัน
+# แล้วเก็บ body ของคำตอบที่ encode แล้วไว้กี่รายการ (0 = ไม่เก็บ) COALESCE_REQUESTS=0 ปิดทั้งหมด
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "1") == "1"
+RESPONSE_BODY_CACHE_SIZE = int(os.getenv("RESPONSE_BODY_CACHE_SIZE", "4096"))
+# body ที่ใหญ่กว่านี้คำนวณตรง ๆ ไม่ coalesce/cache (request ปกติไม่ถึง 2 KB)
+COALESCE_MAX_BODY_BYTES = int(os.getenv("COALESCE_MAX_BODY_BYTES", "16384"))
+
+# METRICS_ENABLED=0 ปิดการจับเวลาทั้งหมด (/metrics จะว่าง)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# sampling profiler ผ่าน /metrics/profiler ปิดไว้ ต้องตั้ง PROFILER_ALLOWED=1 เอง (ใครก็เรียก endpoint ได้)
+# interval ต่ำสุด PROFILER_MIN_INTERVAL_MS: sample ถี่กว่านี้กิน CPU ของ process ที่รับ request
+PROFILER_ALLOWED = os.getenv("PROFILER_ALLOWED", "") == "1"
+PROFILER_MIN_INTERVAL_MS = float(os.getenv("PROFILER_MIN_INTERVAL_MS", "5"))
+PROFILER_MAX_STACKS = int(os.getenv("PROFILER_MAX_STACKS", "5000"))
+
+# ==================== METRICS ====================
+# histogram/counter แบบ Prometheus เก็บในหน่วยความจำของแต่ละ process
+# (serve.py หลาย worker: แต่ละ worker มีค่าของตัวเอง ใช้ label instance ของ Prometheus แยก)
+# Histogram.observe เก็บค่าดิบค้างไว้ได้กี่ค่าก่อนรวมเข้า bucket
+HISTOGRAM_FLUSH_EVERY = 1024
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+def _label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _label_text(labelnames: Tuple[str, ...], labels: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_label_value(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: Any, amount: float = 1) -> None:
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_label_text(self.labelnames, labels)} {value:g}")
+        return lines
+
+class Histogram:
+    """นับแยก bucket (ไม่สะสม) แล้วค่อยรวมเป็น cumulative ตอน render
+
+    observe แค่ต่อค่าท้าย deque (append ปลอดภัยข้าม thread ไม่ต้องล็อก) ซึ่งอยู่บนทางของทุก request
+    การหา bucket/series ทำทีละชุดตอนค้างครบ HISTOGRAM_FLUSH_EVERY ค่า หรือตอน render
+    """
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [count ต่อ bucket (+Inf ท้ายสุด)..., sum]
+        self._series: Dict[tuple, list] = {}
+        self._pending: deque = deque()
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: Any) -> None:
+        if not METRICS_ENABLED:
+            return
+        pending = self._pending
+        pending.append((value, labels))
+        if len(pending) >= HISTOGRAM_FLUSH_EVERY:
+            self._flush()
+
+    def _flush(self) -> None:
+        pending = self._pending
+        with self._lock:
+            for _ in range(len(pending)):
+                value, labels = pending.popleft()
+                series = self._series.get(labels)
+                if series is None:
+                    series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+                series[bisect.bisect_left(self.buckets, value)] += 1
+                series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        self._flush()
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), values):
+                cumulative += count
+                le = f'le="{bound:g}"' if bound != "+Inf" else 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, labels, le)} {cumulative}")
+            label_text = _label_text(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {values[-1]:.6g}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+REQUEST_LATENCY = Histogram("lumopack_http_request_duration_seconds", "HTTP request latency by route",
+                            ("method", "route", "status"))
+MODEL_LATENCY = Histogram("lumopack_model_request_duration_seconds",
+                          "Gemini call latency (stream: until the last chunk)", ("mode", "outcome"))
+MODEL_FIRST_TOKEN = Histogram("lumopack_model_first_token_seconds", "Gemini streaming time to first chunk")
+PROMPT_TOKENS = Histogram("lumopack_prompt_tokens", "Estimated prompt tokens sent per model call", buckets=TOKEN_BUCKETS)
+RESPONSE_TOKENS = Histogram("lumopack_response_tokens", "Estimated tokens in each model reply", buckets=TOKEN_BUCKETS)
+EXTRACTION_RESULTS = Counter("lumopack_extraction_total", "Parsed <extracted_data> blocks by status", ("status",))
+QUOTATION_LATENCY = Histogram("lumopack_quotation_compute_seconds", "generate_quotation time on quotation cache misses",
+                              ("cache",))
+MODEL_CALLS = Histogram("lumopack_model_call_duration_seconds", "Single Gemini call latency by model (retries, hedges)",
+                        ("model", "outcome"))
+MODEL_ROUTES = Counter("lumopack_model_routes_total", "Chat turns sent to the model by route and reason",
+                       ("route", "reason"))
+MODEL_HEDGES = Counter("lumopack_model_hedges_total", "Hedged model requests (sent, won, skipped)", ("outcome",))
+MODEL_RETRIES = Counter("lumopack_model_retries_total", "Model retries by the model retried on", ("model",))
+METRICS = [REQUEST_LATENCY, MODEL_LATENCY, MODEL_FIRST_TOKEN, PROMPT_TOKENS, RESPONSE_TOKENS,
+           EXTRACTION_RESULTS, QUOTATION_LATENCY, MODEL_CALLS, MODEL_ROUTES, MODEL_HEDGES, MODEL_RETRIES]
+
+class MetricsMiddleware:
+    """ASGI middleware (ไม่ใช้ BaseHTTPMiddleware ที่เพิ่ม task ต่อ request) จับเวลาทุก request ตาม route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+
+        # ฟังก์ชันธรรมดาที่คืน awaitable ของ send เลย ไม่สร้าง coroutine เพิ่มทุก message
+        def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            return send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # ใช้ path ของ route (/api/chat) ไม่ใช้ URL จริง ไม่ให้จำนวน series โตตาม URL ที่ถูกยิงเข้ามา
+            route = scope.get("route")
+            REQUEST_LATENCY.observe(time.perf_counter() - started, scope["method"],
+                                    getattr(route, "path", "unmatched"), status)
+
+app.add_middleware(MetricsMiddleware)
+
+class SamplingProfiler:
+    """เก็บ stack ของทุก thread ทุก interval แบบ collapsed ("a;b;c count") ใช้ทำ flamegraph ได้
+
+    ทำงานใน thread ของตัวเอง เปิด/ปิดได้ระหว่างรันผ่าน /metrics/profiler (มีผลเฉพาะ process ที่รับ request)
+    """
+
+    def __init__(self, max_stacks: int):
+        self.max_stacks = max_stacks
+        self.interval = 0.01
+        self.samples = 0
+        self.dropped = 0
+        self.started_at: Optional[float] = None
+        self._stacks: Dict[str, int] = {}
+        self._stop: Optional[threading.Event] = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._stop is not None
+
+    def start(self, interval: float, duration: Optional[float] = None) -> None:
+        with self._lock:
+            if self._stop is not None:
+                self._stop.set()
+            self._stacks, self.samples, self.dropped = {}, 0, 0
+            self.interval, self.started_at = interval, time.time()
+            self._stop = stop = threading.Event()
+        threading.Thread(target=self._run, args=(stop, duration), name="sampling-profiler", daemon=True).start()
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._stop is not None:
+                self._stop.set()
+                self._stop = None
+
+    def _run(self, stop: threading.Event, duration: Optional[float]) -> None:
+        me = threading.get_ident()
+        deadline = time.monotonic() + duration if duration else None
+        while not stop.wait(self.interval):
+            if deadline is not None and time.monotonic() >= deadline:
+                with self._lock:
+                    if self._stop is stop:
+                        self._stop = None
+                return
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack = ";".join(reversed(names))
+                with self._lock:
+                    self.samples += 1
+                    if stack in self._stacks or len(self._stacks) < self.max_stacks:
+                        self._stacks[stack] = self._stacks.get(stack, 0) + 1
+                    else:
+                        self.dropped += 1
+
+    def collapsed(self) -> str:
+        with self._lock:
+            stacks = sorted(self._stacks.items(), key=lambda item: -item[1])
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "interval_ms": round(self.interval * 1000, 3),
+            "started_at": self.started_at,
+            "samples": self.samples,
+            "stacks": len(self._stacks),
+            "dropped": self.dropped,
+        }
+
+profiler = SamplingProfiler(PROFILER_MAX_STACKS)
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    # cache ที่มีตัวนับอยู่แล้ว ส่งออกเป็น counter ตอน scrape ไม่ต้องนับซ้ำใน hot path
+    caches = {"quotation": quotation_cache.stats(), "chat_response": chat_response_cache.summary(),
+              "response_body": coalesced_responses.summary()}
+    for name, field in (("lumopack_cache_hits_total", "hits"), ("lumopack_cache_misses_total", "misses")):
+        lines += [f"# HELP {name} Cache {field}", f"# TYPE {name} counter"]
+        lines += [f'{name}{{cache="{cache}"}} {stats[field]}' for cache, stats in caches.items()]
+    name = "lumopack_model_circuit_open"
+    lines += [f"# HELP {name} 1 while requests to the model are short-circuited", f"# TYPE {name} gauge"]
+    lines += [f'{name}{{model="{_label_value(model)}"}} {int(breaker.state == "open")}'
+              for model, breaker in sorted(model_router.breakers.items())]
+    return "\n".join(lines) + "\n"
 
 # ==================== MODELS ====================
 class BoxDesign(BaseModel):
@@ -38,9 +393,130 @@ class ChatMessage(BaseModel):
 
 class ChatRequest(BaseModel):
     message: str
+    session_id: Optional[str] = None
     conversation_history: List[ChatMessage] = []
     current_requirements: Dict[str, Any] = {}
 
+class ProfilerRequest(BaseModel):
+    enabled: bool
+    interval_ms: float = 10
+    # หยุดเองหลังกี่วินาที (None = จนกว่าจะสั่งปิด)
+    duration_seconds: Optional[float] = None
+
+class BatchPriceRequest(BaseModel):
+    items: List[Dict[str, Any]]
+
+class KernelVerifyRequest(BaseModel):
+    requirements: Dict[str, Any]
+    checksum: str
+    # ยอดที่ client คิดเองจาก kernel (ไม่ส่งก็ได้ จะตรวจแค่ว่า kernel ยังเป็นปัจจุบัน)
+    grand_total: Optional[float] = None
+    price_per_unit: Optional[float] = None
+
+class SweepRange(BaseModel):
+    start: float
+    stop: float
+    # แกนเดียวเกิน 10000 ช่องเกิน SWEEP_MAX_CELLS อยู่แล้ว ตัดตั้งแต่ validate
+    steps: int = Field(10, ge=1, le=10_000)
+
+class SweepDesign(BaseModel):
+    length: float
+    width: float
+    weight: float
+    height: float = 0
+
+class OptimizeRequest(BaseModel):
+    product_weight: float
+    length: float
+    width: float
+    height: float
+    stack_height: int = 4
+    quantity: int = 500
+    tolerance: float = 0
+    tolerance_step: float = 0.5
+    min_safety: Optional[float] = None
+    box_types: Optional[List[str]] = None
+    materials: Optional[List[str]] = None
+    flutes: Optional[List[str]] = None
+
+class SweepRequest(BaseModel):
+    length: Optional[SweepRange] = None
+    width: Optional[SweepRange] = None
+    weight: Optional[SweepRange] = None
+    designs: List[SweepDesign] = []
+
+# ---------- schema ของ <extracted_data> (ดู SYSTEM_PROMPT) ----------
+# ทุก field ไม่บังคับ ค่าที่ผิดชนิดจะถูกตัดทิ้งทีละ field (validate_extracted_data) ไม่ทิ้งทั้ง block
+def _loose_number(value: Any) -> Any:
+    """ตัวเลขที่โมเดลส่งมาเป็นข้อความ เช่น "1,000 ชิ้น" -> 1000, "20.5 cm" -> 20.5"""
+    if isinstance(value, str):
+        match = re.match(r"\s*(-?\d[\d,]*(?:\.\d+)?)", value)
+        if match:
+            number = match.group(1).replace(",", "")
+            return float(number) if "." in number else int(number)
+        if value.strip().lower() in ("", "null", "none"):
+            return None
+    return value
+
+def _string_list(value: Any) -> Any:
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(item) for item in value if item is not None]
+    return value
+
+LooseNumber = Annotated[Optional[Union[int, float]], BeforeValidator(_loose_number)]
+LooseInt = Annotated[Optional[int], BeforeValidator(_loose_number)]
+StringList = Annotated[List[str], BeforeValidator(_string_list)]
+
+class ExtractedModel(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+class ExtractedDimensions(ExtractedModel):
+    width: LooseNumber = None
+    length: LooseNumber = None
+    height: LooseNumber = None
+
+class ExtractedInner(ExtractedModel):
+    cushioning: Optional[str] = None
+    moisture_coating: Optional[str] = None
+    food_coating: Optional[str] = None
+
+class ExtractedLogo(ExtractedModel):
+    has_logo: Optional[bool] = None
+    position: Optional[str] = None
+
+class ExtractedEmboss(ExtractedModel):
+    type: Optional[str] = None
+    has_block: Optional[bool] = None
+
+class ExtractedFoil(ExtractedModel):
+    type: Optional[str] = None
+    color: Optional[str] = None
+    has_block: Optional[bool] = None
+
+class ExtractedFeatures(ExtractedModel):
+    gloss_coating: Optional[str] = None
+    matte_coating: Optional[str] = None
+    emboss: Optional[ExtractedEmboss] = None
+    foil: Optional[ExtractedFoil] = None
+
+class ExtractedData(ExtractedModel):
+    product_type: Optional[str] = None
+    box_type: Optional[str] = None
+    inner: Optional[ExtractedInner] = None
+    dimensions: Optional[ExtractedDimensions] = None
+    quantity: LooseNumber = None
+    mood_tone: Optional[str] = None
+    logo: Optional[ExtractedLogo] = None
+    special_features: Optional[ExtractedFeatures] = None
+    current_step: LooseInt = None
+    is_checkpoint: Optional[bool] = None
+    confirmed_structure: Optional[bool] = None
+    confirmed_design: Optional[bool] = None
+    confirmed_order: Optional[bool] = None
+    quick_replies: StringList = []
+
 class ChatResponse(BaseModel):
     response: str
     extracted_data: Dict[str, Any] = {}
@@ -49,6 +525,7 @@ class ChatResponse(BaseModel):
     is_checkpoint: bool = False
     show_quotation: bool = False
     quotation_data: Dict[str, Any] = {}
+    session_id: Optional[str] = None
 
 # ==================== FLUTE SPECS ====================
 FLUTE_SPECS = {
@@ -59,84 +536,119 @@ FLUTE_SPECS = {
     "BC": {"ect": 6.5, "thickness": 6.0},
 }
 
+# เกณฑ์ safety_score: ต่ำกว่า WARNING = DANGER, ตั้งแต่ SAFE ขึ้นไป = SAFE
+SAFETY_WARNING = 1.5
+SAFETY_SAFE = 3.0
+
+# จำนวนช่องสูงสุดของ /analyze/sweep (flute x weight x length x width)
+SWEEP_MAX_CELLS = int(os.getenv("SWEEP_MAX_CELLS", "500000"))
+
+# วัสดุที่ประเมินความแข็งแรงด้วย FLUTE_SPECS ได้ และจำนวนแบบสูงสุดที่ /api/optimize คำนวณจริงต่อ request (หลังตัดแบบที่แพ้แน่)
+FLUTED_MATERIALS = ("ลูกฟูก",)
+OPTIMIZE_MAX_CANDIDATES = int(os.getenv("OPTIMIZE_MAX_CANDIDATES", "200000"))
+
 # ==================== PRICING DATA (ตาม Requirement) ====================
-BASE_BOX_PRICES = {
-    "RSC": {
-        "ลูกฟูก": {"cost": 3.378, "paper_cost": 22, "thickness": 0.25, "density": 0.6, "labor": 1.2, "factor": 1.1},
-        "คราฟท์": {"cost": 1.596, "paper_cost": 30, "thickness": 0.025, "density": 0.8, "labor": 1.2, "factor": 1.1},
-    },
-    "Die-cut": {
-        "ลูกฟูก": {"cost": 3.57, "paper_cost": 22, "thickness": 0.25, "density": 0.6, "labor": 0.6, "factor": 1.5},
-        "จั่วปัง": {"cost": 8.6, "paper_cost": 40, "thickness": 0.25, "density": 0.9, "labor": 0.6, "factor": 1.5},
-        "อาร์ต": {"cost": 6.67, "paper_cost": 200, "thickness": 0.0375, "density": 0.9, "labor": 0.6, "factor": 1.5},
-        "กล่องแป้ง": {"cost": 1.93, "paper_cost": 40, "thickness": 0.04375, "density": 0.85, "labor": 0.6, "factor": 1.5},
-    }
-}
+# ราคาทั้งหมดอยู่ในไฟล์ catalog (JSON หรือ TOML) แก้ไฟล์แล้วทุก worker โหลดเวอร์ชันใหม่เองโดยไม่ต้อง deploy
+# main.BASE_BOX_PRICES, main.INNER_PRICES ฯลฯ อ่านข้อมูลของเวอร์ชันปัจจุบัน (อ่านอย่างเดียว ดู __getattr__)
+PRICING_CATALOG_PATH = os.getenv(
+    "PRICING_CATALOG_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "pricing_catalog.json"),
+)
+PRICING_CATALOG_POLL_SECONDS = float(os.getenv("PRICING_CATALOG_POLL_SECONDS", "2"))
 
-# Inner - แผ่นกันกระแทก (ราคาต่อ kg)
-INNER_PRICES = {
-    "กระดาษฝอย": {"min": 120, "max": 170, "unit": "บาท/kg", "weight_per_box": 0.02},
-    "บับเบิ้ล": {"min": 60, "max": 90, "unit": "บาท/kg", "weight_per_box": 0.015},
-    "ถุงลม": {"min": 120, "max": 200, "unit": "บาท/kg", "weight_per_box": 0.01},
+# section ในไฟล์ -> ชื่อตัวแปรใน module
+CATALOG_SECTIONS = {
+    "base_box_prices": "BASE_BOX_PRICES",                  # ราคากล่องตามประเภทกล่องและวัสดุ
+    "inner_prices": "INNER_PRICES",                        # แผ่นกันกระแทก (ราคาต่อ kg)
+    "moisture_coating_prices": "MOISTURE_COATING_PRICES",  # เคลือบกันชื้น (กล่อง 10x10x10)
+    "food_coating_prices": "FOOD_COATING_PRICES",          # Food-grade coating (กล่อง 10x10x10)
+    "gloss_coating_prices": "GLOSS_COATING_PRICES",        # เคลือบเงา (กล่อง 10x10x10)
+    "matte_coating_prices": "MATTE_COATING_PRICES",        # เคลือบด้าน (กล่อง 10x10x10)
+    "emboss_prices": "EMBOSS_PRICES",                      # ปั๊มนูน/ปั๊มจม
+    "foil_block_prices": "FOIL_BLOCK_PRICES",              # ปั๊มฟอยล์ - ค่าบล็อก
+    "foil_per_box_prices": "FOIL_PER_BOX_PRICES",          # ปั๊มฟอยล์ - ราคาต่อกล่อง
+    "product_type_materials": "PRODUCT_TYPE_MATERIALS",    # เลือกวัสดุตามประเภทสินค้า
 }
 
-# เคลือบกันชื้น (ราคาสำหรับกล่อง 10x10x10)
-MOISTURE_COATING_PRICES = {
-    "AQ Coating": {"min": 0.48, "max": 1.2, "description": "Acrylic polymer"},
-    "PE Coating": {"min": 1.2, "max": 3.6, "description": "Polyethylene"},
-    "Wax Coating": {"min": 1.2, "max": 3.0, "description": "Paraffin wax"},
-    "Bio Coating": {"min": 2.0, "max": 5.0, "description": "Bio/Water-based Barrier"},
-}
+def _freeze(value: Any) -> Any:
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
 
-# Food-grade coating (ราคาสำหรับกล่อง 10x10x10)
-FOOD_COATING_PRICES = {
-    "Water-based Food Coating": {"min": 0.8, "max": 1.5, "description": "Acrylic/PVOH food safe"},
-    "PE Food-grade Coating": {"min": 1.2, "max": 2.0, "description": "LDPE food-grade resin"},
-    "PLA/Bio Coating": {"min": 2.0, "max": 3.5, "description": "PLA/Bio-resin"},
-    "Grease-resistant Coating": {"min": 1.5, "max": 3.0, "description": "Fluorine-free grease barrier"},
-}
+def _check_range(section: str, name: str, price_data: Any, *extra: str) -> None:
+    for field in ("min", "max", *extra):
+        value = price_data.get(field) if isinstance(price_data, dict) else None
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError(f"{section}.{name}.{field} must be a non-negative number")
+    if price_data["min"] > price_data["max"]:
+        raise ValueError(f"{section}.{name}: min is greater than max")
 
-# เคลือบเงา (ราคาสำหรับกล่อง 10x10x10)
-GLOSS_COATING_PRICES = {
-    "Gloss AQ Coating": {"min": 0.6, "max": 1.2, "description": "ต้นทุนต่ำ กลิ่นน้อย"},
-    "UV Gloss Coating": {"min": 1.2, "max": 2.4, "description": "เงามาก ทนรอยขีดข่วน"},
-    "OPP Gloss Film": {"min": 1.8, "max": 3.6, "description": "ทนสูง กันน้ำ งาน premium"},
-}
+def validate_catalog(data: Any) -> Dict[str, Any]:
+    """ตรวจ catalog ที่อ่านจากไฟล์ ผิดรูปแบบจะ raise ValueError (ไม่สลับเวอร์ชัน)"""
+    if not isinstance(data, dict):
+        raise ValueError("catalog must be an object")
+    missing = [section for section in CATALOG_SECTIONS if not isinstance(data.get(section), dict)]
+    if missing:
+        raise ValueError(f"catalog is missing sections: {', '.join(missing)}")
 
-# เคลือบด้าน (ราคาสำหรับกล่อง 10x10x10)
-MATTE_COATING_PRICES = {
-    "UV ด้าน": {"min": 4.0, "max": 8.0, "description": "ราคาประหยัด ผิวเรียบด้าน"},
-    "ลามิเนตด้าน (PVC Matte)": {"min": 6.0, "max": 12.0, "description": "นิยมสูงสุด ให้ความรู้สึกพรีเมียม"},
-    "วานิชด้าน (Varnish)": {"min": 8.0, "max": 15.0, "description": "เรียบเนียนพิเศษ"},
-}
+    for box_type in ("RSC", "Die-cut"):
+        materials = data["base_box_prices"].get(box_type)
+        if not isinstance(materials, dict) or "ลูกฟูก" not in materials:
+            raise ValueError(f"base_box_prices.{box_type} must include ลูกฟูก (the fallback material)")
+        for material, spec in materials.items():
+            cost = spec.get("cost") if isinstance(spec, dict) else None
+            if isinstance(cost, bool) or not isinstance(cost, (int, float)) or cost < 0:
+                raise ValueError(f"base_box_prices.{box_type}.{material}.cost must be a non-negative number")
 
-# ปั๊มนูน/ปั๊มจม
-EMBOSS_PRICES = {
-    "block_price": {"min": 800, "max": 1500, "unit": "บาท/บล็อก"},
-    "per_box": 2.0,
-}
+    for name, price_data in data["inner_prices"].items():
+        _check_range("inner_prices", name, price_data, "weight_per_box")
+    for section in ("moisture_coating_prices", "food_coating_prices", "gloss_coating_prices",
+                    "matte_coating_prices", "foil_block_prices", "foil_per_box_prices"):
+        for name, price_data in data[section].items():
+            _check_range(section, name, price_data)
+    _check_range("emboss_prices", "block_price", data["emboss_prices"].get("block_price"))
+    per_box = data["emboss_prices"].get("per_box")
+    if isinstance(per_box, bool) or not isinstance(per_box, (int, float)) or per_box < 0:
+        raise ValueError("emboss_prices.per_box must be a non-negative number")
+    for tier in ("ฟอยล์ 1 สี 1 จุด", "ลายใหญ่/ฟอยล์พิเศษ", "ฟอยล์+นูน"):
+        if tier not in data["foil_per_box_prices"]:
+            raise ValueError(f"foil_per_box_prices is missing tier {tier!r}")
 
-# ปั๊มฟอยล์ - ค่าบล็อก
-FOIL_BLOCK_PRICES = {
-    "ฟอยล์ธรรมดา": {"min": 1000, "max": 2000},
-    "ฟอยล์ละเอียด/ลายใหญ่": {"min": 2000, "max": 3500},
-    "ฟอยล์+นูน": {"min": 2500, "max": 5000},
-}
+    for product_type, materials in data["product_type_materials"].items():
+        for box_type, material in (materials.items() if isinstance(materials, dict) else ()):
+            if material not in data["base_box_prices"].get(box_type, {}):
+                raise ValueError(f"product_type_materials.{product_type}.{box_type}: unknown material {material!r}")
 
-# ปั๊มฟอยล์ - ราคาต่อกล่อง
-FOIL_PER_BOX_PRICES = {
-    "ฟอยล์ 1 สี 1 จุด": {"min": 2, "max": 5},
-    "ลายใหญ่/ฟอยล์พิเศษ": {"min": 5, "max": 10},
-    "ฟอยล์+นูน": {"min": 6, "max": 12},
-}
+    return {section: data[section] for section in CATALOG_SECTIONS}
 
-# เลือกวัสดุตามประเภทสินค้า
-PRODUCT_TYPE_MATERIALS = {
-    "สินค้าทั่วไป": {"RSC": "ลูกฟูก", "Die-cut": "ลูกฟูก"},
-    "Non-food": {"RSC": "ลูกฟูก", "Die-cut": "ลูกฟูก"},
-    "Food-grade": {"RSC": "ลูกฟูก", "Die-cut": "กล่องแป้ง"},
-    "เครื่องสำอาง": {"RSC": "คราฟท์", "Die-cut": "อาร์ต"},
-}
+def read_catalog_file(path: str) -> Dict[str, Any]:
+    with open(path, "rb") as f:
+        raw = f.read()
+    if path.endswith(".toml"):
+        import tomllib  # Python 3.11+
+        return tomllib.loads(raw.decode("utf-8"))
+    return json.loads(raw)
+
+class PricingCatalog:
+    """ราคาหนึ่งเวอร์ชัน: ข้อมูลแบบอ่านอย่างเดียว ตารางที่คำนวณแล้ว และ body ของ /api/pricing-info
+
+    เวอร์ชันคือ hash ของเนื้อหา ไฟล์เดิมจึงได้เวอร์ชันเดิมเสมอ (ใช้เป็น ETag ได้ทุก worker)
+    """
+
+    def __init__(self, data: Dict[str, Any], path: Optional[str] = None, mtime_ns: int = 0):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.version = hashlib.sha256(self.body).hexdigest()[:12]
+        self.etag = f'"{self.version}"'
+        self.data = _freeze(data)
+        self.tables = compile_price_tables(self.data, self.version)
+
+def load_pricing_catalog(path: str = PRICING_CATALOG_PATH) -> PricingCatalog:
+    mtime_ns = os.stat(path).st_mtime_ns
+    return PricingCatalog(validate_catalog(read_catalog_file(path)), path, mtime_ns)
 
 # ==================== SYSTEM PROMPT ====================
 SYSTEM_PROMPT = """คุณคือ "ลูโม่" (Lumo) ผู้ช่วย AI วิศวกรบรรจุภัณฑ์ของ LumoPack 
@@ -239,6 +751,209 @@ SYSTEM_PROMPT = """คุณคือ "ลูโม่" (Lumo) ผู้ช่
 - จำนวนขั้นต่ำ 500 ชิ้น
 """
 
+# ==================== PRICE TABLES ====================
+# ตารางราคาที่คำนวณค่าเฉลี่ย (min+max)/2 ไว้แล้ว สร้างครั้งเดียวต่อเวอร์ชันของ catalog
+# การคำนวณหนึ่งใบเสนอราคาอ่าน pricing_catalog.tables ครั้งเดียวแล้วส่งต่อ จึงไม่ปนราคาสองเวอร์ชัน
+def _average(price_data: Dict[str, Any]) -> float:
+    return (price_data["min"] + price_data["max"]) / 2
+
+def compile_price_tables(data: Dict[str, Any], version: str) -> Dict[str, Any]:
+    return {
+        "version": version,
+        "materials": data["product_type_materials"],
+        "base_cost": {
+            box_type: {material: spec["cost"] for material, spec in materials.items()}
+            for box_type, materials in data["base_box_prices"].items()
+        },
+        # (cost, labor, thickness cm) ใช้ปรับราคาแผ่นตามความหนา flute (ดู BOX OPTIMIZER)
+        "board": {
+            box_type: {
+                material: (spec["cost"], spec.get("labor", 0), spec.get("thickness", 0))
+                for material, spec in materials.items()
+            }
+            for box_type, materials in data["base_box_prices"].items()
+        },
+        "cushioning": {name: (_average(p), p["weight_per_box"]) for name, p in data["inner_prices"].items()},
+        "moisture_coating": {name: _average(p) for name, p in data["moisture_coating_prices"].items()},
+        "food_coating": {name: _average(p) for name, p in data["food_coating_prices"].items()},
+        "gloss_coating": {name: _average(p) for name, p in data["gloss_coating_prices"].items()},
+        "matte_coating": {name: _average(p) for name, p in data["matte_coating_prices"].items()},
+        "emboss_block": _average(data["emboss_prices"]["block_price"]),
+        "emboss_per_box": data["emboss_prices"]["per_box"],
+        "foil_block": {name: _average(p) for name, p in data["foil_block_prices"].items()},
+        "foil_per_box": {tier: _average(p) for tier, p in data["foil_per_box_prices"].items()},
+        # foil type ที่มีใน catalog -> ราคาต่อกล่องเฉลี่ย เติมเมื่อใช้ครั้งแรก (ดู foil_per_box_price)
+        "foil_tiers": {},
+    }
+
+def install_pricing_catalog(catalog: PricingCatalog) -> None:
+    """สลับ catalog ทั้งก้อนด้วยการกำหนดค่าครั้งเดียว ข้อมูล ตาราง และเวอร์ชันมาจาก object เดียวกันเสมอ
+
+    ผู้อ่านเก็บ pricing_catalog ไว้ในตัวแปรก่อนแล้วใช้ตัวนั้นจนจบ request ที่กำลังคำนวณอยู่จึงใช้ snapshot เดิม
+    """
+    global pricing_catalog
+    pricing_catalog = catalog
+
+install_pricing_catalog(load_pricing_catalog())
+
+_CATALOG_NAMES = {name: section for section, name in CATALOG_SECTIONS.items()}
+
+def __getattr__(name: str) -> Any:
+    """ชื่อเดิมของตารางราคา (main.INNER_PRICES ฯลฯ) และ main.PRICE_TABLES อ่านจาก pricing_catalog ปัจจุบัน"""
+    if name == "PRICE_TABLES":
+        return pricing_catalog.tables
+    if name in _CATALOG_NAMES:
+        return pricing_catalog.data[_CATALOG_NAMES[name]]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# คำในชื่อชนิดฟอยล์ -> ระดับราคาต่อกล่อง (ตรวจตามลำดับ ไม่เจอคำไหนใช้ FOIL_DEFAULT_TIER)
+FOIL_TIER_KEYWORDS = (("นูน", "ฟอยล์+นูน"), ("ละเอียด", "ลายใหญ่/ฟอยล์พิเศษ"), ("ใหญ่", "ลายใหญ่/ฟอยล์พิเศษ"))
+FOIL_DEFAULT_TIER = "ฟอยล์ 1 สี 1 จุด"
+FOIL_DEFAULT_BLOCK = 1500
+
+def foil_per_box_price(foil_type: Any, tables: Optional[Dict[str, Any]] = None) -> float:
+    """ราคาฟอยล์ต่อกล่องเฉลี่ยตามชื่อชนิดฟอยล์
+
+    จำผลไว้เฉพาะชื่อที่มีใน catalog ชื่ออื่นที่ผู้ใช้พิมพ์มาค้นหาคำใหม่ทุกครั้ง ไม่ให้ตารางโตตาม input
+    """
+    tables = tables or pricing_catalog.tables
+    tiers = tables["foil_tiers"]
+    try:
+        return tiers[foil_type]
+    except (KeyError, TypeError):
+        pass
+    name = str(foil_type)
+    tier = next((tier for keyword, tier in FOIL_TIER_KEYWORDS if keyword in name), FOIL_DEFAULT_TIER)
+    price = tables["foil_per_box"][tier]
+    if name == foil_type and (name in tables["foil_block"] or name in tables["foil_per_box"]):
+        tiers[name] = price
+    return price
+
+def _quotation_config(requirements: Dict[str, Any]) -> tuple:
+    """ส่วนของ requirements ที่ไม่ขึ้นกับขนาด/จำนวน ใช้เป็น key ของตารางต้นทุน"""
+    inner = requirements.get("inner", {})
+    inner_key = None
+    if inner:
+        inner_key = (inner.get("cushioning"), inner.get("moisture_coating"), inner.get("food_coating"))
+
+    features = requirements.get("special_features", {})
+    features_key = None
+    if features:
+        emboss = features.get("emboss", {})
+        foil = features.get("foil", {})
+        features_key = (
+            features.get("gloss_coating"), features.get("matte_coating"),
+            bool(emboss.get("type")), bool(emboss.get("has_block")),
+            foil.get("type") or None, bool(foil.get("has_block")),
+        )
+    return (
+        requirements.get("box_type", "RSC"),
+        requirements.get("product_type", "สินค้าทั่วไป"),
+        inner_key,
+        features_key,
+    )
+
+class QuotationCache:
+    """LRU ของผลคำนวณราคา (material, pricing) key คือเวอร์ชัน catalog + ค่าที่มีผลต่อราคาเท่านั้น
+
+    ส่วนที่ต้องสะท้อนกลับ (dimensions, inner ฯลฯ) ประกอบใหม่จาก requirements ทุกครั้ง
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, requirements: Dict[str, Any], version: str) -> Optional[tuple]:
+        if not self.max_size:
+            return None
+        try:
+            dimensions = requirements.get("dimensions", {"width": 10, "length": 10, "height": 10})
+            key = (
+                version,
+                _quotation_config(requirements),
+                dimensions.get("width", 10),
+                dimensions.get("length", 10),
+                dimensions.get("height", 10),
+                requirements.get("quantity", 500),
+            )
+            hash(key)
+        except (AttributeError, TypeError):
+            # ข้อมูลผิดรูปแบบ ให้ _compute_quotation แจ้ง error ตามปกติ
+            return None
+        return key
+
+    def get(self, key: tuple) -> Optional[tuple]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: tuple, entry: tuple) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+quotation_cache = QuotationCache(QUOTATION_CACHE_SIZE)
+
+def reload_pricing(path: Optional[str] = None) -> PricingCatalog:
+    """โหลด catalog จากไฟล์ใหม่แล้วสลับเข้าใช้งาน และล้างใบเสนอราคาที่ cache ไว้
+
+    ถ้าไฟล์ผิดรูปแบบจะ raise ValueError/OSError และยังใช้เวอร์ชันเดิมต่อ
+    """
+    catalog = load_pricing_catalog(path or pricing_catalog.path or PRICING_CATALOG_PATH)
+    install_pricing_catalog(catalog)
+    quotation_cache.clear()
+    return catalog
+
+def watch_pricing_catalog(stop: threading.Event, interval: float = PRICING_CATALOG_POLL_SECONDS) -> None:
+    """ตรวจ mtime ของไฟล์ catalog ทุก interval วินาที ถ้าเปลี่ยนก็โหลดใหม่"""
+    rejected_mtime_ns = None
+    while not stop.wait(interval):
+        current = pricing_catalog
+        try:
+            mtime_ns = os.stat(current.path).st_mtime_ns
+        except OSError:
+            continue
+        # ไม่ลองไฟล์เสียเดิมซ้ำ รอแก้ไฟล์ครั้งถัดไป (catalog ที่ใช้อยู่ไม่ถูกแก้)
+        if mtime_ns in (current.mtime_ns, rejected_mtime_ns):
+            continue
+        try:
+            catalog = reload_pricing(current.path)
+        except (OSError, ValueError) as e:
+            logger.error("Pricing catalog %s not reloaded: %s", current.path, e)
+            rejected_mtime_ns = mtime_ns
+            continue
+        if catalog.version != current.version:
+            logger.info("Pricing catalog reloaded: %s -> %s", current.version, catalog.version)
+
+def start_pricing_watcher() -> threading.Event:
+    stop = threading.Event()
+    if PRICING_CATALOG_POLL_SECONDS > 0:
+        threading.Thread(target=watch_pricing_catalog, args=(stop,), name="pricing-watcher", daemon=True).start()
+    return stop
+
 # ==================== HELPER FUNCTIONS ====================
 def calculate_surface_area(width: float, length: float, height: float) -> float:
     return 2 * ((width * length) + (width * height) + (length * height))
@@ -250,19 +965,19 @@ def calculate_factor(width: float, length: float, height: float, box_type: str)
     new_area = calculate_surface_area(width, length, height) * production_factor
     return max(1.0, new_area / base_area_with_factor)
 
-def get_material_for_product(product_type: str, box_type: str) -> str:
-    if product_type in PRODUCT_TYPE_MATERIALS:
-        return PRODUCT_TYPE_MATERIALS[product_type].get(box_type, "ลูกฟูก")
+def get_material_for_product(product_type: str, box_type: str, tables: Optional[Dict[str, Any]] = None) -> str:
+    materials = (tables or pricing_catalog.tables)["materials"]
+    if product_type in materials:
+        return materials[product_type].get(box_type, "ลูกฟูก")
     return "ลูกฟูก"
 
 def calculate_box_price(width: float, length: float, height: float, 
-                        box_type: str, material: str, quantity: int) -> Dict[str, Any]:
+                        box_type: str, material: str, quantity: int,
+                        tables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     factor = calculate_factor(width, length, height, box_type)
     
-    if box_type == "RSC":
-        base_price = BASE_BOX_PRICES["RSC"].get(material, BASE_BOX_PRICES["RSC"]["ลูกฟูก"])["cost"]
-    else:
-        base_price = BASE_BOX_PRICES["Die-cut"].get(material, BASE_BOX_PRICES["Die-cut"]["ลูกฟูก"])["cost"]
+    base_cost = (tables or pricing_catalog.tables)["base_cost"]["RSC" if box_type == "RSC" else "Die-cut"]
+    base_price = base_cost.get(material, base_cost["ลูกฟูก"])
     
     price_per_box = base_price * factor
     total_price = price_per_box * quantity
@@ -274,35 +989,36 @@ def calculate_box_price(width: float, length: float, height: float,
         "quantity": quantity
     }
 
-def calculate_inner_price(inner: Dict[str, Any], factor: float, quantity: int) -> Dict[str, float]:
+def calculate_inner_price(inner: Dict[str, Any], factor: float, quantity: int,
+                          tables: Optional[Dict[str, Any]] = None) -> Dict[str, float]:
+    tables = tables or pricing_catalog.tables
     result = {"cushioning": 0, "moisture_coating": 0, "food_coating": 0, "total": 0}
     
     if not inner:
         return result
     
     cushioning = inner.get("cushioning")
-    if cushioning and cushioning in INNER_PRICES:
-        price_data = INNER_PRICES[cushioning]
-        avg_price_per_kg = (price_data["min"] + price_data["max"]) / 2
-        weight = price_data["weight_per_box"] * factor
+    if cushioning and cushioning in tables["cushioning"]:
+        avg_price_per_kg, weight_per_box = tables["cushioning"][cushioning]
+        weight = weight_per_box * factor
         result["cushioning"] = round(avg_price_per_kg * weight * quantity, 2)
     
     moisture = inner.get("moisture_coating")
-    if moisture and moisture in MOISTURE_COATING_PRICES:
-        price_data = MOISTURE_COATING_PRICES[moisture]
-        avg_price = (price_data["min"] + price_data["max"]) / 2 * factor
+    if moisture and moisture in tables["moisture_coating"]:
+        avg_price = tables["moisture_coating"][moisture] * factor
         result["moisture_coating"] = round(avg_price * quantity, 2)
     
     food = inner.get("food_coating")
-    if food and food in FOOD_COATING_PRICES:
-        price_data = FOOD_COATING_PRICES[food]
-        avg_price = (price_data["min"] + price_data["max"]) / 2 * factor
+    if food and food in tables["food_coating"]:
+        avg_price = tables["food_coating"][food] * factor
         result["food_coating"] = round(avg_price * quantity, 2)
     
     result["total"] = result["cushioning"] + result["moisture_coating"] + result["food_coating"]
     return result
 
-def calculate_special_features_price(features: Dict[str, Any], factor: float, quantity: int) -> Dict[str, Any]:
+def calculate_special_features_price(features: Dict[str, Any], factor: float, quantity: int,
+                                     tables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    tables = tables or pricing_catalog.tables
     result = {
         "gloss_coating": 0,
         "matte_coating": 0,
@@ -315,42 +1031,29 @@ def calculate_special_features_price(features: Dict[str, Any], factor: float, qu
         return result
     
     gloss = features.get("gloss_coating")
-    if gloss and gloss in GLOSS_COATING_PRICES:
-        price_data = GLOSS_COATING_PRICES[gloss]
-        avg_price = (price_data["min"] + price_data["max"]) / 2 * factor
+    if gloss and gloss in tables["gloss_coating"]:
+        avg_price = tables["gloss_coating"][gloss] * factor
         result["gloss_coating"] = round(avg_price * quantity, 2)
     
     matte = features.get("matte_coating")
-    if matte and matte in MATTE_COATING_PRICES:
-        price_data = MATTE_COATING_PRICES[matte]
-        avg_price = (price_data["min"] + price_data["max"]) / 2 * factor
+    if matte and matte in tables["matte_coating"]:
+        avg_price = tables["matte_coating"][matte] * factor
         result["matte_coating"] = round(avg_price * quantity, 2)
     
     emboss = features.get("emboss", {})
     if emboss.get("type"):
         if not emboss.get("has_block"):
-            result["emboss"]["block"] = (EMBOSS_PRICES["block_price"]["min"] + EMBOSS_PRICES["block_price"]["max"]) / 2
-        result["emboss"]["per_box"] = round(EMBOSS_PRICES["per_box"] * quantity, 2)
+            result["emboss"]["block"] = tables["emboss_block"]
+        result["emboss"]["per_box"] = round(tables["emboss_per_box"] * quantity, 2)
         result["emboss"]["total"] = result["emboss"]["block"] + result["emboss"]["per_box"]
     
     foil = features.get("foil", {})
     foil_type = foil.get("type")
     if foil_type:
         if not foil.get("has_block"):
-            if foil_type in FOIL_BLOCK_PRICES:
-                block_price = FOIL_BLOCK_PRICES[foil_type]
-                result["foil"]["block"] = (block_price["min"] + block_price["max"]) / 2
-            else:
-                result["foil"]["block"] = 1500
-        
-        if "นูน" in str(foil_type):
-            per_box = FOIL_PER_BOX_PRICES["ฟอยล์+นูน"]
-        elif "ละเอียด" in str(foil_type) or "ใหญ่" in str(foil_type):
-            per_box = FOIL_PER_BOX_PRICES["ลายใหญ่/ฟอยล์พิเศษ"]
-        else:
-            per_box = FOIL_PER_BOX_PRICES["ฟอยล์ 1 สี 1 จุด"]
+            result["foil"]["block"] = tables["foil_block"].get(foil_type, FOIL_DEFAULT_BLOCK)
         
-        avg_per_box = (per_box["min"] + per_box["max"]) / 2
+        avg_per_box = foil_per_box_price(foil_type, tables)
         result["foil"]["per_box"] = round(avg_per_box * quantity, 2)
         result["foil"]["total"] = result["foil"]["block"] + result["foil"]["per_box"]
     
@@ -363,28 +1066,56 @@ def calculate_special_features_price(features: Dict[str, Any], factor: float, qu
     
     return result
 
-def generate_quotation(requirements: Dict[str, Any]) -> Dict[str, Any]:
+def generate_quotation(requirements: Dict[str, Any], tables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """ใบเสนอราคาจาก requirements (dict "pricing" อาจมาจาก cache ที่ใช้ร่วมกัน ห้ามแก้ไข)"""
+    started = time.perf_counter()
+    tables = tables or pricing_catalog.tables
+    key = quotation_cache.key(requirements, tables["version"])
+    cached = quotation_cache.get(key) if key is not None else None
+    if cached is None:
+        quotation = _compute_quotation(requirements, tables)
+        if key is not None:
+            quotation_cache.put(key, (quotation["material"], quotation["pricing"]))
+        QUOTATION_LATENCY.observe(time.perf_counter() - started, "miss")
+        return quotation
+
+    # hit ไม่จับเวลา (จำนวน hit ส่งออกจาก quotation_cache.stats() ตอน scrape อยู่แล้ว)
+    material, pricing = cached
+    return {
+        "product_type": requirements.get("product_type", "สินค้าทั่วไป"),
+        "box_type": requirements.get("box_type", "RSC"),
+        "material": material,
+        "dimensions": requirements.get("dimensions", {"width": 10, "length": 10, "height": 10}),
+        "quantity": requirements.get("quantity", 500),
+        "inner": requirements.get("inner", {}),
+        "special_features": requirements.get("special_features", {}),
+        "catalog_version": tables["version"],
+        "pricing": pricing,
+    }
+
+def _compute_quotation(requirements: Dict[str, Any], tables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    tables = tables or pricing_catalog.tables
     dimensions = requirements.get("dimensions", {"width": 10, "length": 10, "height": 10})
     box_type = requirements.get("box_type", "RSC")
     quantity = requirements.get("quantity", 500)
     product_type = requirements.get("product_type", "สินค้าทั่วไป")
     
-    material = get_material_for_product(product_type, box_type)
+    material = get_material_for_product(product_type, box_type, tables)
     
     box_price = calculate_box_price(
         dimensions.get("width", 10), 
         dimensions.get("length", 10), 
         dimensions.get("height", 10),
-        box_type, material, quantity
+        box_type, material, quantity, tables
     )
     
     factor = box_price["factor"]
     
     inner = requirements.get("inner", {})
-    inner_price = calculate_inner_price(inner, factor, quantity)
+    inner_price = calculate_inner_price(inner, factor, quantity, tables)
     
     special_features = requirements.get("special_features", {})
-    features_price = calculate_special_features_price(special_features, factor, quantity)
+    features_price = calculate_special_features_price(special_features, factor, quantity, tables)
     
     grand_total = box_price["total_price"] + inner_price["total"] + features_price["grand_total"]
     
@@ -396,6 +1127,7 @@ def generate_quotation(requirements: Dict[str, Any]) -> Dict[str, Any]:
         "quantity": quantity,
         "inner": inner,
         "special_features": special_features,
+        "catalog_version": tables["version"],
         "pricing": {
             "factor": factor,
             "box_price_per_unit": box_price["price_per_box"],
@@ -409,127 +1141,3088 @@ def generate_quotation(requirements: Dict[str, Any]) -> Dict[str, Any]:
         }
     }
 
-def extract_json_from_response(response_text: str) -> Dict[str, Any]:
-    pattern = r'<extracted_data>\s*(\{.*?\})\s*</extracted_data>'
-    match = re.search(pattern, response_text, re.DOTALL)
-    
-    if match:
-        try:
-            return json.loads(match.group(1))
-        except json.JSONDecodeError:
-            pass
-    return {}
+# ==================== BATCH PRICING ====================
+# คำนวณราคาหลายรายการในรอบเดียวด้วย NumPy (ผลลัพธ์ต้องตรงกับ generate_quotation ทุกหลัก)
+_BATCH_COST_COLUMNS = (
+    "production_factor", "base_price", "cushioning_per_kg", "cushioning_weight",
+    "moisture_coating", "food_coating", "gloss_coating", "matte_coating",
+    "emboss_per_box", "emboss_block", "foil_per_box", "foil_block",
+)
 
-def clean_response(response_text: str) -> str:
-    pattern = r'<extracted_data>.*?</extracted_data>'
-    return re.sub(pattern, '', response_text, flags=re.DOTALL).strip()
+def _as_number(value: Any) -> Any:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError(f"expected a number, got {value!r}")
+    return value
 
-# ==================== ENDPOINTS ====================
-@app.get("/")
-def read_root():
-    return {"message": "Hello! LumoPack Brain is ready 🧠"}
+# x * 100 คลาดจากค่าจริงได้ไม่เกิน 1 ulp ซึ่ง <= eps * |x * 100| เผื่อไว้สองเท่า
+_HALF_TOLERANCE = 2 * np.finfo(np.float64).eps
 
-@app.get("/health")
-def health_check():
-    return {"status": "healthy", "gemini_configured": bool(GEMINI_API_KEY)}
+def _round_array(values: np.ndarray) -> np.ndarray:
+    """round(x, 2) แบบ vectorized ที่ให้ผลเหมือน round() ของ Python"""
+    scaled = values * 100
+    rounded = np.rint(scaled) / 100
+    # ค่าที่ห่างจาก .5 ไม่เกินความคลาดของการคูณ (ตามขนาดของค่า) อาจปัดต่างจาก Python จึงปัดซ้ำทีละตัว
+    # ค่าใหญ่มากจน ulp >= 0.5 เข้าเงื่อนไขนี้ทั้งหมด
+    near_half = np.abs(scaled - np.floor(scaled) - 0.5) <= np.abs(scaled) * _HALF_TOLERANCE
+    if near_half.any():
+        rounded[near_half] = [round(v, 2) for v in values[near_half].tolist()]
+    return rounded
 
-@app.post("/analyze")
-def analyze_box(design: BoxDesign):
-    spec = FLUTE_SPECS.get(design.flute_type, FLUTE_SPECS["C"])
-    
-    perimeter_inch = 2 * (design.length + design.width) * 0.3937
-    bct_lbs = 5.87 * spec["ect"] * ((spec["thickness"] * 0.03937 * perimeter_inch) ** 0.5)
-    max_load_kg = bct_lbs * 0.453592
-    
-    stack_load = design.weight * 4
-    safety_score = max_load_kg / stack_load if stack_load > 0 else 100
+def _resolve_quotation_config(config: tuple, tables: Dict[str, Any]) -> Dict[str, Any]:
+    box_type, product_type, inner_key, features_key = config
+    material = get_material_for_product(product_type, box_type, tables)
+    base_cost = tables["base_cost"]["RSC" if box_type == "RSC" else "Die-cut"]
+    costs = dict.fromkeys(_BATCH_COST_COLUMNS, 0)
+    costs.update({
+        "material": material,
+        "production_factor": 1.1 if box_type == "RSC" else 1.5,
+        "base_price": base_cost.get(material, base_cost["ลูกฟูก"]),
+    })
+    present = set()
+
+    if inner_key:
+        cushioning, moisture, food = inner_key
+        if cushioning and cushioning in tables["cushioning"]:
+            costs["cushioning_per_kg"], costs["cushioning_weight"] = tables["cushioning"][cushioning]
+            present.add("cushioning")
+        for key, name in (("moisture_coating", moisture), ("food_coating", food)):
+            if name and name in tables[key]:
+                costs[key] = tables[key][name]
+                present.add(key)
+
+    if features_key:
+        gloss, matte, has_emboss, emboss_has_block, foil_type, foil_has_block = features_key
+        for key, name in (("gloss_coating", gloss), ("matte_coating", matte)):
+            if name and name in tables[key]:
+                costs[key] = tables[key][name]
+                present.add(key)
+
+        if has_emboss:
+            if not emboss_has_block:
+                costs["emboss_block"] = tables["emboss_block"]
+            costs["emboss_per_box"] = tables["emboss_per_box"]
+            present.add("emboss")
+
+        if foil_type:
+            if not foil_has_block:
+                costs["foil_block"] = tables["foil_block"].get(foil_type, FOIL_DEFAULT_BLOCK)
+            costs["foil_per_box"] = foil_per_box_price(foil_type, tables)
+            present.add("foil")
 
-    status = "SAFE"
-    if safety_score < 1.5:
-        status = "DANGER"
-    elif safety_score < 3.0:
-        status = "WARNING"
+    costs["present"] = present
+    costs["has_inner"] = bool(present & {"cushioning", "moisture_coating", "food_coating"})
+    costs["has_features"] = bool(present & {"gloss_coating", "matte_coating", "emboss", "foil"})
+    return costs
 
+def _price_totals(cost: Dict[str, Any], raw_factor: np.ndarray, qty: np.ndarray) -> Dict[str, Any]:
+    """ยอดเงินแต่ละส่วนของทุกแถวพร้อมกัน (ลำดับการคูณ/บวกเหมือน calculate_* ทุกตัว)"""
+    price_per_box = cost["base_price"] * raw_factor
+    factor = _round_array(raw_factor)
+
+    box_total = _round_array(price_per_box * qty)
+    cushioning = _round_array(cost["cushioning_per_kg"] * (cost["cushioning_weight"] * factor) * qty)
+    moisture = _round_array(cost["moisture_coating"] * factor * qty)
+    food = _round_array(cost["food_coating"] * factor * qty)
+    inner_total = cushioning + moisture + food
+
+    gloss = _round_array(cost["gloss_coating"] * factor * qty)
+    matte = _round_array(cost["matte_coating"] * factor * qty)
+    emboss_per_box = _round_array(cost["emboss_per_box"] * qty)
+    emboss_total = cost["emboss_block"] + emboss_per_box
+    foil_per_box = _round_array(cost["foil_per_box"] * qty)
+    foil_total = cost["foil_block"] + foil_per_box
+    features_total = gloss + matte + emboss_total + foil_total
+
+    grand_total = box_total + inner_total + features_total
     return {
-        "max_load_kg": round(max_load_kg, 2),
-        "current_load": stack_load,
-        "safety_score": round(safety_score, 2),
-        "status": status,
-        "recommendation": "Switch to Flute BC (Double Wall)" if status == "DANGER" else "Design is optimal (Safe)."
+        "factor": factor,
+        "price_per_box": _round_array(price_per_box),
+        "box_total": box_total,
+        "cushioning": cushioning,
+        "moisture_coating": moisture,
+        "food_coating": food,
+        "inner_total": inner_total,
+        "gloss_coating": gloss,
+        "matte_coating": matte,
+        "emboss_per_box": emboss_per_box,
+        "emboss_total": emboss_total,
+        "foil_per_box": foil_per_box,
+        "foil_total": foil_total,
+        "features_total": features_total,
+        "grand_total": _round_array(grand_total),
+        "price_per_unit": _round_array(grand_total / qty),
     }
 
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat_with_ai(request: ChatRequest):
-    if not client:
-        raise HTTPException(status_code=500, detail="GEMINI_API_KEY not configured")
-    
+def generate_quotations_batch(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Price many requirement rows at once; each result equals generate_quotation(row)."""
+    if not items:
+        return []
+    tables = pricing_catalog.tables
+
+    # 1) แยกตัวเลขของแต่ละแถว และจัดกลุ่มแถวที่ใช้ตัวเลือกชุดเดียวกัน
+    dims = []
+    quantities = []
+    config_index: Dict[tuple, int] = {}
+    configs: List[Dict[str, Any]] = []
+    row_config = []
+    for i, requirements in enumerate(items):
+        try:
+            dimensions = requirements.get("dimensions", {"width": 10, "length": 10, "height": 10})
+            dims.append((
+                _as_number(dimensions.get("width", 10)),
+                _as_number(dimensions.get("length", 10)),
+                _as_number(dimensions.get("height", 10)),
+            ))
+            quantity = _as_number(requirements.get("quantity", 500))
+            if quantity == 0:
+                raise ZeroDivisionError("quantity must not be zero")
+            quantities.append(quantity)
+            config = _quotation_config(requirements)
+            if config not in config_index:
+                config_index[config] = len(configs)
+                configs.append(_resolve_quotation_config(config, tables))
+            row_config.append(config_index[config])
+        except Exception as e:
+            raise ValueError(f"row {i}: {e}") from e
+
+    cost_table = np.array([[cfg[col] for col in _BATCH_COST_COLUMNS] for cfg in configs], dtype=np.float64)
+    cost = dict(zip(_BATCH_COST_COLUMNS, cost_table[row_config].T))
+    qty = np.array(quantities, dtype=np.float64)
+
+    # 2) คำนวณทุกแถวพร้อมกัน
+    width, length, height = np.array(dims, dtype=np.float64).T
+    production_factor = cost["production_factor"]
+    surface_area = 2 * ((width * length) + (width * height) + (length * height))
+    raw_factor = np.maximum(1.0, (surface_area * production_factor) / (600 * production_factor))
+    t = _price_totals(cost, raw_factor, qty)
+
+    # 3) ประกอบ dict ผลลัพธ์ ช่องที่ไม่ได้เลือกเป็น 0 (int) เหมือนเส้นทางปกติ
+    columns = zip(
+        row_config, *(t[name].tolist() for name in (
+            "factor", "price_per_box", "box_total", "cushioning", "moisture_coating", "food_coating", "inner_total",
+            "gloss_coating", "matte_coating", "emboss_per_box", "emboss_total", "foil_per_box", "foil_total",
+            "features_total", "grand_total", "price_per_unit",
+        )),
+    )
+    results = []
+    for requirements, (c, f, ppb, box, cu, mo, fo, inn, gl, ma, emb, emb_t, foi, foi_t, feat, grand, ppu) in zip(items, columns):
+        cfg = configs[c]
+        present = cfg["present"]
+        inner_price = {
+            "cushioning": cu if "cushioning" in present else 0,
+            "moisture_coating": mo if "moisture_coating" in present else 0,
+            "food_coating": fo if "food_coating" in present else 0,
+            "total": inn if cfg["has_inner"] else 0,
+        }
+        features_price = {
+            "gloss_coating": gl if "gloss_coating" in present else 0,
+            "matte_coating": ma if "matte_coating" in present else 0,
+            "emboss": ({"block": cfg["emboss_block"], "per_box": emb, "total": emb_t}
+                       if "emboss" in present else {"block": 0, "per_box": 0, "total": 0}),
+            "foil": ({"block": cfg["foil_block"], "per_box": foi, "total": foi_t}
+                     if "foil" in present else {"block": 0, "per_box": 0, "total": 0}),
+            "grand_total": feat if cfg["has_features"] else 0,
+        }
+        results.append({
+            "product_type": requirements.get("product_type", "สินค้าทั่วไป"),
+            "box_type": requirements.get("box_type", "RSC"),
+            "material": cfg["material"],
+            "dimensions": requirements.get("dimensions", {"width": 10, "length": 10, "height": 10}),
+            "quantity": requirements.get("quantity", 500),
+            "inner": requirements.get("inner", {}),
+            "special_features": requirements.get("special_features", {}),
+            "catalog_version": tables["version"],
+            "pricing": {
+                "factor": f,
+                "box_price_per_unit": ppb,
+                "box_total": box,
+                "inner_breakdown": inner_price,
+                "inner_total": inner_price["total"],
+                "features_breakdown": features_price,
+                "features_total": features_price["grand_total"],
+                "grand_total": grand,
+                "price_per_unit": ppu
+            }
+        })
+    return results
+
+# ==================== PRICE BREAKS ====================
+# ราคาหลายจำนวนในครั้งเดียว: วัสดุ, factor, ต้นทุนต่อชิ้น และค่าบล็อก (จ่ายครั้งเดียว) คิดครั้งเดียว
+# แล้วคิดทุกจำนวนพร้อมกันด้วย _price_totals ราคาแต่ละขั้นตรงกับ generate_quotation ที่จำนวนนั้น
+PRICE_BREAK_QUANTITIES = (500, 1000, 2000, 5000, 10000)
+PRICE_BREAK_MAX_TIERS = 50
+PRICE_BREAK_CURVE_POINTS = 24
+
+def _price_break_quantities(quantities: Any) -> List[Union[int, float]]:
+    if not isinstance(quantities, list) or not quantities:
+        raise ValueError("quantities must be a non-empty list")
     try:
-        contents = []
-        
-        contents.append({"role": "user", "parts": [{"text": SYSTEM_PROMPT}]})
-        contents.append({"role": "model", "parts": [{"text": "เข้าใจแล้วครับ พร้อมทำหน้าที่ลูโม่แล้วครับ"}]})
-        
-        for msg in request.conversation_history:
-            role = "user" if msg.role == "user" else "model"
-            contents.append({"role": role, "parts": [{"text": msg.content}]})
-        
-        user_message = request.message
-        if request.current_requirements:
-            user_message += f"\n\n[ข้อมูลที่เก็บได้: {json.dumps(request.current_requirements, ensure_ascii=False)}]"
-        
-        contents.append({"role": "user", "parts": [{"text": user_message}]})
-        
-        response = client.models.generate_content(
-            model="gemini-1.5-flash",
-            contents=contents
-        )
-        
-        response_text = response.text
-        
-        extracted_data = extract_json_from_response(response_text)
-        clean_text = clean_response(response_text)
-        
-        quick_replies = extracted_data.get("quick_replies", [])
-        
-        result = ChatResponse(
-            response=clean_text,
-            extracted_data=extracted_data,
-            quick_replies=quick_replies,
-            current_step=extracted_data.get("current_step", 1),
-            is_checkpoint=extracted_data.get("is_checkpoint", False),
-            show_quotation=False,
-            quotation_data={}
-        )
-        
-        if extracted_data.get("confirmed_design") and extracted_data.get("current_step", 0) >= 10:
-            quotation = generate_quotation(extracted_data)
-            result.show_quotation = True
-            result.quotation_data = quotation
-        
-        return result
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"AI Error: {str(e)}")
+        tiers = sorted({_as_number(q) for q in quantities})
+    except TypeError as e:
+        raise ValueError(f"quantities: {e}") from None
+    if tiers[0] <= 0:
+        raise ValueError("quantities must be positive")
+    if len(tiers) > PRICE_BREAK_MAX_TIERS:
+        raise ValueError(f"at most {PRICE_BREAK_MAX_TIERS} quantities per request")
+    return tiers
+
+def _amortization_quantities(low: float, high: float, points: int) -> List[int]:
+    """จำนวนแบบ log-spaced จาก low ถึง high ใช้วาดกราฟราคาต่อชิ้น"""
+    if points < 2 or high <= low:
+        return []
+    low = max(low, 1)
+    ratio = high / low
+    return sorted({round(low * ratio ** (i / (points - 1))) for i in range(points)})
 
-@app.post("/api/calculate-price")
-async def calculate_price(requirements: Dict[str, Any]):
+def generate_price_breaks(requirements: Dict[str, Any], quantities: List[Any],
+                          curve_points: int = PRICE_BREAK_CURVE_POINTS,
+                          tables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    tables = tables or pricing_catalog.tables
+    tiers = _price_break_quantities(quantities)
+    dimensions = requirements.get("dimensions", {"width": 10, "length": 10, "height": 10})
+    box_type = requirements.get("box_type", "RSC")
     try:
-        quotation = generate_quotation(requirements)
-        return quotation
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Calculation Error: {str(e)}")
+        width, length, height = (_as_number(dimensions.get(k, 10)) for k in ("width", "length", "height"))
+    except TypeError as e:
+        raise ValueError(f"dimensions: {e}") from None
 
-@app.get("/api/pricing-info")
-def get_pricing_info():
+    # ส่วนที่ไม่ขึ้นกับจำนวน
+    cost = _resolve_quotation_config(_quotation_config(requirements), tables)
+    raw_factor = calculate_factor(width, length, height, box_type)
+    factor = round(raw_factor, 2)
+    variable_per_unit = (
+        cost["base_price"] * raw_factor
+        + cost["cushioning_per_kg"] * cost["cushioning_weight"] * factor
+        + (cost["moisture_coating"] + cost["food_coating"] + cost["gloss_coating"] + cost["matte_coating"]) * factor
+        + cost["emboss_per_box"] + cost["foil_per_box"]
+    )
+    one_time = cost["emboss_block"] + cost["foil_block"]
+
+    # ทุกขั้นและทุกจุดบนกราฟคิดใน _price_totals ครั้งเดียวเป็น array (ขั้นอยู่หน้า จุดกราฟต่อท้าย)
+    curve = _amortization_quantities(tiers[0], tiers[-1], curve_points)
+    qty = np.array([*tiers, *curve], dtype=np.float64)
+    totals = _price_totals(cost, np.full(qty.size, raw_factor), qty)
+    columns = {name: totals[name][:len(tiers)].tolist()
+               for name in ("box_total", "inner_total", "features_total", "grand_total", "price_per_unit")}
+    rows = []
+    for i, quantity in enumerate(tiers):
+        rows.append({
+            "quantity": quantity,
+            **{name: values[i] for name, values in columns.items()},
+            "one_time_per_unit": round(one_time / quantity, 2),
+        })
+    first_price = rows[0]["price_per_unit"]
+    for row in rows:
+        row["savings_per_unit"] = round(first_price - row["price_per_unit"], 2)
+        row["savings_percent"] = round(row["savings_per_unit"] / first_price * 100, 1) if first_price else 0.0
+    curve_prices = totals["price_per_unit"][len(tiers):].tolist()
+    return {
+        "catalog_version": tables["version"],
+        "product_type": requirements.get("product_type", "สินค้าทั่วไป"),
+        "box_type": box_type,
+        "material": cost["material"],
+        "dimensions": dimensions,
+        "factor": factor,
+        "box_price_per_unit": round(cost["base_price"] * raw_factor, 2),
+        # ราคาต่อชิ้นเมื่อสั่งมากจนค่าบล็อกหารแล้วเหลือ ~0 (เส้นล่างของกราฟ)
+        "variable_per_unit": round(variable_per_unit, 2),
+        "one_time": {"emboss_block": cost["emboss_block"], "foil_block": cost["foil_block"], "total": one_time},
+        "tiers": rows,
+        "curve": {
+            "quantities": curve,
+            "price_per_unit": curve_prices,
+            "one_time_per_unit": [round(one_time / q, 2) for q in curve],
+        },
+    }
+
+# ==================== PRICING KERNEL ====================
+# ตัวเลขทั้งหมดที่ใช้คิดราคาของขนาด + ชนิดกล่องหนึ่ง ๆ ให้หน้าเว็บสลับตัวเลือก (วัสดุ, เคลือบ, ปั๊ม, ฟอยล์, จำนวน)
+# แล้วคิดราคาเองได้โดยไม่ต้องเรียก API ทุกครั้ง ยอดสุดท้ายส่งกลับมาตรวจกับ generate_quotation ที่ /verify
+# ราคาต่อชิ้นในนี้คูณ factor ไว้แล้วในลำดับเดียวกับ calculate_* จึงได้ผลตรงกันทุกหลัก (ดู quote_from_kernel)
+PRICING_KERNEL_VERSION = 1  # เพิ่มเมื่อสูตรใน quote_from_kernel เปลี่ยน
+
+def _json_checksum(value: Any) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:16]
+
+def build_pricing_kernel(width: float, length: float, height: float, box_type: str,
+                         tables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    tables = tables or pricing_catalog.tables
+    # 20 กับ 20.0 ต้องได้ checksum เดียวกัน
+    width, length, height = float(width), float(length), float(height)
+    for name, value in (("width", width), ("length", length), ("height", height)):
+        if not (math.isfinite(value) and value > 0):
+            raise ValueError(f"{name} must be a finite number greater than 0, got {value!r}")
+    raw_factor = calculate_factor(width, length, height, box_type)
+    factor = round(raw_factor, 2)
+    base_cost = tables["base_cost"]["RSC" if box_type == "RSC" else "Die-cut"]
+    per_unit = lambda prices: {name: price * factor for name, price in prices.items()}
+    kernel = {
+        "kernel_version": PRICING_KERNEL_VERSION,
+        "catalog_version": tables["version"],
+        "box_type": box_type,
+        "dimensions": {"width": width, "length": length, "height": height},
+        "factor": factor,
+        # product_type -> material (ชนิดสินค้าที่ไม่มีในนี้ใช้ default_material)
+        "materials": {product: get_material_for_product(product, box_type, tables) for product in tables["materials"]},
+        "default_material": "ลูกฟูก",
+        # ราคากล่องต่อชิ้นก่อนปัด: total = round(box_price_per_unit[material] * quantity, 2)
+        "box_price_per_unit": {material: price * raw_factor for material, price in base_cost.items()},
+        "inner": {
+            "cushioning": {name: per_kg * (weight * factor) for name, (per_kg, weight) in tables["cushioning"].items()},
+            "moisture_coating": per_unit(tables["moisture_coating"]),
+            "food_coating": per_unit(tables["food_coating"]),
+        },
+        "features": {
+            "gloss_coating": per_unit(tables["gloss_coating"]),
+            "matte_coating": per_unit(tables["matte_coating"]),
+            # block คิดครั้งเดียวต่องาน (ไม่คิดถ้าลูกค้ามีบล็อกอยู่แล้ว has_block)
+            "emboss": {"per_unit": tables["emboss_per_box"], "block": tables["emboss_block"]},
+            "foil": {
+                "per_unit": dict(tables["foil_per_box"]),
+                "tier_keywords": [list(pair) for pair in FOIL_TIER_KEYWORDS],
+                "default_tier": FOIL_DEFAULT_TIER,
+                "block": dict(tables["foil_block"]),
+                "default_block": FOIL_DEFAULT_BLOCK,
+            },
+        },
+        "rounding": "round(x, 2) half-even on the exact binary value, after each line total",
+    }
+    kernel["checksum"] = _json_checksum(kernel)
+    return kernel
+
+def quote_from_kernel(kernel: Dict[str, Any], requirements: Dict[str, Any]) -> Dict[str, Any]:
+    """ต้นแบบของการคิดราคาฝั่ง client จาก kernel (ผลต้องเท่ากับ generate_quotation ทุกช่อง)"""
+    quantity = requirements.get("quantity", 500)
+    material = kernel["materials"].get(requirements.get("product_type", "สินค้าทั่วไป"), kernel["default_material"])
+    box_prices = kernel["box_price_per_unit"]
+    price_per_box = box_prices.get(material, box_prices[kernel["default_material"]])
+    box_total = round(price_per_box * quantity, 2)
+
+    inner = requirements.get("inner", {})
+    inner_price = {"cushioning": 0, "moisture_coating": 0, "food_coating": 0, "total": 0}
+    if inner:
+        for key in ("cushioning", "moisture_coating", "food_coating"):
+            if inner.get(key) and inner[key] in kernel["inner"][key]:
+                inner_price[key] = round(kernel["inner"][key][inner[key]] * quantity, 2)
+        inner_price["total"] = inner_price["cushioning"] + inner_price["moisture_coating"] + inner_price["food_coating"]
+
+    features = requirements.get("special_features", {})
+    table = kernel["features"]
+    features_price = {
+        "gloss_coating": 0,
+        "matte_coating": 0,
+        "emboss": {"block": 0, "per_box": 0, "total": 0},
+        "foil": {"block": 0, "per_box": 0, "total": 0},
+        "grand_total": 0,
+    }
+    if features:
+        for key in ("gloss_coating", "matte_coating"):
+            if features.get(key) and features[key] in table[key]:
+                features_price[key] = round(table[key][features[key]] * quantity, 2)
+        emboss = features.get("emboss", {})
+        if emboss.get("type"):
+            features_price["emboss"]["block"] = 0 if emboss.get("has_block") else table["emboss"]["block"]
+            features_price["emboss"]["per_box"] = round(table["emboss"]["per_unit"] * quantity, 2)
+            features_price["emboss"]["total"] = features_price["emboss"]["block"] + features_price["emboss"]["per_box"]
+        foil = features.get("foil", {})
+        foil_type = foil.get("type")
+        if foil_type:
+            foil_table = table["foil"]
+            tier = next((t for keyword, t in foil_table["tier_keywords"] if keyword in str(foil_type)),
+                        foil_table["default_tier"])
+            unit = foil_table["per_unit"][tier]
+            if not foil.get("has_block"):
+                features_price["foil"]["block"] = foil_table["block"].get(foil_type, foil_table["default_block"])
+            features_price["foil"]["per_box"] = round(unit * quantity, 2)
+            features_price["foil"]["total"] = features_price["foil"]["block"] + features_price["foil"]["per_box"]
+        features_price["grand_total"] = (
+            features_price["gloss_coating"] + features_price["matte_coating"]
+            + features_price["emboss"]["total"] + features_price["foil"]["total"]
+        )
+
+    grand_total = box_total + inner_price["total"] + features_price["grand_total"]
+    return {
+        "material": material,
+        "pricing": {
+            "factor": kernel["factor"],
+            "box_price_per_unit": round(price_per_box, 2),
+            "box_total": box_total,
+            "inner_breakdown": inner_price,
+            "inner_total": inner_price["total"],
+            "features_breakdown": features_price,
+            "features_total": features_price["grand_total"],
+            "grand_total": round(grand_total, 2),
+            "price_per_unit": round(grand_total / quantity, 2),
+        },
+    }
+
+def verify_kernel_quote(request: KernelVerifyRequest) -> Dict[str, Any]:
+    """ใบเสนอราคาจริงจาก generate_quotation + ผลเทียบกับ kernel/ยอดที่ client คิด"""
+    requirements = request.requirements
+    dimensions = requirements.get("dimensions", {"width": 10, "length": 10, "height": 10})
+    try:
+        kernel = build_pricing_kernel(
+            _as_number(dimensions.get("width", 10)), _as_number(dimensions.get("length", 10)),
+            _as_number(dimensions.get("height", 10)), requirements.get("box_type", "RSC"),
+        )
+    except TypeError as e:
+        raise ValueError(f"dimensions: {e}") from None
+    quotation = generate_quotation(requirements)
+    pricing = quotation["pricing"]
+    mismatches = {}
+    for field, value in (("grand_total", request.grand_total), ("price_per_unit", request.price_per_unit)):
+        if value is not None and value != pricing[field]:
+            mismatches[field] = {"client": value, "server": pricing[field]}
+    current = request.checksum == kernel["checksum"]
     return {
-        "base_box_prices": BASE_BOX_PRICES,
-        "inner_prices": INNER_PRICES,
-        "moisture_coating_prices": MOISTURE_COATING_PRICES,
-        "food_coating_prices": FOOD_COATING_PRICES,
-        "gloss_coating_prices": GLOSS_COATING_PRICES,
-        "matte_coating_prices": MATTE_COATING_PRICES,
-        "emboss_prices": EMBOSS_PRICES,
-        "foil_block_prices": FOIL_BLOCK_PRICES,
-        "foil_per_box_prices": FOIL_PER_BOX_PRICES,
-        "product_type_materials": PRODUCT_TYPE_MATERIALS
-    }
\ No newline at end of file
+        # False เมื่อราคาเปลี่ยน (catalog ใหม่) หรือ kernel เป็นของขนาด/ชนิดกล่องอื่น ให้โหลด kernel ใหม่
+        "kernel_current": current,
+        "checksum": kernel["checksum"],
+        "valid": current and not mismatches,
+        "mismatches": mismatches,
+        "quotation": quotation,
+    }
+
+def extract_json_from_response(response_text: str) -> Dict[str, Any]:
+    return parse_model_reply(response_text)[1]
+
+def clean_response(response_text: str) -> str:
+    return parse_model_reply(response_text)[0]
+
+def parse_model_reply(response_text: str) -> Tuple[str, Dict[str, Any], str]:
+    """แยกคำตอบเต็มในรอบเดียว: (ข้อความที่แสดงได้, extracted_data, สถานะ ดู ExtractedDataFilter.status)"""
+    parser = ExtractedDataFilter()
+    text = parser.feed(response_text) + parser.close()
+    return text.strip(), parser.data, parser.status
+
+_PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+def repair_json(text: str) -> Optional[Any]:
+    """ซ่อม JSON ที่โมเดลส่งมาไม่ครบ/ไม่ถูก ด้วยการ scan รอบเดียว (เวลาเชิงเส้น)
+
+    - ปิดวงเล็บที่ค้าง (คำตอบถูกตัด) ถ้ายังไม่ได้ ตัดกลับไปที่ค่าสุดท้ายที่สมบูรณ์
+      (string/ตัวเลขที่ถูกตัดกลางคำถูกทิ้ง ไม่เดาค่า)
+    - ตัด comma เกิน, ใช้วงเล็บปิดที่ถูกแทนตัวที่ผิด, True/False/None -> true/false/null
+    - ข้อความหลังวงเล็บปิดตัวนอกสุดไม่สนใจ
+    """
+    start = text.find("{")
+    if start < 0:
+        return None
+    out: List[str] = []
+    word: List[str] = []
+    # stack เป็น linked list (วงเล็บปิด, ชั้นนอก) จุดตัดจึงจำ stack ณ ตอนนั้นได้โดยไม่ต้อง copy
+    stack: Optional[tuple] = None
+    last = ""
+    in_string = escape = is_key = False
+    cut = (0, None)  # จุดตัดล่าสุดที่ JSON ยังสมบูรณ์: (จำนวนชิ้นใน out, stack)
+
+    def flush_word():
+        nonlocal last
+        if word:
+            token = "".join(word)
+            out.append(_PYTHON_LITERALS.get(token, token))
+            word.clear()
+            last = "w"
+
+    for ch in text[start:]:
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+                last = '"'
+                out.append(ch)
+                if not is_key:
+                    cut = (len(out), stack)
+                continue
+            out.append("\\n" if ch == "\n" else ch)
+            continue
+        if ch == '"':
+            flush_word()
+            is_key = stack is not None and stack[0] == "}" and last in "{,"
+            in_string = True
+            out.append(ch)
+        elif ch in "{[":
+            flush_word()
+            stack = ("}" if ch == "{" else "]", stack)
+            out.append(ch)
+            last = ch
+            cut = (len(out), stack)
+        elif ch in "}]":
+            flush_word()
+            if last == ",":
+                out.pop()
+            closer, stack = stack
+            out.append(closer)
+            last = "}"
+            if stack is None:
+                break
+            cut = (len(out), stack)
+        elif ch == ",":
+            flush_word()
+            if last in ",{[":
+                continue
+            cut = (len(out), stack)
+            out.append(ch)
+            last = ch
+        elif ch == ":":
+            flush_word()
+            out.append(ch)
+            last = ch
+        elif ch.isspace():
+            flush_word()
+        else:
+            word.append(ch)
+
+    def closers(node: Optional[tuple]) -> str:
+        chars = []
+        while node is not None:
+            chars.append(node[0])
+            node = node[1]
+        return "".join(chars)
+
+    candidates = ["".join(out[:cut[0]]) + closers(cut[1])]
+    if not in_string and not word:
+        candidates.insert(0, "".join(out) + closers(stack))
+    for candidate in candidates:
+        try:
+            return json.loads(candidate)
+        except (json.JSONDecodeError, RecursionError):
+            pass
+    return None
+
+def _error_target(data: Any, loc: tuple) -> Optional[tuple]:
+    """(container, key) ของค่าที่ validate ไม่ผ่าน (loc ของ Union มีชื่อชนิดต่อท้าย จึงเดินเท่าที่มีจริง)"""
+    target, current = None, data
+    for part in loc:
+        if isinstance(current, dict) and part in current:
+            target, current = (current, part), current[part]
+        elif isinstance(current, list) and isinstance(part, int) and 0 <= part < len(current):
+            target, current = (current, part), current[part]
+        else:
+            break
+    return target
+
+def validate_extracted_data(raw: Any) -> Tuple[Dict[str, Any], bool]:
+    """ตรวจกับ ExtractedData คืน (ข้อมูลที่แปลงชนิดแล้ว เฉพาะ key ที่โมเดลส่งมา, มี field ถูกตัดทิ้งหรือไม่)"""
+    if not isinstance(raw, dict):
+        return {}, True
+    data, dropped = raw, False
+    for _ in range(4):
+        try:
+            return ExtractedData.model_validate(data).model_dump(exclude_unset=True), dropped
+        except ValidationError as e:
+            if not dropped:
+                data, dropped = copy.deepcopy(data), True
+            targets = {}
+            for error in e.errors():
+                target = _error_target(data, error["loc"])
+                if target:
+                    targets[(id(target[0]), target[1])] = target
+            # ลบ index ของ list จากท้ายไปหน้า ไม่ให้ตำแหน่งเลื่อน
+            for container, key in sorted(targets.values(), key=lambda t: t[1] if isinstance(t[1], int) else 0, reverse=True):
+                del container[key]
+    return {}, True
+
+def parse_extracted_block(block: str) -> Tuple[Dict[str, Any], str]:
+    """JSON ใน <extracted_data> -> (data, "ok" | "repaired" | "failed")"""
+    start = block.find("{")
+    if start < 0:
+        return {}, "failed"
+    repaired = False
+    try:
+        # ทางปกติ: JSON ถูกต้อง (ยอมให้มีข้อความ/``` ต่อท้าย)
+        raw, _ = json.JSONDecoder().raw_decode(block, start)
+    except (json.JSONDecodeError, RecursionError):
+        raw, repaired = repair_json(block), True
+    if raw is None:
+        return {}, "failed"
+    try:
+        data, dropped = validate_extracted_data(raw)
+    except RecursionError:
+        return {}, "failed"
+    if not data and (raw or repaired):
+        return {}, "failed"
+    return data, "repaired" if repaired or dropped else "ok"
+
+extraction_stats = {"replies": 0, "ok": 0, "repaired": 0, "failed": 0, "missing": 0}
+_extraction_stats_lock = threading.Lock()
+
+def record_extraction_stats(status: str) -> None:
+    with _extraction_stats_lock:
+        extraction_stats["replies"] += 1
+        extraction_stats[status] += 1
+    EXTRACTION_RESULTS.inc(status)
+
+def extraction_summary() -> Dict[str, Any]:
+    stats = dict(extraction_stats)
+    stats["failure_ratio"] = round((stats["failed"] + stats["missing"]) / stats["replies"], 4) if stats["replies"] else 0.0
+    return stats
+
+class ExtractedDataFilter:
+    """แยก <extracted_data> ออกจาก stream ของข้อความทีละ chunk
+
+    feed() คืนข้อความที่แสดงให้ผู้ใช้ได้ทันที ส่วนที่อาจเป็นจุดเริ่มของแท็กจะถูกกักไว้
+    จนกว่าจะรู้แน่ เมื่อแท็กปิดจะ parse JSON ทันทีเก็บไว้ใน self.data
+    block แรกที่ใช้ได้เป็นคำตอบ block อื่นถูกตัดออกจากข้อความเช่นกัน ถ้า stream จบทั้งที่แท็กยังไม่ปิด
+    (คำตอบถูกตัด) close() จะซ่อม JSON ที่มาถึงแล้วแทน
+    status: "ok" | "repaired" | "failed" (มี block แต่ใช้ไม่ได้) | "missing" (ไม่มี block)
+    """
+    OPEN_TAG = "<extracted_data>"
+    CLOSE_TAG = "</extracted_data>"
+
+    def __init__(self):
+        self.data: Dict[str, Any] = {}
+        self.status = "missing"
+        self._pending = ""
+        self._block: Optional[List[str]] = None
+        self._started = False
+
+    def feed(self, chunk: str) -> str:
+        self._pending += chunk
+        visible = []
+        while self._pending:
+            if self._block is None:
+                index = self._pending.find(self.OPEN_TAG)
+                # แท็กปิดที่ไม่มีแท็กเปิด (แท็กเปิดเสีย) ตัดทิ้งเฉพาะตัวแท็ก
+                orphan = self._pending.find(self.CLOSE_TAG, 0, index if index >= 0 else len(self._pending))
+                if orphan >= 0:
+                    visible.append(self._pending[:orphan])
+                    self._pending = self._pending[orphan + len(self.CLOSE_TAG):]
+                    continue
+                if index >= 0:
+                    visible.append(self._pending[:index])
+                    self._pending = self._pending[index + len(self.OPEN_TAG):]
+                    self._block = []
+                    continue
+                keep = max(_partial_tag_length(self._pending, self.OPEN_TAG),
+                           _partial_tag_length(self._pending, self.CLOSE_TAG))
+                visible.append(self._pending[:len(self._pending) - keep])
+                self._pending = self._pending[len(self._pending) - keep:]
+                break
+            index = self._pending.find(self.CLOSE_TAG)
+            if index < 0:
+                keep = _partial_tag_length(self._pending, self.CLOSE_TAG)
+                self._block.append(self._pending[:len(self._pending) - keep])
+                self._pending = self._pending[len(self._pending) - keep:]
+                break
+            self._block.append(self._pending[:index])
+            self._pending = self._pending[index + len(self.CLOSE_TAG):]
+            self._close_block("".join(self._block))
+            self._block = None
+        return self._visible("".join(visible))
+
+    def close(self) -> str:
+        """จบ stream: ข้อความที่ค้างอยู่ (ที่ไม่ใช่ block ค้าง) ส่งออกทั้งหมด"""
+        if self._block is not None:
+            self._close_block("".join(self._block) + self._pending)
+            self._block = None
+            rest = ""
+        else:
+            rest = self._pending
+        self._pending = ""
+        return self._visible(rest)
+
+    def _close_block(self, block: str) -> None:
+        if self.data:
+            return
+        self.data, self.status = parse_extracted_block(block)
+
+    def _visible(self, text: str) -> str:
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
+
+def _partial_tag_length(text: str, tag: str) -> int:
+    """ความยาวท้ายข้อความที่เป็นส่วนต้นของ tag (อาจเป็นแท็กที่ยังมาไม่ครบ)"""
+    for size in range(min(len(text), len(tag) - 1), 0, -1):
+        if tag.startswith(text[-size:]):
+            return size
+    return 0
+
+# ==================== REQUEST COALESCING ====================
+try:
+    import orjson
+except ImportError:  # ไม่มี orjson ใช้ json ของ standard library แทน (ช้ากว่า)
+    orjson = None
+
+def encode_json(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def parse_json_body(body: bytes, adapter: TypeAdapter) -> Any:
+    """validate body ดิบแบบเดียวกับที่ FastAPI ทำให้ (422 รูปแบบเดิม)"""
+    try:
+        return adapter.validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+        )
+
+class SingleFlight:
+    """request ที่ key เดียวกันและมาพร้อมกันรอผลคำนวณครั้งเดียวกัน แล้วเก็บ body ที่ encode แล้วไว้ใน LRU
+
+    key = scope + sha256 ของ request body (ไม่เก็บ body ดิบ) body เกิน max_body_bytes ไม่ coalesce
+    compute เป็นฟังก์ชัน sync ที่คืน bytes รันใน threadpool ไม่บล็อก event loop
+    เรียกจาก event loop เท่านั้น (dict ทั้งสองจึงไม่ต้องมี lock) error ไม่ถูกเก็บ request ถัดไปคำนวณใหม่
+    """
+
+    def __init__(self, max_size: int, enabled: bool = True, max_body_bytes: int = 16384):
+        self.max_size = max_size
+        self.enabled = enabled
+        self.max_body_bytes = max_body_bytes
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "too_large": 0}
+        self._bodies: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+
+    async def run(self, scope: tuple, request_body: bytes, compute: Callable[[], bytes]) -> bytes:
+        if not self.enabled:
+            return await run_in_threadpool(compute)
+        if len(request_body) > self.max_body_bytes:
+            self.stats["too_large"] += 1
+            return await run_in_threadpool(compute)
+        key = (*scope, hashlib.sha256(request_body).digest())
+        body = self._bodies.get(key)
+        if body is not None:
+            self._bodies.move_to_end(key)
+            self.stats["hits"] += 1
+            return body
+        task = self._inflight.get(key)
+        if task is None:
+            self.stats["misses"] += 1
+            task = self._inflight[key] = asyncio.ensure_future(self._compute(key, compute))
+        else:
+            self.stats["coalesced"] += 1
+        # shield: client ที่ตัดการเชื่อมต่อไม่ยกเลิกงานที่คนอื่นรออยู่
+        return await asyncio.shield(task)
+
+    async def _compute(self, key: tuple, compute: Callable[[], bytes]) -> bytes:
+        try:
+            body = await run_in_threadpool(compute)
+        finally:
+            del self._inflight[key]
+        if self.max_size:
+            self._bodies[key] = body
+            while len(self._bodies) > self.max_size:
+                self._bodies.popitem(last=False)
+        return body
+
+    def clear(self) -> None:
+        self._bodies.clear()
+
+    def summary(self) -> Dict[str, Any]:
+        stats = {**self.stats, "size": len(self._bodies), "max_size": self.max_size, "enabled": self.enabled}
+        requests = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["computed_ratio"] = round(stats["misses"] / requests, 3) if requests else 0.0
+        return stats
+
+coalesced_responses = SingleFlight(RESPONSE_BODY_CACHE_SIZE, COALESCE_REQUESTS, COALESCE_MAX_BODY_BYTES)
+
+def json_body_schema(schema: Dict[str, Any]) -> Dict[str, Any]:
+    """openapi_extra ของ endpoint ที่อ่าน body ดิบเอง (ให้ /docs ยังแสดง schema เดิม)"""
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": schema}}}}
+
+_REQUIREMENTS_BODY = TypeAdapter(Dict[str, Any])
+_BOX_DESIGN_BODY = TypeAdapter(BoxDesign)
+
+# ==================== ENDPOINTS ====================
+@app.get("/")
+def read_root():
+    return {"message": "Hello! LumoPack Brain is ready 🧠"}
+
+@app.get("/health")
+def health_check():
+    return {
+        "status": "healthy",
+        "gemini_configured": bool(GEMINI_API_KEY),
+        "catalog_version": pricing_catalog.version,
+        "prompt_context": dict(context_stats),
+        "fast_path": fast_path_summary(),
+        "extraction": extraction_summary(),
+        "response_cache": chat_response_cache.summary(),
+        "quotation_cache": quotation_cache.stats(),
+        "coalesced_responses": coalesced_responses.summary(),
+        "quotation_store": quotation_store.summary(),
+        "model_router": model_router.summary(),
+    }
+
+@app.get("/metrics")
+def metrics():
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/metrics/profiler")
+def profiler_status():
+    return profiler.summary()
+
+@app.post("/metrics/profiler")
+def toggle_profiler(request: ProfilerRequest):
+    if not PROFILER_ALLOWED:
+        raise HTTPException(status_code=403, detail="Profiler is disabled (set PROFILER_ALLOWED=1 to enable)")
+    if request.enabled:
+        if not PROFILER_MIN_INTERVAL_MS <= request.interval_ms <= 1000:
+            raise HTTPException(status_code=400,
+                                detail=f"interval_ms must be between {PROFILER_MIN_INTERVAL_MS:g} and 1000")
+        if request.duration_seconds is not None and not 0 < request.duration_seconds <= 3600:
+            raise HTTPException(status_code=400, detail="duration_seconds must be between 0 and 3600")
+        profiler.start(request.interval_ms / 1000, request.duration_seconds)
+    else:
+        profiler.stop()
+    return profiler.summary()
+
+@app.get("/metrics/profile")
+def profiler_stacks():
+    """stack แบบ collapsed เรียงตามจำนวน sample (ส่งต่อให้ flamegraph.pl / speedscope ได้)"""
+    return Response(profiler.collapsed(), media_type="text/plain; charset=utf-8")
+
+def safety_status(safety_score: float) -> str:
+    if safety_score < SAFETY_WARNING:
+        return "DANGER"
+    if safety_score < SAFETY_SAFE:
+        return "WARNING"
+    return "SAFE"
+
+def analyze_box(design: BoxDesign):
+    spec = FLUTE_SPECS.get(design.flute_type, FLUTE_SPECS["C"])
+    
+    perimeter_inch = 2 * (design.length + design.width) * 0.3937
+    bct_lbs = 5.87 * spec["ect"] * ((spec["thickness"] * 0.03937 * perimeter_inch) ** 0.5)
+    max_load_kg = bct_lbs * 0.453592
+    
+    stack_load = design.weight * 4
+    safety_score = max_load_kg / stack_load if stack_load > 0 else 100
+    status = safety_status(safety_score)
+
+    return {
+        "max_load_kg": round(max_load_kg, 2),
+        "current_load": stack_load,
+        "safety_score": round(safety_score, 2),
+        "status": status,
+        "recommendation": "Switch to Flute BC (Double Wall)" if status == "DANGER" else "Design is optimal (Safe)."
+    }
+
+@app.post("/analyze", openapi_extra=json_body_schema(BoxDesign.model_json_schema()))
+async def analyze(request: Request):
+    body = await request.body()
+    content = await coalesced_responses.run(
+        ("analyze",), body, lambda: encode_json(analyze_box(parse_json_body(body, _BOX_DESIGN_BODY))))
+    return Response(content=content, media_type="application/json")
+
+# ==================== STRUCTURAL SWEEP ====================
+# สูตรเดียวกับ analyze_box แต่คำนวณทุก flute x ทุกขนาดใน NumPy รอบเดียว ให้ UI วาด heatmap จาก response เดียว
+# max_load ขึ้นกับเส้นรอบรูป (length + width) และ flute เท่านั้น ส่วน safety ขึ้นกับน้ำหนักด้วย
+
+def _flutes_by_board_cost() -> List[str]:
+    """flute เรียงจากถูกไปแพง: ใช้ความหนาแทนปริมาณกระดาษต่อกล่อง (พื้นที่เท่ากันในช่องเดียวกัน)"""
+    return sorted(FLUTE_SPECS, key=lambda name: FLUTE_SPECS[name]["thickness"])
+
+def _sweep_axis(name: str, axis: Optional[SweepRange]) -> SweepRange:
+    if axis is None:
+        raise ValueError(f"{name} range is required when designs is empty")
+    return axis
+
+def flute_max_load(length: np.ndarray, width: np.ndarray, flutes: List[str]) -> np.ndarray:
+    """max_load_kg ไม่ปัดเศษ รูปร่าง (flute, *length.shape)"""
+    ect = np.array([FLUTE_SPECS[f]["ect"] for f in flutes]).reshape((-1,) + (1,) * length.ndim)
+    thickness = np.array([FLUTE_SPECS[f]["thickness"] for f in flutes]).reshape(ect.shape)
+    perimeter_inch = 2 * (length + width) * 0.3937
+    bct_lbs = 5.87 * ect * ((thickness * 0.03937 * perimeter_inch) ** 0.5)
+    return bct_lbs * 0.453592
+
+def flute_safety(max_load: np.ndarray, stack_load: np.ndarray) -> np.ndarray:
+    """safety_score ไม่ปัดเศษ (stack_load เป็น 0 ได้ 100 เหมือน analyze_box)"""
+    loaded = stack_load > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(loaded, max_load / np.where(loaded, stack_load, 1), 100.0)
+
+def cheapest_safe_flute(safety: np.ndarray, flutes: List[str]) -> np.ndarray:
+    """flute ที่ถูกที่สุดที่ยัง SAFE ในแต่ละช่อง (None ถ้าไม่มี) โดย flutes ต้องเรียงจากถูกไปแพง"""
+    safe = safety >= SAFETY_SAFE
+    names = np.array(flutes + [None], dtype=object)
+    first = np.where(safe.any(axis=0), safe.argmax(axis=0), len(flutes))
+    return names[first]
+
+def analyze_sweep(request: SweepRequest) -> Dict[str, Any]:
+    flutes = _flutes_by_board_cost()
+
+    if request.designs:
+        cells = len(flutes) * len(request.designs)
+    else:
+        axes = [_sweep_axis(name, getattr(request, name)) for name in ("length", "width", "weight")]
+        # math.prod บน int ของ Python ไม่ overflow (np.prod เป็น int64 วนกลับเป็นค่าเล็กได้)
+        cells = len(flutes) * math.prod(axis.steps for axis in axes)
+    # ตรวจขนาดก่อนสร้าง array เพื่อไม่ให้ request เดียวกินหน่วยความจำ
+    if cells > SWEEP_MAX_CELLS:
+        raise ValueError(f"sweep has {cells} cells, limit is {SWEEP_MAX_CELLS}")
+
+    if request.designs:
+        length = np.array([d.length for d in request.designs], dtype=float)
+        width = np.array([d.width for d in request.designs], dtype=float)
+        weight = np.array([d.weight for d in request.designs], dtype=float)
+    else:
+        length, width, weight = (np.linspace(axis.start, axis.stop, axis.steps) for axis in axes)
+        length, width = length[:, None], width[None, :]
+
+    if (length <= 0).any() or (width <= 0).any():
+        raise ValueError("length and width must be positive")
+    if (weight < 0).any():
+        raise ValueError("weight must not be negative")
+
+    stack_load = weight * 4
+    max_load = flute_max_load(length, width, flutes)                # (flute, design) หรือ (flute, length, width)
+    if request.designs:
+        safety = flute_safety(max_load, stack_load)                  # (flute, design)
+    else:
+        safety = flute_safety(max_load[:, None], stack_load[:, None, None])  # (flute, weight, length, width)
+
+    max_load_rounded = _round_array(max_load)
+    safety_rounded = _round_array(safety)
+    result = {
+        "flutes": flutes,
+        "safe_threshold": SAFETY_SAFE,
+        "warning_threshold": SAFETY_WARNING,
+        "current_load": stack_load.tolist(),
+        "max_load_kg": dict(zip(flutes, max_load_rounded.tolist())),
+        "safety_score": dict(zip(flutes, safety_rounded.tolist())),
+        "cheapest_safe_flute": cheapest_safe_flute(safety, flutes).tolist(),
+    }
+    if not request.designs:
+        result["axes"] = {
+            "length": length.ravel().tolist(),
+            "width": width.ravel().tolist(),
+            "weight": weight.tolist(),
+        }
+    return result
+
+@app.post("/analyze/sweep")
+def analyze_sweep_endpoint(request: SweepRequest):
+    try:
+        return analyze_sweep(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# ==================== BOX OPTIMIZER ====================
+# หาแบบกล่องที่ถูกและแข็งแรงพอ: ค้นทุก box_type x วัสดุ x flute x ขนาด (ภายใน tolerance) ใน NumPy รอบเดียว
+# ราคาแผ่นลูกฟูกใน catalog คิดที่ความหนาของวัสดุ (0.25 cm = flute B) ส่วนค่ากระดาษแปรตามความหนา
+# จึงปรับเป็น labor + (cost - labor) x ความหนา flute / ความหนาใน catalog (flute B ได้ราคาเท่า quotation เดิม)
+# ความสูงไม่มีผลกับ BCT ในสูตรนี้ เพิ่มความสูงมีแต่แพงขึ้น จึงใช้ความสูงขั้นต่ำเสมอ
+
+def flute_board_price(board: tuple, flute_type: str) -> float:
+    cost, labor, thickness = board
+    return labor + (cost - labor) * (FLUTE_SPECS[flute_type]["thickness"] / 10) / thickness
+
+def _narrowest_per_perimeter(lengths: np.ndarray, widths: np.ndarray) -> tuple:
+    """ขนาดที่ length + width เท่ากันมี BCT เท่ากัน แบบที่ length x width น้อยสุดถูกที่สุดเสมอ
+    จึงเหลือแบบเดียวต่อผลรวมหนึ่งค่า (อยู่ที่ขอบ grid) จาก n x m เหลือ n + m - 1"""
+    total = np.arange(lengths.size + widths.size - 1)
+    low = np.maximum(0, total - widths.size + 1)
+    high = np.minimum(total, lengths.size - 1)
+    low_area = lengths[low] * widths[total - low]
+    high_area = lengths[high] * widths[total - high]
+    pick = np.where(high_area < low_area, high, low)
+    return lengths[pick], widths[total - pick]
+
+def _optimizer_choices(request: OptimizeRequest, tables: Dict[str, Any]) -> List[tuple]:
+    """(box_type, material, board) ทุกคู่ที่ค้นได้"""
+    box_types = request.box_types or list(tables["board"])
+    materials = request.materials or list(FLUTED_MATERIALS)
+    choices = []
+    unknown = [box_type for box_type in box_types if box_type not in tables["board"]]
+    if unknown:
+        raise ValueError(f"unknown box types: {unknown}")
+    for box_type in box_types:
+        board_prices = tables["board"][box_type]
+        for material in materials:
+            board = board_prices.get(material)
+            if material not in FLUTED_MATERIALS or board is None or board[2] <= 0:
+                raise ValueError(f"{material} on {box_type} has no flute strength data")
+            choices.append((box_type, material, board))
+    return choices
+
+def optimize_box(request: OptimizeRequest) -> Dict[str, Any]:
+    tables = pricing_catalog.tables
+    flutes = request.flutes or _flutes_by_board_cost()
+    unknown = [f for f in flutes if f not in FLUTE_SPECS]
+    if unknown:
+        raise ValueError(f"unknown flute types: {unknown}")
+    if min(request.length, request.width, request.height) <= 0:
+        raise ValueError("length, width and height must be positive")
+    if request.product_weight < 0 or request.stack_height < 1 or request.quantity < 1:
+        raise ValueError("product_weight must not be negative, stack_height and quantity must be at least 1")
+    if request.tolerance < 0 or request.tolerance_step <= 0:
+        raise ValueError("tolerance must not be negative and tolerance_step must be positive")
+    min_safety = SAFETY_SAFE if request.min_safety is None else request.min_safety
+
+    choices = _optimizer_choices(request, tables)
+    steps = int(np.floor(request.tolerance / request.tolerance_step + 1e-9)) + 1
+    searched = len(choices) * len(flutes) * steps * steps
+    evaluated = len(choices) * len(flutes) * (2 * steps - 1)
+    if evaluated > OPTIMIZE_MAX_CANDIDATES:
+        raise ValueError(f"search needs {evaluated} evaluations, limit is {OPTIMIZE_MAX_CANDIDATES}")
+    lengths = request.length + np.arange(steps) * request.tolerance_step
+    widths = request.width + np.arange(steps) * request.tolerance_step
+
+    # 1) ความแข็งแรง (flute, ขนาด) ไม่ขึ้นกับ box_type/วัสดุ
+    lengths, widths = _narrowest_per_perimeter(lengths, widths)
+    stack_load = request.product_weight * request.stack_height
+    max_load = flute_max_load(lengths, widths, flutes)
+    safety = flute_safety(max_load, np.asarray(stack_load, dtype=float))
+
+    # 2) ตัดแบบที่ไม่ถึง min_safety ก่อนคิดราคา
+    flute_idx, size_idx = np.nonzero(safety >= min_safety)
+
+    # 3) ราคาต่อกล่อง (choice, แบบที่ผ่าน) ลำดับการคำนวณเหมือน calculate_box_price
+    width_cm, length_cm, height_cm = widths[size_idx], lengths[size_idx], request.height
+    surface_area = 2 * ((width_cm * length_cm) + (width_cm * height_cm) + (length_cm * height_cm))
+    production = np.array([1.1 if box_type == "RSC" else 1.5 for box_type, _, _ in choices])[:, None]
+    raw_factor = np.maximum(1.0, (surface_area * production) / (600 * production))
+    board_price = np.array([[flute_board_price(board, f) for f in flutes] for _, _, board in choices])
+    raw_price = (board_price[:, flute_idx] * raw_factor).ravel()
+
+    # 4) Pareto front: เรียงตามราคา (เท่ากันเอา safety สูงก่อน) เก็บเฉพาะแบบที่ safety สูงกว่าทุกแบบที่ถูกกว่า
+    choice_idx = np.repeat(np.arange(len(choices)), flute_idx.size)
+    cell_idx = np.tile(np.arange(flute_idx.size), len(choices))
+    flat_price = _round_array(raw_price)
+    flat_safety = safety[flute_idx, size_idx][cell_idx]
+    order = np.lexsort((-flat_safety, flat_price))
+    best_before = np.maximum.accumulate(np.concatenate(([-np.inf], flat_safety[order])))[:-1]
+    front = order[flat_safety[order] > best_before]
+
+    results = []
+    for i in front.tolist():
+        box_type, material, _ = choices[choice_idx[i]]
+        cell = cell_idx[i]
+        f, size = flute_idx[cell], size_idx[cell]
+        score = float(safety[f, size])
+        results.append({
+            "box_type": box_type,
+            "material": material,
+            "flute_type": flutes[f],
+            "dimensions": {"width": float(widths[size]), "length": float(lengths[size]), "height": request.height},
+            "max_load_kg": round(float(max_load[f, size]), 2),
+            "safety_score": round(score, 2),
+            "status": safety_status(score),
+            "price_per_box": float(flat_price[i]),
+            "total_price": round(float(raw_price[i]) * request.quantity, 2),
+        })
+
+    return {
+        "catalog_version": tables["version"],
+        "stack_load": stack_load,
+        "min_safety": min_safety,
+        "searched": searched,
+        "evaluated": evaluated,
+        "safe_candidates": int(flat_price.size),
+        "cheapest": results[0] if results else None,
+        "pareto_front": results,
+    }
+
+@app.post("/api/optimize")
+def optimize_box_endpoint(request: OptimizeRequest):
+    try:
+        return optimize_box(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# ==================== BULK QUOTATION JOBS ====================
+# ไฟล์ CSV/Parquet หลายหมื่นถึงหลักล้านแถว: เก็บไฟล์ลงดิสก์ แล้วคิดราคาทีละ chunk ใน thread แยก
+# หน่วยความจำใช้แค่ chunk เดียว ผลลัพธ์เขียนต่อท้ายไฟล์ทุก chunk และบันทึกตำแหน่งไว้ใน job.json
+# ถ้า process ตายหรือถูกยกเลิก สั่ง resume ต่อจาก chunk สุดท้ายที่เขียนเสร็จได้
+BULK_COLUMN_ALIASES = {
+    "width": "dimensions.width",
+    "length": "dimensions.length",
+    "height": "dimensions.height",
+    "cushioning": "inner.cushioning",
+    "moisture_coating": "inner.moisture_coating",
+    "food_coating": "inner.food_coating",
+    "gloss_coating": "special_features.gloss_coating",
+    "matte_coating": "special_features.matte_coating",
+    "emboss": "special_features.emboss.type",
+    "emboss_has_block": "special_features.emboss.has_block",
+    "foil": "special_features.foil.type",
+    "foil_has_block": "special_features.foil.has_block",
+}
+_BULK_NUMBER_FIELDS = {"dimensions.width", "dimensions.length", "dimensions.height", "quantity"}
+_BULK_FLAG_FIELDS = {"special_features.emboss.has_block", "special_features.foil.has_block"}
+_BULK_FIELDS = {"product_type", "box_type", "quantity", *BULK_COLUMN_ALIASES.values()}
+_BULK_TRUE = {"1", "true", "yes", "y", "ใช่", "มี"}
+_BULK_FALSE = {"0", "false", "no", "n", "ไม่", "ไม่มี"}
+
+# คอลัมน์ที่เติมต่อท้ายทุกแถว (pricing.* ตามโครงสร้าง pricing ของ generate_quotation)
+BULK_PRICING_COLUMNS = (
+    "factor", "box_price_per_unit", "box_total",
+    "inner_breakdown.cushioning", "inner_breakdown.moisture_coating", "inner_breakdown.food_coating", "inner_total",
+    "features_breakdown.gloss_coating", "features_breakdown.matte_coating",
+    "features_breakdown.emboss.block", "features_breakdown.emboss.per_box", "features_breakdown.emboss.total",
+    "features_breakdown.foil.block", "features_breakdown.foil.per_box", "features_breakdown.foil.total",
+    "features_total", "grand_total", "price_per_unit",
+)
+BULK_OUTPUT_COLUMNS = ("material", "catalog_version", *(f"pricing.{c}" for c in BULK_PRICING_COLUMNS), "error")
+
+_BULK_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+_bulk_executor = ThreadPoolExecutor(max_workers=BULK_MAX_JOBS, thread_name_prefix="bulk-quotation")
+bulk_jobs: Dict[str, "BulkQuotationJob"] = {}
+_bulk_jobs_lock = threading.Lock()
+
+def _bulk_number(value: Any) -> Union[int, float]:
+    if isinstance(value, bool):
+        raise ValueError(f"expected a number, got {value!r}")
+    number = float(value if isinstance(value, (int, float)) else str(value).strip().replace(",", ""))
+    if not math.isfinite(number):
+        raise ValueError(f"expected a number, got {value!r}")
+    return int(number) if number.is_integer() else number
+
+def _bulk_flag(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().casefold()
+    if text in _BULK_TRUE:
+        return True
+    if text in _BULK_FALSE:
+        return False
+    raise ValueError(f"expected yes/no, got {value!r}")
+
+def bulk_row_fields(columns: List[str]) -> List[tuple]:
+    """(ตำแหน่งคอลัมน์, path, ตัวแปลงค่า, key ของ dict ชั้นนอก, key สุดท้าย) ของคอลัมน์ที่มีผลต่อราคา
+    ชื่อคอลัมน์เป็น path แบบ dimensions.width หรือชื่อย่อใน BULK_COLUMN_ALIASES ก็ได้ คอลัมน์อื่นส่งผ่านไปเฉย ๆ"""
+    fields = []
+    for index, name in enumerate(columns):
+        path = BULK_COLUMN_ALIASES.get(name, name)
+        if path not in _BULK_FIELDS:
+            continue
+        convert = _bulk_number if path in _BULK_NUMBER_FIELDS else _bulk_flag if path in _BULK_FLAG_FIELDS else None
+        *parents, leaf = path.split(".")
+        fields.append((index, path, convert, tuple(parents), leaf))
+    return fields
+
+def bulk_row_requirements(fields: List[tuple], row: List[Any]) -> Dict[str, Any]:
+    requirements: Dict[str, Any] = {}
+    for index, path, convert, parents, leaf in fields:
+        value = row[index] if index < len(row) else None
+        if value is None or (isinstance(value, str) and not value.strip()):
+            continue
+        if convert is None:
+            value = value.strip() if isinstance(value, str) else value
+        else:
+            try:
+                value = convert(value)
+            except ValueError as e:
+                raise ValueError(f"{path}: {e}") from None
+        target = requirements
+        for key in parents:
+            target = target.setdefault(key, {})
+        target[leaf] = value
+    # แถวเดียวที่จำนวนเป็น 0 จะทำให้ทั้ง chunk คิดแบบ batch ไม่ได้ จึงตัดออกตั้งแต่ตอนอ่าน
+    if requirements.get("quantity", 500) == 0:
+        raise ValueError("quantity must not be zero")
+    return requirements
+
+_BULK_PRICING_PATHS = [tuple(path.split(".")) for path in BULK_PRICING_COLUMNS]
+
+def _pricing_values(pricing: Dict[str, Any]) -> List[Any]:
+    values = []
+    for path in _BULK_PRICING_PATHS:
+        value = pricing
+        for key in path:
+            value = value[key]
+        values.append(value)
+    return values
+
+def price_bulk_rows(fields: List[tuple], rows: List[List[Any]]) -> List[List[Any]]:
+    """คอลัมน์ BULK_OUTPUT_COLUMNS ของแต่ละแถว แถวที่คิดราคาไม่ได้มีแค่ช่อง error"""
+    parsed = []
+    for row in rows:
+        try:
+            parsed.append((bulk_row_requirements(fields, row), None))
+        except ValueError as e:
+            parsed.append((None, str(e)))
+
+    valid = [requirements for requirements, error in parsed if error is None]
+    try:
+        quotations = iter(generate_quotations_batch(valid))
+    except ValueError:
+        # มีแถวที่คำนวณไม่ได้ (เช่น quantity = 0) คิดทีละแถวเพื่อแยกแถวที่ผิดออก
+        quotations = None
+
+    blank = [""] * (len(BULK_OUTPUT_COLUMNS) - 1)
+    results = []
+    for requirements, error in parsed:
+        if error is None:
+            try:
+                quotation = next(quotations) if quotations is not None else generate_quotation(requirements)
+            except Exception as e:
+                error = str(e) or type(e).__name__
+        if error is not None:
+            results.append([*blank, error])
+            continue
+        results.append([quotation["material"], quotation["catalog_version"], *_pricing_values(quotation["pricing"]), ""])
+    return results
+
+def _pid_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class BulkQuotationJob:
+    """งานคิดราคาจากไฟล์ สถานะทั้งหมดอยู่ใน job.json ข้างไฟล์ input/output (worker อื่นอ่านได้)
+
+    status: queued | running | done | failed | cancelled | interrupted (process ที่รันอยู่ตายไป)
+    """
+
+    def __init__(self, job_id: str, state: Dict[str, Any]):
+        self.id = job_id
+        self.dir = os.path.join(BULK_JOB_DIR, job_id)
+        self.state = state
+        self._cancel = threading.Event()
+
+    @property
+    def input_path(self) -> str:
+        return os.path.join(self.dir, f"input.{self.state['format']}")
+
+    @property
+    def output_path(self) -> str:
+        return os.path.join(self.dir, "output.csv")
+
+    @classmethod
+    def create(cls, input_format: str) -> "BulkQuotationJob":
+        job = cls(uuid.uuid4().hex, {
+            "format": input_format,
+            "status": "uploading",
+            "created_at": time.time(),
+            "input_size": 0,
+            "total_rows": None,
+            "columns": None,
+            "input_position": 0,
+            "output_size": 0,
+            "chunks_done": 0,
+            "rows_done": 0,
+            "rows_failed": 0,
+            "elapsed_seconds": 0.0,
+            "error": None,
+            "pid": os.getpid(),
+        })
+        os.makedirs(job.dir)
+        return job
+
+    @classmethod
+    def load(cls, job_id: str) -> Optional["BulkQuotationJob"]:
+        try:
+            with open(os.path.join(BULK_JOB_DIR, job_id, "job.json"), encoding="utf-8") as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        job = cls(job_id, state)
+        # job.json บอกว่ารันอยู่ แต่ไม่มี process ไหนรันจริงแล้ว (worker ถูก restart)
+        if state["status"] in ("queued", "running") and (state["pid"] == os.getpid() or not _pid_alive(state["pid"])):
+            state["status"] = "interrupted"
+        return job
+
+    def save(self) -> None:
+        path = os.path.join(self.dir, "job.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def summary(self) -> Dict[str, Any]:
+        state = self.state
+        if state["total_rows"]:
+            progress = state["rows_done"] / state["total_rows"]
+        else:
+            progress = state["input_position"] / state["input_size"] if state["input_size"] else 0.0
+        if state["status"] == "done":
+            progress = 1.0
+        elapsed = state["elapsed_seconds"]
+        return {
+            "job_id": self.id,
+            **{k: v for k, v in state.items() if k not in ("columns", "input_position", "output_size", "pid")},
+            "progress": round(progress, 4),
+            "rows_per_second": round(state["rows_done"] / elapsed) if elapsed else 0,
+            "columns": len(state["columns"] or ()),
+        }
+
+    def submit(self) -> None:
+        self._cancel.clear()
+        self.state.update(status="queued", error=None, pid=os.getpid())
+        self.save()
+        with _bulk_jobs_lock:
+            bulk_jobs[self.id] = self
+        _bulk_executor.submit(self.run)
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def _read_header(self) -> Tuple[List[str], int]:
+        """(ชื่อคอลัมน์, ตำแหน่งแถวแรกของข้อมูล) ตำแหน่งของ CSV คือ byte offset ของ Parquet คือเลขแถว"""
+        if self.state["format"] == "parquet":
+            import pyarrow.parquet as pq
+
+            metadata = pq.ParquetFile(self.input_path).metadata
+            self.state["total_rows"] = metadata.num_rows
+            return list(metadata.schema.names), 0
+        with open(self.input_path, newline="", encoding="utf-8-sig") as f:
+            # อ่านผ่าน readline (ไม่ใช่ for line in f) เพื่อให้ f.tell() ใช้ได้
+            reader = csv.reader(iter(f.readline, ""))
+            header = next(reader, None)
+            if not header:
+                raise ValueError("file has no header row")
+            return [name.strip() for name in header], f.tell()
+
+    def _chunks(self):
+        """yield (แถวใน chunk, ตำแหน่งเริ่มของ chunk ถัดไป) ตั้งแต่ input_position"""
+        size = BULK_CHUNK_ROWS
+        position = self.state["input_position"]
+        if self.state["format"] == "parquet":
+            import pyarrow.parquet as pq
+
+            names = self.state["columns"]
+            skip = position
+            for batch in pq.ParquetFile(self.input_path).iter_batches(batch_size=size):
+                if skip >= batch.num_rows:
+                    skip -= batch.num_rows
+                    continue
+                if skip:
+                    batch, skip = batch.slice(skip), 0
+                columns = [batch.column(name).to_pylist() for name in names]
+                position += batch.num_rows
+                yield [list(row) for row in zip(*columns)], position
+            return
+
+        with open(self.input_path, newline="", encoding="utf-8-sig") as f:
+            f.seek(position)
+            reader = csv.reader(iter(f.readline, ""))
+            while True:
+                # range ก่อน reader: zip หยุดที่ range โดยไม่ดึงแถวถัดไปจาก reader ทิ้ง
+                rows = [row for _, row in zip(range(size), reader)]
+                if not rows:
+                    return
+                yield rows, f.tell()
+
+    def run(self) -> None:
+        state = self.state
+        started = time.perf_counter()
+        elapsed_before = state["elapsed_seconds"]
+        state["status"] = "running"
+        try:
+            if state["columns"] is None:
+                state["columns"], state["input_position"] = self._read_header()
+                with open(self.output_path, "w", newline="", encoding="utf-8-sig") as out:
+                    csv.writer(out).writerow([*state["columns"], *BULK_OUTPUT_COLUMNS])
+                    state["output_size"] = out.tell()
+            self.save()
+
+            columns = state["columns"]
+            fields = bulk_row_fields(columns)
+            # ตัดส่วนที่เขียนไปแล้วแต่ยังไม่ได้บันทึกใน job.json (ตายกลาง chunk) ทิ้งก่อนเขียนต่อ
+            os.truncate(self.output_path, state["output_size"])
+            with open(self.output_path, "a", newline="", encoding="utf-8-sig") as out:
+                writer = csv.writer(out)
+                for rows, position in self._chunks():
+                    if self._cancel.is_set():
+                        state["status"] = "cancelled"
+                        break
+                    priced = price_bulk_rows(fields, rows)
+                    # แถวที่คอลัมน์ไม่ครบเติมช่องว่าง ให้ผลลัพธ์อยู่ตรงคอลัมน์เสมอ
+                    width = len(columns)
+                    writer.writerows(
+                        [*row[:width], *[""] * (width - len(row)), *result] for row, result in zip(rows, priced)
+                    )
+                    out.flush()
+                    os.fsync(out.fileno())
+                    state.update(
+                        input_position=position,
+                        output_size=out.tell(),
+                        chunks_done=state["chunks_done"] + 1,
+                        rows_done=state["rows_done"] + len(rows),
+                        rows_failed=state["rows_failed"] + sum(1 for result in priced if result[-1]),
+                        elapsed_seconds=round(elapsed_before + time.perf_counter() - started, 3),
+                    )
+                    self.save()
+                else:
+                    state["status"] = "done"
+        except Exception as e:
+            logger.exception("Bulk quotation job %s failed", self.id)
+            state.update(status="failed", error=str(e) or type(e).__name__)
+        finally:
+            state["elapsed_seconds"] = round(elapsed_before + time.perf_counter() - started, 3)
+            self.save()
+
+    def parquet_output(self) -> str:
+        """แปลง output.csv เป็น Parquet ทีละ block (ทำครั้งเดียวต่อ job)"""
+        import pyarrow as pa
+        import pyarrow.csv as pacsv
+        import pyarrow.parquet as pq
+
+        path = os.path.join(self.dir, "output.parquet")
+        if os.path.exists(path):
+            return path
+        text_columns = [*self.state["columns"], "material", "catalog_version", "error"]
+        types = {name: pa.string() for name in text_columns}
+        types.update({f"pricing.{c}": pa.float64() for c in BULK_PRICING_COLUMNS})
+        reader = pacsv.open_csv(self.output_path, convert_options=pacsv.ConvertOptions(
+            column_types=types, strings_can_be_null=False))
+        with pq.ParquetWriter(path + ".tmp", reader.schema) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+        os.replace(path + ".tmp", path)
+        return path
+
+def get_bulk_job(job_id: str) -> BulkQuotationJob:
+    """job ที่รันอยู่ใน process นี้ใช้ object ในหน่วยความจำ (ยกเลิกได้) นอกนั้นอ่าน job.json ใหม่ทุกครั้ง
+    เพราะ worker อื่นอาจรันหรือ resume job เดียวกันอยู่"""
+    if not _BULK_JOB_ID.match(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    with _bulk_jobs_lock:
+        job = bulk_jobs.get(job_id)
+    if job is not None and job.state["status"] in ("queued", "running"):
+        return job
+    job = BulkQuotationJob.load(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+_BULK_ACTIVE = ("uploading", "queued", "running")
+
+def admit_bulk_job(job: BulkQuotationJob) -> None:
+    """จอง job เข้า bulk_jobs ถ้า job ที่ยังไม่จบใน process นี้ครบ BULK_MAX_ACTIVE_JOBS แล้วตอบ 429"""
+    with _bulk_jobs_lock:
+        active = sum(1 for other in bulk_jobs.values() if other.id != job.id and other.state["status"] in _BULK_ACTIVE)
+        if active >= BULK_MAX_ACTIVE_JOBS:
+            raise HTTPException(status_code=429, detail="Too many bulk jobs in progress, please retry later",
+                                headers={"Retry-After": "30"})
+        bulk_jobs[job.id] = job
+
+def _dir_usage(path: str) -> Tuple[int, float]:
+    """(ขนาดรวมของไฟล์, mtime ล่าสุดของ path และไฟล์ข้างใน)"""
+    try:
+        size, updated = 0, os.stat(path).st_mtime
+    except FileNotFoundError:
+        return 0, 0.0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            size += stat.st_size
+            updated = max(updated, stat.st_mtime)
+    return size, updated
+
+def sweep_bulk_jobs() -> int:
+    """ลบ job ที่ไม่ได้รันอยู่และไม่มีไฟล์ไหนถูกแก้นานเกิน BULK_JOB_RETENTION_HOURS คืนพื้นที่ที่ job ที่เหลือใช้ (bytes)
+
+    job ที่ไม่มี job.json คืออัปโหลดค้าง (process ตายระหว่างรับไฟล์) ลบเมื่อเก่าเกินเกณฑ์เหมือนกัน
+    """
+    try:
+        names = os.listdir(BULK_JOB_DIR)
+    except FileNotFoundError:
+        return 0
+    cutoff = time.time() - BULK_JOB_RETENTION_HOURS * 3600
+    with _bulk_jobs_lock:
+        active = {job_id for job_id, job in bulk_jobs.items() if job.state["status"] in _BULK_ACTIVE}
+    usage = 0
+    for job_id in names:
+        if not _BULK_JOB_ID.match(job_id):
+            continue
+        path = os.path.join(BULK_JOB_DIR, job_id)
+        size, updated = _dir_usage(path)
+        if job_id not in active and updated < cutoff:
+            job = BulkQuotationJob.load(job_id)
+            # load() เปลี่ยน job ที่ process เจ้าของตายไปแล้วเป็น interrupted ที่เหลือคือยังรันอยู่ใน worker อื่น
+            if job is None or job.state["status"] not in ("queued", "running"):
+                shutil.rmtree(path, ignore_errors=True)
+                with _bulk_jobs_lock:
+                    bulk_jobs.pop(job_id, None)
+                continue
+        usage += size
+    return usage
+
+def _require_parquet_support() -> None:
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise HTTPException(status_code=415, detail="Parquet needs pyarrow (pip install pyarrow); upload CSV instead")
+
+_UPLOAD_WRITE_BYTES = 1024 * 1024
+
+@app.post("/api/calculate-price/jobs", status_code=202)
+async def create_bulk_job(request: Request, format: str = "csv"):
+    """body คือไฟล์ CSV (แถวแรกเป็นหัวคอลัมน์) หรือ Parquet ทั้งไฟล์ เขียนลงดิสก์ระหว่างรับ ไม่เก็บในหน่วยความจำ"""
+    if format not in ("csv", "parquet"):
+        raise HTTPException(status_code=400, detail="format must be csv or parquet")
+    if format == "parquet":
+        _require_parquet_support()
+    disk_left = BULK_MAX_DISK_MB * 1024 * 1024 - await run_in_threadpool(sweep_bulk_jobs)
+    if disk_left <= 0:
+        raise HTTPException(status_code=507, detail="Bulk job storage is full; delete finished jobs or retry later")
+    job = BulkQuotationJob.create(format)
+    limit = BULK_MAX_UPLOAD_MB * 1024 * 1024
+    try:
+        admit_bulk_job(job)
+        # รวม chunk เล็ก ๆ ของ request แล้วเขียนทีละ _UPLOAD_WRITE_BYTES ใน threadpool ไม่ให้ดิสก์บล็อก event loop
+        f = await run_in_threadpool(open, job.input_path, "wb")
+        try:
+            buffer = bytearray()
+            async for chunk in request.stream():
+                job.state["input_size"] += len(chunk)
+                if job.state["input_size"] > limit:
+                    raise HTTPException(status_code=413, detail=f"File is larger than {BULK_MAX_UPLOAD_MB} MB")
+                if job.state["input_size"] > disk_left:
+                    raise HTTPException(status_code=507, detail="Bulk job storage is full")
+                buffer += chunk
+                if len(buffer) >= _UPLOAD_WRITE_BYTES:
+                    await run_in_threadpool(f.write, buffer)
+                    buffer.clear()
+            if buffer:
+                await run_in_threadpool(f.write, buffer)
+        finally:
+            await run_in_threadpool(f.close)
+        if not job.state["input_size"]:
+            raise HTTPException(status_code=400, detail="Empty upload")
+    except BaseException:
+        with _bulk_jobs_lock:
+            bulk_jobs.pop(job.id, None)
+        shutil.rmtree(job.dir, ignore_errors=True)
+        raise
+    job.submit()
+    return job.summary()
+
+@app.get("/api/calculate-price/jobs/{job_id}")
+def bulk_job_status(job_id: str):
+    return get_bulk_job(job_id).summary()
+
+@app.post("/api/calculate-price/jobs/{job_id}/resume", status_code=202)
+def resume_bulk_job(job_id: str):
+    job = get_bulk_job(job_id)
+    if job.state["status"] in ("queued", "running"):
+        raise HTTPException(status_code=409, detail="Job is already running")
+    if job.state["status"] != "done":
+        admit_bulk_job(job)
+        job.submit()
+    return job.summary()
+
+@app.post("/api/calculate-price/jobs/{job_id}/cancel")
+def cancel_bulk_job(job_id: str):
+    job = get_bulk_job(job_id)
+    if job.state["status"] in ("queued", "running") and job.state["pid"] != os.getpid():
+        raise HTTPException(status_code=409, detail="Job is running in another worker")
+    job.cancel()
+    return job.summary()
+
+@app.get("/api/calculate-price/jobs/{job_id}/result")
+def bulk_job_result(job_id: str, format: str = "csv"):
+    job = get_bulk_job(job_id)
+    if job.state["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job.state['status']}")
+    if format == "parquet":
+        _require_parquet_support()
+        return FileResponse(job.parquet_output(), media_type="application/vnd.apache.parquet",
+                            filename=f"quotations-{job.id}.parquet")
+    if format != "csv":
+        raise HTTPException(status_code=400, detail="format must be csv or parquet")
+    return FileResponse(job.output_path, media_type="text/csv; charset=utf-8", filename=f"quotations-{job.id}.csv")
+
+@app.delete("/api/calculate-price/jobs/{job_id}")
+def delete_bulk_job(job_id: str):
+    job = get_bulk_job(job_id)
+    if job.state["status"] in ("queued", "running"):
+        raise HTTPException(status_code=409, detail="Cancel the job before deleting it")
+    with _bulk_jobs_lock:
+        bulk_jobs.pop(job_id, None)
+    shutil.rmtree(job.dir, ignore_errors=True)
+    return {"deleted": job_id}
+
+# ==================== QUOTATION STORE ====================
+# ใบเสนอราคา (confirmed_design) และคำสั่งซื้อ (confirmed_order) ที่แชทสร้าง บันทึกแบบ write-behind:
+# request แค่ใส่คิว thread เขียนรวบหลายรายการเป็น transaction เดียว ไม่มี request ไหนรอดิสก์
+# เก็บแค่ hash ของ session_id: session_id ใช้ต่อแชทของลูกค้าได้ จึงห้ามหลุดออกทาง /api/quotations
+_QUOTATION_COLUMNS = ("id", "created_at", "kind", "session_hash", "catalog_version", "product_type", "box_type",
+                      "material", "quantity", "grand_total", "price_per_unit", "turns")
+
+def session_hash(session_id: Optional[str]) -> Optional[str]:
+    """hash ทางเดียวของ session_id ใช้จับกลุ่มใบเสนอราคาของแชทเดียวกันโดยไม่เปิดเผย id จริง"""
+    return hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:32] if session_id else None
+
+class QuotationStore:
+    """SQLite แบบ write-behind
+
+    record() ไม่แตะดิสก์ ถ้าคิวเต็มจะทิ้งรายการนั้นและนับใน dropped
+    thread เขียน commit ทุก batch_size รายการ หรือเมื่อรายการแรกในคิวรอครบ flush_seconds
+    เปิด connection และ thread ครั้งแรกที่ใช้ worker ที่ fork จาก serve.py จึงได้ของตัวเอง
+    """
+
+    def __init__(self, path: str, batch_size: int, flush_seconds: float, queue_size: int):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.stats = {"queued": 0, "written": 0, "dropped": 0, "failed": 0, "batches": 0, "last_batch_ms": 0.0}
+        self._queue: "queue.Queue" = queue.Queue(queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._reader: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL: commit ไม่ fsync ทุกครั้ง (ไฟดับอาจเสีย batch ล่าสุด แต่ไฟล์ไม่เสีย)
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS quotations ("
+            " id INTEGER PRIMARY KEY, created_at REAL NOT NULL, kind TEXT NOT NULL, session_hash TEXT,"
+            " catalog_version TEXT, product_type TEXT, box_type TEXT, material TEXT, quantity INTEGER,"
+            " grand_total REAL, price_per_unit REAL, turns INTEGER, quotation TEXT NOT NULL, requirements TEXT)"
+        )
+        for name, columns in (("created", "created_at"), ("session", "session_hash, id"), ("kind", "kind, id"),
+                              ("catalog", "catalog_version, id")):
+            db.execute(f"CREATE INDEX IF NOT EXISTS quotations_{name} ON quotations ({columns})")
+        return db
+
+    def record(self, kind: str, session_id: Optional[str], quotation: Dict[str, Any],
+               requirements: Dict[str, Any], turns: int) -> None:
+        if not self.path:
+            return
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="quotation-store", daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait((time.time(), kind, session_hash(session_id), quotation, requirements, turns))
+        except queue.Full:
+            self.stats["dropped"] += 1
+            return
+        self.stats["queued"] += 1
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """รอจนทุกรายการที่อยู่ในคิวตอนเรียกถูก commit (ใช้ตอนปิด process และใน bench)"""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 10) -> None:
+        self.flush(timeout)
+
+    def _run(self) -> None:
+        db = self._connect()
+        while True:
+            item = self._queue.get()
+            batch, markers = [], []
+            deadline = time.monotonic() + self.flush_seconds
+            while True:
+                if isinstance(item, threading.Event):
+                    markers.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(db, batch)
+            for marker in markers:
+                marker.set()
+
+    def _write(self, db: sqlite3.Connection, batch: List[tuple]) -> None:
+        started = time.perf_counter()
+        # encode ใน thread นี้ ไม่ใช่ตอน record() ที่อยู่บนเส้นทางของ request
+        rows = []
+        for created_at, kind, session_key, quotation, requirements, turns in batch:
+            pricing = quotation.get("pricing") or {}
+            try:
+                encoded = encode_json(quotation).decode("utf-8"), encode_json(requirements).decode("utf-8")
+            except (TypeError, ValueError) as e:
+                self.stats["failed"] += 1
+                logger.error("Could not encode quotation for session %s: %s", session_key, e)
+                continue
+            rows.append((
+                created_at, kind, session_key, quotation.get("catalog_version"), quotation.get("product_type"),
+                quotation.get("box_type"), quotation.get("material"), quotation.get("quantity"),
+                pricing.get("grand_total"), pricing.get("price_per_unit"), turns, *encoded,
+            ))
+        try:
+            db.execute("BEGIN")
+            db.executemany(
+                "INSERT INTO quotations (created_at, kind, session_hash, catalog_version, product_type, box_type,"
+                " material, quantity, grand_total, price_per_unit, turns, quotation, requirements)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            db.execute("COMMIT")
+        except sqlite3.Error as e:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            self.stats["failed"] += len(rows)
+            logger.error("Could not write %d quotations to %s: %s", len(rows), self.path, e)
+            return
+        self.stats["written"] += len(rows)
+        self.stats["batches"] += 1
+        self.stats["last_batch_ms"] = round((time.perf_counter() - started) * 1000, 3)
+
+    def _query(self, sql: str, params: tuple) -> List[tuple]:
+        with self._lock:
+            if self._reader is None:
+                self._reader = self._connect()
+            return self._reader.execute(sql, params).fetchall()
+
+    def recent(self, limit: int = 50, kind: Optional[str] = None, session_key: Optional[str] = None,
+               catalog_version: Optional[str] = None, since: Optional[float] = None,
+               before_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """รายการล่าสุดก่อน (ไม่รวม JSON เต็ม) before_id ใช้เลื่อนหน้าถัดไป"""
+        where, params = [], []
+        for column, value in (("kind", kind), ("session_hash", session_key), ("catalog_version", catalog_version)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            where.append("created_at >= ?")
+            params.append(since)
+        if before_id is not None:
+            where.append("id < ?")
+            params.append(before_id)
+        sql = f"SELECT {', '.join(_QUOTATION_COLUMNS)} FROM quotations"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        rows = self._query(sql + " ORDER BY id DESC LIMIT ?", (*params, limit))
+        return [dict(zip(_QUOTATION_COLUMNS, row)) for row in rows]
+
+    def get(self, quotation_id: int) -> Optional[Dict[str, Any]]:
+        rows = self._query(
+            f"SELECT {', '.join(_QUOTATION_COLUMNS)}, quotation, requirements FROM quotations WHERE id = ?",
+            (quotation_id,),
+        )
+        if not rows:
+            return None
+        entry = dict(zip(_QUOTATION_COLUMNS, rows[0]))
+        entry["quotation"] = json.loads(rows[0][-2])
+        entry["requirements"] = json.loads(rows[0][-1])
+        return entry
+
+    def summary(self) -> Dict[str, Any]:
+        return {**self.stats, "pending": self._queue.qsize(), "path": self.path or None}
+
+quotation_store = QuotationStore(QUOTATION_DB_PATH, QUOTATION_STORE_BATCH, QUOTATION_STORE_FLUSH_SECONDS,
+                                 QUOTATION_STORE_QUEUE_MAX)
+
+def _require_quotation_store() -> QuotationStore:
+    if not quotation_store.path:
+        raise HTTPException(status_code=503, detail="Quotation store is disabled (QUOTATION_DB_PATH is empty)")
+    return quotation_store
+
+def _require_quotations_admin(request: Request) -> None:
+    """ข้อมูลลูกค้าทั้งหมด: ต้องตั้ง QUOTATIONS_ADMIN_TOKEN และส่ง token ตรงกันเท่านั้น"""
+    if not QUOTATIONS_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Quotation API is disabled (QUOTATIONS_ADMIN_TOKEN is not set)")
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), QUOTATIONS_ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+
+@app.get("/api/quotations")
+def list_quotations(request: Request, limit: int = 50, kind: Optional[str] = None,
+                    session_hash: Optional[str] = None, catalog_version: Optional[str] = None,
+                    since: Optional[float] = None, before_id: Optional[int] = None):
+    """ใบเสนอราคา/คำสั่งซื้อล่าสุด (รายการที่ยังอยู่ในคิวจะเห็นหลัง commit ไม่เกิน QUOTATION_STORE_FLUSH_SECONDS)"""
+    _require_quotations_admin(request)
+    if not 1 <= limit <= 500:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 500")
+    if kind not in (None, "quotation", "order"):
+        raise HTTPException(status_code=400, detail="kind must be quotation or order")
+    items = _require_quotation_store().recent(limit, kind, session_hash, catalog_version, since, before_id)
+    return {"count": len(items), "items": items, "next_before_id": items[-1]["id"] if len(items) == limit else None}
+
+@app.get("/api/quotations/{quotation_id}")
+def get_quotation(request: Request, quotation_id: int):
+    _require_quotations_admin(request)
+    entry = _require_quotation_store().get(quotation_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Quotation not found")
+    return entry
+
+# ==================== CHAT SESSIONS ====================
+# session = {"history": [{"role", "content"}, ...], "requirements": {...}}
+# client ส่ง session_id มาพร้อมข้อความใหม่เท่านั้น ไม่ต้องส่งประวัติทั้งหมดทุกรอบ
+class MemorySessionStore:
+    """LRU + TTL ในหน่วยความจำของ process"""
+
+    def __init__(self, ttl_seconds: float = SESSION_TTL_SECONDS, max_sessions: int = SESSION_MAX):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            expires_at, session = entry
+            if expires_at < time.monotonic():
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+        # คืนสำเนา: request ที่มาพร้อมกันใน session เดียวกันไม่แก้ dict ชุดเดียวกัน (เหมือน sqlite ที่ได้ของใหม่ทุกครั้ง)
+        return copy.deepcopy(session)
+
+    def save(self, session_id: str, session: Dict[str, Any]) -> None:
+        with self._lock:
+            self._sessions[session_id] = (time.monotonic() + self.ttl_seconds, session)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+class SQLiteSessionStore:
+    """เก็บ session ลงไฟล์ SQLite ใช้ร่วมกันได้หลาย worker และอยู่รอดหลัง restart"""
+
+    def __init__(self, path: str = SESSION_DB_PATH, ttl_seconds: float = SESSION_TTL_SECONDS,
+                 max_sessions: int = SESSION_MAX):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.path = path
+        self._lock = threading.Lock()
+        self._swept_at = 0.0
+        self._connect()
+        # connection SQLite ใช้ข้าม fork ไม่ได้ worker ที่ fork จาก serve.py จึงเปิดใหม่เอง
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._connect)
+
+    def _connect(self) -> None:
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chat_sessions ("
+            " session_id TEXT PRIMARY KEY, data TEXT NOT NULL, touched_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS chat_sessions_touched ON chat_sessions (touched_at)")
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM chat_sessions WHERE session_id = ? AND touched_at >= ?",
+                (session_id, now - self.ttl_seconds),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE chat_sessions SET touched_at = ? WHERE session_id = ?", (now, session_id))
+        return json.loads(row[0])
+
+    def save(self, session_id: str, session: Dict[str, Any]) -> None:
+        now = time.time()
+        data = json.dumps(session, ensure_ascii=False)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO chat_sessions (session_id, data, touched_at) VALUES (?, ?, ?)",
+                (session_id, data, now),
+            )
+            # ลบที่หมดอายุ/เกิน max_sessions ทุก SESSION_SWEEP_SECONDS ไม่ใช่ทุก save
+            # (get กรองที่หมดอายุเองอยู่แล้ว จำนวนแถวจึงเกิน max ได้แค่ช่วงสั้น ๆ)
+            if now - self._swept_at >= SESSION_SWEEP_SECONDS:
+                self._swept_at = now
+                self._sweep(now)
+
+    def _sweep(self, now: float) -> None:
+        self._db.execute("DELETE FROM chat_sessions WHERE touched_at < ?", (now - self.ttl_seconds,))
+        self._db.execute(
+            "DELETE FROM chat_sessions WHERE session_id IN ("
+            " SELECT session_id FROM chat_sessions ORDER BY touched_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_sessions,),
+        )
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM chat_sessions WHERE session_id = ?", (session_id,))
+
+SESSION_BACKENDS = {
+    "memory": MemorySessionStore,
+    "sqlite": SQLiteSessionStore,
+}
+
+if SESSION_BACKEND not in SESSION_BACKENDS:
+    raise RuntimeError(f"Unknown SESSION_BACKEND {SESSION_BACKEND!r} (expected one of {sorted(SESSION_BACKENDS)})")
+session_store = SESSION_BACKENDS[SESSION_BACKEND]()
+
+def load_chat_session(request: ChatRequest) -> tuple:
+    """คืน (session_id, session) ถ้าไม่มี session เดิมจะเริ่มใหม่จากข้อมูลที่ client ส่งมา
+
+    session_id ที่หมดอายุ/ไม่รู้จักและไม่มีประวัติหรือ requirements มาด้วย ตอบ 410
+    ไม่เริ่มแชทใหม่เงียบ ๆ ให้ client ส่งประวัติที่มีอยู่มาใหม่แทน
+    """
+    session = session_store.get(request.session_id) if request.session_id else None
+    if session is None:
+        if request.session_id and not (request.conversation_history or request.current_requirements):
+            raise HTTPException(status_code=410,
+                                detail="Chat session expired; resend conversation_history and current_requirements")
+        session = {
+            "history": [msg.model_dump() for msg in request.conversation_history],
+            "requirements": dict(request.current_requirements),
+        }
+        return uuid.uuid4().hex, session
+    if request.current_requirements:
+        session["requirements"] = {**session["requirements"], **request.current_requirements}
+    return request.session_id, session
+
+_transcript_lock = threading.Lock()
+
+def record_transcript(session_id: str, message: str, model_reply: Optional[str]) -> None:
+    """ต่อท้ายรอบสนทนาลง CHAT_TRANSCRIPT_DIR/<session_id>.jsonl
+
+    บรรทัดละ {"user": ข้อความ, "model": คำตอบดิบของโมเดล} ("model" เป็น null เมื่อ server ตอบเอง)
+    """
+    line = json.dumps({"user": message, "model": model_reply}, ensure_ascii=False)
+    path = os.path.join(CHAT_TRANSCRIPT_DIR, f"{session_id}.jsonl")
+    try:
+        with _transcript_lock:
+            os.makedirs(CHAT_TRANSCRIPT_DIR, exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    except OSError as e:
+        logger.warning("Could not record transcript %s: %s", path, e)
+
+def as_model_reply(result: ChatResponse) -> str:
+    """ประกอบคำตอบที่มาจาก cache กลับเป็นรูปแบบคำตอบดิบของโมเดล"""
+    return f"{result.response}\n<extracted_data>{json.dumps(result.extracted_data, ensure_ascii=False)}</extracted_data>"
+
+def record_chat_turn(session_id: str, session: Dict[str, Any], message: str, result: ChatResponse,
+                     pending_question: Optional[str] = None, model_reply: Optional[str] = None) -> None:
+    if CHAT_TRANSCRIPT_DIR:
+        record_transcript(session_id, message, model_reply)
+    ordered_before = bool(session["requirements"].get("confirmed_order"))
+    session["history"].append({"role": "user", "content": message})
+    session["history"].append({"role": "assistant", "content": result.response})
+    if result.extracted_data:
+        session["requirements"] = {**session["requirements"], **result.extracted_data}
+    if result.show_quotation:
+        kind = "order" if session["requirements"].get("confirmed_order") and not ordered_before else "quotation"
+        quotation_store.record(kind, session_id, result.quotation_data, session["requirements"],
+                               len(session["history"]) // 2)
+    # คำถามที่รอคำตอบอยู่ ใช้ตัดสินว่า quick reply ถัดไปตอบเองได้หรือไม่
+    session["pending_question"] = pending_question or question_for_replies(result.quick_replies, session["requirements"])
+    session_store.save(session_id, session)
+    result.session_id = session_id
+
+# ==================== QUICK-REPLY FAST PATH ====================
+# คำตอบที่มาจากปุ่ม quick_replies เป็นค่าตายตัว จึงอัปเดต requirements และถามคำถามถัดไปเองได้
+# โดยไม่ต้องเรียก Gemini ข้อความที่พิมพ์เองยังส่งให้โมเดลตามปกติ
+# question -> (current_step, ข้อความคำถาม, quick_replies)
+QUICK_REPLY_QUESTIONS = {
+    "product_type": (2, "สินค้าของคุณเป็นประเภทไหนครับ? 📦", ["สินค้าทั่วไป", "Non-food", "Food-grade", "เครื่องสำอาง"]),
+    "box_type": (3, "ต้องการกล่องแบบไหนครับ?\n• RSC - กล่องมาตรฐาน แข็งแรง ประหยัด\n• Die-cut - ไดคัท ขึ้นรูปสวยงาม",
+                 ["RSC (มาตรฐาน)", "Die-cut (ไดคัท)"]),
+    "cushioning": (4, "ต้องการแผ่นกันกระแทกด้านในไหมครับ? 🛡️", ["ไม่ต้องการ", "กระดาษฝอย", "บับเบิ้ล", "ถุงลม"]),
+    "moisture_coating": (4, "ต้องการเคลือบกันชื้นไหมครับ? 💧",
+                         ["ไม่ต้องการ", "AQ Coating", "PE Coating", "Wax Coating", "Bio Coating"]),
+    "food_coating": (4, "ต้องการ Food-grade coating ไหมครับ? 🍱",
+                     ["ไม่ต้องการ", "Water-based", "PE Food-grade", "PLA/Bio", "Grease-resistant"]),
+    "dimensions": (5, "ขนาดกล่องที่ต้องการเท่าไหร่ครับ? 📏\nพิมพ์เป็น กว้าง x ยาว x สูง (ซม.) เช่น 20x30x10", []),
+    "quantity": (6, "ต้องการผลิตกี่ชิ้นครับ? (ขั้นต่ำ 500 ชิ้น)", ["500", "1000", "2000", "5000"]),
+    "confirm_structure": (6, "", ["ยืนยัน ✓", "ขอแก้ไข"]),
+    "mood_tone": (7, "อยากให้กล่องมี Mood & Tone แบบไหนครับ? 🎨", ["ข้าม", "มินิมอล", "พรีเมียม", "สดใส", "เรียบหรู"]),
+    "logo": (8, "มีโลโก้ที่ต้องการใส่บนกล่องไหมครับ?", ["ไม่มีโลโก้", "มีโลโก้"]),
+    "logo_position": (8, "อยากให้โลโก้อยู่ตำแหน่งไหนครับ?", ["ด้านบน", "ด้านล่าง", "ทุกด้าน", "ด้านกว้าง", "ด้านยาว"]),
+    "special_features": (9, "ต้องการลูกเล่นพิเศษไหมครับ? ✨",
+                         ["ไม่ต้องการ", "เคลือบเงา", "เคลือบด้าน", "ปั๊มนูน", "ปั๊มจม", "ปั๊มฟอยล์"]),
+    "gloss_coating": (9, "เลือกเคลือบเงาแบบไหนครับ?", ["Gloss AQ Coating", "UV Gloss Coating", "OPP Gloss Film"]),
+    "matte_coating": (9, "เลือกเคลือบด้านแบบไหนครับ?", ["UV ด้าน", "ลามิเนตด้าน", "วานิชด้าน"]),
+    "foil_color": (9, "ต้องการฟอยล์สีไหนครับ?", ["ทอง", "เงิน", "โรสโกลด์", "โฮโลแกรม", "ฟอยล์+นูน"]),
+    "emboss_block": (9, "เคยทำบล็อกปั๊มนูน/ปั๊มจมไว้แล้วหรือยังครับ?", ["เคยทำแล้ว", "ยังไม่เคย", "ใช้บล็อกเดิม"]),
+    "foil_block": (9, "เคยทำบล็อกปั๊มฟอยล์ไว้แล้วหรือยังครับ?", ["เคยทำแล้ว", "ยังไม่เคย", "ใช้บล็อกเดิม"]),
+    "confirm_design": (9, "", ["ยืนยัน ✓", "ขอแก้ไข"]),
+    "confirm_order": (11, "", ["ยืนยันคำสั่งซื้อ ✓", "ขอแก้ไข"]),
+}
+
+# ชื่อบนปุ่มที่สั้นกว่าชื่อในตารางราคา
+QUICK_REPLY_VALUES = {
+    "box_type": {"RSC (มาตรฐาน)": "RSC", "Die-cut (ไดคัท)": "Die-cut"},
+    "food_coating": {
+        "Water-based": "Water-based Food Coating",
+        "PE Food-grade": "PE Food-grade Coating",
+        "PLA/Bio": "PLA/Bio Coating",
+        "Grease-resistant": "Grease-resistant Coating",
+    },
+    "matte_coating": {"ลามิเนตด้าน": "ลามิเนตด้าน (PVC Matte)", "วานิชด้าน": "วานิชด้าน (Varnish)"},
+}
+
+GREETING_MESSAGES = {"เริ่มต้น", "สวัสดี", "สวัสดีครับ", "สวัสดีค่ะ"}
+
+fast_path_stats = {"turns": 0, "local_turns": 0}
+_fast_path_latency_ms: deque = deque(maxlen=1000)
+
+def record_fast_path_stats(local: bool, elapsed: float) -> None:
+    fast_path_stats["turns"] += 1
+    if local:
+        fast_path_stats["local_turns"] += 1
+        _fast_path_latency_ms.append(elapsed * 1000)
+
+def fast_path_summary() -> Dict[str, Any]:
+    turns = fast_path_stats["turns"]
+    summary = {**fast_path_stats, "local_ratio": round(fast_path_stats["local_turns"] / turns, 3) if turns else 0.0}
+    if _fast_path_latency_ms:
+        p50, p95 = np.percentile(list(_fast_path_latency_ms), [50, 95])
+        summary.update(local_p50_ms=round(float(p50), 3), local_p95_ms=round(float(p95), 3))
+    return summary
+
+def _requirements_skeleton(requirements: Dict[str, Any]) -> Dict[str, Any]:
+    """สำเนาของ requirements ที่มีโครงสร้างครบตาม <extracted_data> ใน SYSTEM_PROMPT"""
+    req = copy.deepcopy(requirements)
+    req["inner"] = {"cushioning": None, "moisture_coating": None, "food_coating": None, **(req.get("inner") or {})}
+    req["dimensions"] = {"width": None, "length": None, "height": None, **(req.get("dimensions") or {})}
+    req["logo"] = {"has_logo": False, "position": None, **(req.get("logo") or {})}
+    features = req.get("special_features") or {}
+    req["special_features"] = {
+        "gloss_coating": None,
+        "matte_coating": None,
+        **features,
+        "emboss": {"type": None, "has_block": False, **(features.get("emboss") or {})},
+        "foil": {"type": None, "color": None, "has_block": False, **(features.get("foil") or {})},
+    }
+    for key in ("product_type", "box_type", "quantity", "mood_tone"):
+        req.setdefault(key, None)
+    for key in ("confirmed_structure", "confirmed_design", "confirmed_order"):
+        req.setdefault(key, False)
+    return req
+
+def _questions_by_replies() -> Dict[tuple, List[str]]:
+    """ชุด quick_replies -> คำถามที่ใช้ชุดนั้น (บางชุดใช้ร่วมกันหลายคำถาม)"""
+    index: Dict[tuple, List[str]] = {}
+    for question, (_, _, replies) in QUICK_REPLY_QUESTIONS.items():
+        if replies:
+            index.setdefault(tuple(replies), []).append(question)
+    return index
+
+_QUESTIONS_BY_REPLIES = _questions_by_replies()
+
+def question_for_replies(quick_replies: List[str], requirements: Dict[str, Any]) -> Optional[str]:
+    """เดาคำถามจาก quick_replies ของคำตอบโมเดล (turn ที่ fast path ตอบเองบันทึก id ของคำถามไว้แล้ว)
+
+    ชุดที่ใช้ร่วมกันหลายคำถามต้องแยกด้วย state: ยืนยันโครงสร้าง/การออกแบบแยกด้วย current_step
+    ส่วนบล็อกปั๊มนูนกับบล็อกฟอยล์อยู่ step เดียวกันและเลือกได้ทั้งคู่ จึงคืน None ให้โมเดลตอบ turn ถัดไปเอง
+    """
+    matches = _QUESTIONS_BY_REPLIES.get(tuple(quick_replies), [])
+    if len(matches) == 1:
+        return matches[0]
+    if "confirm_structure" in matches:
+        design_step = QUICK_REPLY_QUESTIONS["mood_tone"][0]
+        if requirements.get("confirmed_structure") and (requirements.get("current_step") or 0) >= design_step:
+            return "confirm_design"
+        return "confirm_structure"
+    return None
+
+def _next_structure_question(req: Dict[str, Any]) -> str:
+    if not req["product_type"]:
+        return "product_type"
+    if not req["box_type"]:
+        return "box_type"
+    if not all(req["dimensions"].get(key) for key in ("width", "length", "height")):
+        return "dimensions"
+    if not req["quantity"]:
+        return "quantity"
+    return "confirm_structure"
+
+def _apply_quick_reply(question: str, reply: str, req: Dict[str, Any]) -> Optional[str]:
+    """บันทึกคำตอบลง req แล้วคืนคำถามถัดไป (None = ให้โมเดลตอบเอง)"""
+    value = QUICK_REPLY_VALUES.get(question, {}).get(reply, reply)
+    skipped = reply in ("ไม่ต้องการ", "ข้าม")
+    features = req["special_features"]
+
+    if question == "product_type":
+        req["product_type"] = value
+    elif question == "box_type":
+        req["box_type"] = value
+        if value == "Die-cut":
+            return "cushioning"
+    elif question in ("cushioning", "moisture_coating", "food_coating"):
+        req["inner"][question] = None if skipped else value
+        if question == "cushioning":
+            return "moisture_coating"
+        if question == "moisture_coating":
+            return "food_coating"
+    elif question == "quantity":
+        req["quantity"] = int(value)
+    elif question == "confirm_structure":
+        if reply != "ยืนยัน ✓":
+            return None
+        req["confirmed_structure"] = True
+        return "mood_tone"
+    elif question == "mood_tone":
+        req["mood_tone"] = None if skipped else value
+        return "logo"
+    elif question == "logo":
+        req["logo"]["has_logo"] = reply == "มีโลโก้"
+        return "logo_position" if req["logo"]["has_logo"] else "special_features"
+    elif question == "logo_position":
+        req["logo"]["position"] = value
+        return "special_features"
+    elif question == "special_features":
+        if skipped:
+            return "confirm_design"
+        if reply == "เคลือบเงา":
+            return "gloss_coating"
+        if reply == "เคลือบด้าน":
+            return "matte_coating"
+        if reply == "ปั๊มฟอยล์":
+            return "foil_color"
+        features["emboss"]["type"] = reply
+        return "emboss_block"
+    elif question in ("gloss_coating", "matte_coating"):
+        features[question] = value
+        return "special_features"
+    elif question == "foil_color":
+        features["foil"]["type"] = "ฟอยล์+นูน" if reply == "ฟอยล์+นูน" else "ฟอยล์ธรรมดา"
+        features["foil"]["color"] = None if reply == "ฟอยล์+นูน" else reply
+        return "foil_block"
+    elif question in ("emboss_block", "foil_block"):
+        features[question.split("_")[0]]["has_block"] = reply != "ยังไม่เคย"
+        return "special_features"
+    elif question == "confirm_design":
+        if reply != "ยืนยัน ✓":
+            return None
+        req["confirmed_design"] = True
+        return "confirm_order"
+    elif question == "confirm_order":
+        if reply != "ยืนยันคำสั่งซื้อ ✓":
+            return None
+        req["confirmed_order"] = True
+        return "done"
+    return _next_structure_question(req)
+
+def _describe_inner(inner: Dict[str, Any]) -> str:
+    chosen = [inner[key] for key in ("cushioning", "moisture_coating", "food_coating") if inner.get(key)]
+    return ", ".join(chosen) or "ไม่ได้กำหนด"
+
+def _describe_features(features: Dict[str, Any]) -> str:
+    chosen = [features[key] for key in ("gloss_coating", "matte_coating") if features.get(key)]
+    if features["emboss"].get("type"):
+        chosen.append(features["emboss"]["type"])
+    if features["foil"].get("type"):
+        foil = features["foil"]
+        chosen.append(f"{foil['type']} ({foil['color']})" if foil.get("color") else foil["type"])
+    return ", ".join(chosen) or "ไม่มี"
+
+def _question_text(question: str, req: Dict[str, Any]) -> str:
+    dims = req["dimensions"]
+    size = f"{dims['width']} x {dims['length']} x {dims['height']} ซม."
+    if question == "confirm_structure":
+        return (
+            "📋 สรุปข้อมูลโครงสร้างกล่องครับ\n"
+            f"• ประเภทสินค้า: {req['product_type']}\n"
+            f"• ประเภทกล่อง: {req['box_type']}\n"
+            f"• Inner: {_describe_inner(req['inner'])}\n"
+            f"• ขนาด: {size}\n"
+            f"• จำนวน: {req['quantity']:,} ชิ้น\n\n"
+            "ข้อมูลถูกต้องไหมครับ?"
+        )
+    if question == "confirm_design":
+        logo = req["logo"]
+        return (
+            "🎨 สรุปข้อมูลการออกแบบครับ\n"
+            f"• ประเภทกล่อง: {req['box_type']}\n"
+            f"• ขนาด: {size}\n"
+            f"• Mood & Tone: {req['mood_tone'] or 'ไม่ได้กำหนด'}\n"
+            f"• Logo: {('มี (' + str(logo['position']) + ')') if logo.get('has_logo') else 'ไม่มี'}\n"
+            f"• ลูกเล่นพิเศษ: {_describe_features(req['special_features'])}\n\n"
+            "ยืนยันการออกแบบไหมครับ?"
+        )
+    if question == "confirm_order":
+        material = get_material_for_product(req["product_type"], req["box_type"])
+        return (
+            f"📦 Mockup: กล่อง {req['box_type']} วัสดุ{material} ขนาด {size} "
+            f"สไตล์{req['mood_tone'] or 'มาตรฐาน'} ลูกเล่น: {_describe_features(req['special_features'])}\n\n"
+            "นี่คือใบเสนอราคาครับ 👇 ถ้าถูกต้องกดยืนยันคำสั่งซื้อได้เลยครับ"
+        )
+    if question == "done":
+        return "🎉 ขอบคุณที่ไว้วางใจ LumoPack ครับ! ทีมงานจะติดต่อกลับเพื่อยืนยันรายละเอียดการผลิตเร็ว ๆ นี้ครับ 🙏"
+    if question == "special_features" and _describe_features(req["special_features"]) != "ไม่มี":
+        return "ต้องการลูกเล่นพิเศษเพิ่มอีกไหมครับ? ✨"
+    return QUICK_REPLY_QUESTIONS[question][1]
+
+def quick_reply_turn(session: Dict[str, Any], message: str) -> Optional[tuple]:
+    """ตอบ quick reply โดยไม่เรียกโมเดล คืน (ChatResponse, คำถามถัดไป) หรือ None ถ้าต้องส่งให้โมเดล"""
+    message = message.strip()
+    if not session["history"] and not session["requirements"] and message in GREETING_MESSAGES:
+        text = "สวัสดีครับ 😊 ผม \"ลูโม่\" ผู้ช่วย AI ของ LumoPack จะช่วยออกแบบกล่องให้คุณเองครับ\n\n"
+        question, req = "product_type", _requirements_skeleton({})
+        text += QUICK_REPLY_QUESTIONS[question][1]
+    else:
+        question = session.get("pending_question")
+        if not question or message not in QUICK_REPLY_QUESTIONS[question][2]:
+            return None
+        req = _requirements_skeleton(session["requirements"])
+        question = _apply_quick_reply(question, message, req)
+        if question is None:
+            return None
+        text = _question_text(question, req)
+
+    step, _, replies = QUICK_REPLY_QUESTIONS.get(question, (13, "", []))
+    req.update(
+        current_step=step,
+        is_checkpoint=question.startswith("confirm_"),
+        quick_replies=list(replies),
+    )
+    return build_chat_response(text, req), question
+
+# ==================== CHAT RESPONSE CACHE ====================
+# turn ที่ state เหมือนกัน (requirements + ข้อความล่าสุด + step) ได้คำตอบจากโมเดลเหมือนกัน
+# เก็บเฉพาะข้อความและ extracted_data ส่วน quotation ประกอบใหม่ทุกครั้ง (ราคาตาม catalog ปัจจุบัน)
+KNOWN_QUICK_REPLIES = frozenset(
+    reply for _, _, replies in QUICK_REPLY_QUESTIONS.values() for reply in replies
+) | GREETING_MESSAGES
+
+# key ที่บอกสถานะของหน้าจอ ไม่ใช่ข้อมูลของลูกค้า (step ใส่ใน key แยก)
+_VOLATILE_REQUIREMENT_KEYS = {"current_step", "is_checkpoint", "quick_replies"}
+
+def _normalize_requirements(value: Any) -> Any:
+    """ตัดค่าว่าง (None, "", {}, []) ออก เพื่อให้ requirements ที่ความหมายเดียวกันได้ key เดียวกัน"""
+    if isinstance(value, dict):
+        items = ((k, _normalize_requirements(v)) for k, v in value.items())
+        return {k: v for k, v in items if v not in (None, "", {}, [])}
+    if isinstance(value, list):
+        return [_normalize_requirements(v) for v in value]
+    return value
+
+def _normalize_message(message: str) -> str:
+    return " ".join(message.split()).casefold()
+
+class ChatResponseCache:
+    """LRU + TTL ของ (ข้อความที่แสดง, extracted_data เป็น JSON) จากโมเดล"""
+
+    def __init__(self, max_size: int, ttl_seconds: float, free_text: bool = False):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.free_text = free_text
+        self.stats = {"hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "evictions": 0, "expired": 0}
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, requirements: Dict[str, Any], message: str) -> Optional[str]:
+        """None = turn นี้ไม่ใช้ cache (ปิดอยู่ หรือเป็นข้อความพิมพ์เองโดยไม่ได้เปิด free_text)"""
+        if not self.max_size:
+            return None
+        if not self.free_text and message.strip() not in KNOWN_QUICK_REPLIES:
+            with self._lock:
+                self.stats["bypassed"] += 1
+            return None
+        state = {k: v for k, v in requirements.items() if k not in _VOLATILE_REQUIREMENT_KEYS}
+        try:
+            payload = json.dumps(
+                [_normalize_requirements(state), _normalize_message(message), requirements.get("current_step")],
+                sort_keys=True, ensure_ascii=False, default=str,
+            )
+        except (TypeError, ValueError):
+            return None
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self.stats["expired"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+        _, text, data = entry
+        # คืน dict ใหม่ทุกครั้ง session ที่แก้ requirements ต่อจะไม่กระทบค่าใน cache
+        return text, json.loads(data)
+
+    def put(self, key: str, text: str, extracted_data: Dict[str, Any]) -> None:
+        # turn ที่แยกข้อมูลไม่ได้ไม่เก็บ ให้ครั้งถัดไปถามโมเดลใหม่
+        if not extracted_data:
+            return
+        entry = (time.monotonic() + self.ttl_seconds, text, json.dumps(extracted_data, ensure_ascii=False))
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self.stats["stores"] += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {**self.stats, "size": len(self._entries), "max_size": self.max_size}
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
+
+chat_response_cache = ChatResponseCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL_SECONDS, CHAT_CACHE_FREE_TEXT)
+
+def cached_chat_turn(session: Dict[str, Any], message: str) -> Tuple[Optional[str], Optional[ChatResponse]]:
+    """(cache key, คำตอบจาก cache หรือ None) key เป็น None ถ้า turn นี้ไม่ใช้ cache"""
+    key = chat_response_cache.key(session["requirements"], message)
+    if key is None:
+        return None, None
+    entry = chat_response_cache.get(key)
+    if entry is None:
+        return key, None
+    return key, build_chat_response(*entry)
+
+# ==================== LLM CALLS ====================
+_llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="llm")
+_llm_slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+
+def acquire_llm_slot() -> None:
+    if not _llm_slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=429,
+            detail="AI is busy, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+
+def release_llm_slot(*_: Any) -> None:
+    _llm_slots.release()
+
+_client_lock = threading.Lock()
+
+def model_configured() -> bool:
+    return client is not None or bool(GEMINI_API_KEY)
+
+def get_client():
+    """genai.Client ของ process นี้ (สร้างครั้งแรกที่เรียก) เรียกจาก worker thread เท่านั้นเพราะ import ช้า"""
+    global client
+    if client is None and GEMINI_API_KEY:
+        with _client_lock:
+            if client is None:
+                import httpx
+                from google import genai
+
+                limits = httpx.Limits(
+                    max_connections=LLM_MAX_CONCURRENCY,
+                    max_keepalive_connections=LLM_MAX_CONCURRENCY,
+                    keepalive_expiry=GEMINI_KEEPALIVE_SECONDS,
+                )
+                client = genai.Client(api_key=GEMINI_API_KEY, http_options={"client_args": {"limits": limits}})
+    return client
+
+def warm_model_client() -> None:
+    """import genai, สร้าง client และเปิด connection แรกไว้ใน pool ก่อนแชทแรกเข้ามา"""
+    started = time.perf_counter()
+    try:
+        model_client = get_client()
+        if model_client is None:
+            return
+        model_client.models.get(model=GEMINI_MODEL)
+    except Exception as e:
+        logger.warning("Gemini prewarm failed: %s", e)
+        return
+    logger.info("Gemini client warmed up in %.0f ms", (time.perf_counter() - started) * 1000)
+
+# ==================== MODEL ROUTER ====================
+# turn เก็บข้อมูลทั่วไปใช้โมเดลเบา turn ที่คำตอบจะเป็น checkpoint/ใบเสนอราคาใช้โมเดลที่เก่งกว่า
+# แต่ละ route มีโมเดลสำรองเป็นตัวถัดไป: ใช้ตอน retry, ตอนวงจรของโมเดลหลักเปิด และเป็นตัว hedge
+LLM_ROUTES = {
+    route: tuple(dict.fromkeys(models))
+    for route, models in (
+        {"light": (GEMINI_LIGHT_MODEL, GEMINI_STRONG_MODEL), "strong": (GEMINI_STRONG_MODEL, GEMINI_LIGHT_MODEL)}
+        if LLM_ROUTING else
+        {"light": (GEMINI_MODEL, GEMINI_LIGHT_MODEL), "strong": (GEMINI_MODEL, GEMINI_LIGHT_MODEL)}
+    ).items()
+}
+
+def choose_route(requirements: Dict[str, Any]) -> Tuple[str, str]:
+    """(route, เหตุผล) จาก requirements ก่อน turn นี้"""
+    if not LLM_ROUTING:
+        return "strong", "routing_off"
+    if requirements.get("is_checkpoint"):
+        return "strong", "checkpoint"
+    if requirements.get("confirmed_structure") and (requirements.get("current_step") or 0) >= 9:
+        return "strong", "quotation"
+    dims = requirements.get("dimensions") or {}
+    structure = (requirements.get("product_type"), requirements.get("box_type"), requirements.get("quantity"),
+                 *(dims.get(key) for key in ("width", "length", "height")))
+    if all(structure) and not requirements.get("confirmed_structure"):
+        return "strong", "structure_summary"
+    return "light", "extraction"
+
+def _retryable(error: BaseException) -> bool:
+    # 4xx (ยกเว้น 408/429) คือ request ของเราผิด ส่งซ้ำหรือเปลี่ยนโมเดลก็ไม่หาย และไม่นับว่าโมเดลล่ม
+    code = getattr(error, "code", None)
+    return not (isinstance(code, int) and 400 <= code < 500 and code not in (408, 429))
+
+class CircuitBreaker:
+    """ล้มติดกัน failure_threshold ครั้ง -> เปิดวงจร (ไม่ส่งไปโมเดลนี้) reset_seconds
+    แล้วปล่อย request ทดลองทีละตัว (half-open) ถ้าผ่านก็ปิดวงจร ถ้าล้มก็เปิดต่ออีกรอบ
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened = 0
+        self._open_until = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.failures < self.failure_threshold:
+            return "closed"
+        return "open" if time.monotonic() < self._open_until else "half_open"
+
+    def available(self) -> bool:
+        """ส่งได้ไหม (ไม่จอง probe) ใช้เลือกลำดับโมเดล"""
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self._probing)
+
+    def allow(self) -> bool:
+        """จองสิทธิ์ส่งจริง ตอน half-open ได้ทีละ request"""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "open" or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def release(self) -> None:
+        """คืนสิทธิ์ probe ที่จองไว้แต่ไม่ได้ส่ง"""
+        with self._lock:
+            self._probing = False
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            self._probing = False
+            if ok:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self._open_until <= time.monotonic():
+                    self.opened += 1
+                self._open_until = time.monotonic() + self.reset_seconds
+
+class ModelRouter:
+    """เรียกโมเดลตาม route พร้อม retry (exponential backoff + full jitter), fallback, hedge และ circuit breaker
+
+    ทุก call ใช้ slot ของ LLM_MAX_CONCURRENCY จนกว่า thread จะทำงานเสร็จจริง call แรกได้ slot ไม่ทันตอบ 429
+    ส่วน hedge ส่งเฉพาะเมื่อมี slot ว่าง
+    """
+
+    def __init__(self, routes: Dict[str, Tuple[str, ...]], hedge_after: float, retries: int,
+                 backoff_seconds: float, failure_threshold: int, reset_seconds: float):
+        self.routes = routes
+        self.hedge_after = hedge_after
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.stats = {"turns": 0, "hedged": 0, "hedge_wins": 0, "retries": 0, "fallbacks": 0, "short_circuited": 0,
+                      "routes": {}, "models": {}}
+        self._lock = threading.Lock()
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        with self._lock:
+            if model not in self.breakers:
+                self.breakers[model] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+            return self.breakers[model]
+
+    def candidates(self, route: str) -> List[str]:
+        """โมเดลที่วงจรยังไม่เปิด ตามลำดับของ route ว่าง = ทุกตัวล่ม ให้ตอบ 503 ทันที"""
+        models = [model for model in self.routes[route] if self.breaker(model).available()]
+        if not models:
+            self._count("short_circuited")
+        return models
+
+    def unavailable(self) -> HTTPException:
+        return HTTPException(status_code=503, detail="AI is temporarily unavailable, please retry shortly",
+                             headers={"Retry-After": f"{self.reset_seconds:.0f}"})
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, self.backoff_seconds * 2 ** (attempt - 1))
+
+    def _count(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self.stats[key] += amount
+
+    def record_turn(self, route: str, reason: str, model: Optional[str]) -> None:
+        MODEL_ROUTES.inc(route, reason)
+        with self._lock:
+            self.stats["turns"] += 1
+            self.stats["routes"][f"{route}:{reason}"] = self.stats["routes"].get(f"{route}:{reason}", 0) + 1
+            if model:
+                self.stats["models"][model] = self.stats["models"].get(model, 0) + 1
+
+    def record_call(self, model: str, started: float, error: Optional[BaseException]) -> None:
+        outcome = "ok" if error is None else "error"
+        MODEL_CALLS.observe(time.perf_counter() - started, model, outcome)
+        # 4xx แปลว่าโมเดลยังตอบได้ จึงนับเป็นผ่านสำหรับวงจร
+        self.breaker(model).record(error is None or not _retryable(error))
+
+    def _submit(self, model: str, contents: List[Dict[str, Any]], required: bool,
+                calls: Dict[asyncio.Future, str]) -> Optional[asyncio.Future]:
+        """ส่ง call ไป model คืน None ถ้าวงจรไม่ให้ส่ง (เช่นมี probe ตอน half-open อยู่แล้ว) หรือไม่มี slot ว่างของ hedge"""
+        if not self.breaker(model).allow():
+            return None
+        if not _llm_slots.acquire(blocking=False):
+            self.breaker(model).release()
+            if required:
+                raise HTTPException(status_code=429, detail="AI is busy, please retry shortly",
+                                    headers={"Retry-After": "1"})
+            return None
+        started = time.perf_counter()
+        try:
+            future = _llm_executor.submit(
+                lambda: get_client().models.generate_content(**model_request(contents, model)))
+        except BaseException:
+            release_llm_slot()
+            self.breaker(model).release()
+            raise
+        # คืน slot และบันทึกผลเมื่อ thread ทำงานเสร็จจริง แม้ request จะได้คำตอบจากตัวอื่นหรือ timeout ไปก่อน
+        future.add_done_callback(release_llm_slot)
+        future.add_done_callback(lambda f: self.record_call(model, started, f.exception()))
+        wrapped = asyncio.wrap_future(future)
+        # ตัวที่แพ้ hedge อาจ error ทีหลัง อ่าน exception ทิ้งไว้ไม่ให้ asyncio log เตือน
+        wrapped.add_done_callback(lambda f: f.cancelled() or f.exception())
+        calls[wrapped] = model
+        return wrapped
+
+    def _start(self, order: List[str], contents: List[Dict[str, Any]], required: bool,
+               calls: Dict[asyncio.Future, str]) -> Optional[asyncio.Future]:
+        """ส่งไปโมเดลแรกใน order ที่วงจรยอม ตัวที่แพ้ probe ตอน half-open ข้ามไปตัวถัดไป ไม่ตอบ 503"""
+        for model in order:
+            future = self._submit(model, contents, required, calls)
+            if future is not None:
+                return future
+        if required:
+            self._count("short_circuited")
+            raise self.unavailable()
+        return None
+
+    def _retry_order(self, route: str, models: List[str], attempt: int) -> List[str]:
+        """ลำดับโมเดลของ attempt ถัดไป: เลื่อนไปตัวถัดไปใน route วงจรที่เพิ่งเปิดจะถูกข้าม"""
+        models = [model for model in self.routes[route] if self.breaker(model).available()] or models
+        start = attempt % len(models)
+        return models[start:] + models[:start]
+
+    async def generate(self, contents: List[Dict[str, Any]], route: str, reason: str) -> str:
+        deadline = time.monotonic() + LLM_TIMEOUT_SECONDS
+        models = self.candidates(route)
+        if not models:
+            self.record_turn(route, reason, None)
+            raise self.unavailable()
+        calls: Dict[asyncio.Future, str] = {}
+        attempt = 0
+        while True:
+            try:
+                first = self._start(models, contents, True, calls)
+            except HTTPException:
+                self.record_turn(route, reason, None)
+                raise
+            in_flight = calls[first]
+            if attempt:
+                self._count("retries")
+                MODEL_RETRIES.inc(in_flight)
+            if in_flight != self.routes[route][0]:
+                self._count("fallbacks")
+            # สถานะ hedge เริ่มใหม่ทุก attempt
+            pending, hedged = {first}, False
+            hedge_at = time.monotonic() + self.hedge_after
+            error = None
+            while pending:
+                now = time.monotonic()
+                timeout = deadline - now
+                if self.hedge_after > 0 and not hedged:
+                    timeout = min(timeout, max(0.0, hedge_at - now))
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if time.monotonic() >= deadline:
+                        self.record_turn(route, reason, None)
+                        raise HTTPException(status_code=504,
+                                            detail=f"AI Error: no response within {LLM_TIMEOUT_SECONDS:g}s")
+                    # ตัวแรกช้าเกิน hedge_after: ส่งไปโมเดลอื่นที่วงจรยังปิดอยู่คู่ขนาน ใช้คำตอบของตัวที่เสร็จก่อน
+                    hedged = True
+                    targets = [model for model in self.routes[route]
+                               if model != in_flight and self.breaker(model).available()]
+                    hedge = self._start(targets, contents, False, calls)
+                    if hedge is not None:
+                        self._count("hedged")
+                        MODEL_HEDGES.inc("sent")
+                        pending.add(hedge)
+                    else:
+                        MODEL_HEDGES.inc("skipped")
+                    continue
+                for future in done:
+                    if future.exception() is None:
+                        if calls[future] != in_flight:
+                            self._count("hedge_wins")
+                            MODEL_HEDGES.inc("won")
+                        self.record_turn(route, reason, calls[future])
+                        return future.result().text
+                    error = future.exception()
+            if attempt >= self.retries or not _retryable(error):
+                self.record_turn(route, reason, None)
+                raise error
+            attempt += 1
+            delay = self.backoff(attempt)
+            if time.monotonic() + delay >= deadline:
+                self.record_turn(route, reason, None)
+                raise error
+            await asyncio.sleep(delay)
+            models = self._retry_order(route, models, attempt)
+
+    def open_stream(self, contents: List[Dict[str, Any]], route: str, reason: str, deadline: float):
+        """เปิด generate_content_stream (sync ใน thread ของ stream) คืน (model, chunk แรก, iterator ที่เหลือ)
+
+        retry/fallback ได้เฉพาะก่อน chunk แรก เพราะหลังจากนั้นส่ง token ให้ลูกค้าไปแล้ว ไม่มี hedge สำหรับ stream
+        เพราะสอง stream คู่ขนานจะใช้ slot สองตัวตลอดทั้งคำตอบ
+        """
+        models = self.candidates(route) or list(self.routes[route][:1])
+        attempt = 0
+        while True:
+            model = next((model for model in models if self.breaker(model).allow()), None)
+            if model is None:
+                self._count("short_circuited")
+                self.record_turn(route, reason, None)
+                raise self.unavailable()
+            if attempt:
+                self._count("retries")
+                MODEL_RETRIES.inc(model)
+            if model != self.routes[route][0]:
+                self._count("fallbacks")
+            started = time.perf_counter()
+            try:
+                stream = iter(get_client().models.generate_content_stream(**model_request(contents, model)))
+                first = next(stream, None)
+            except Exception as e:
+                self.record_call(model, started, e)
+                if attempt >= self.retries or not _retryable(e):
+                    self.record_turn(route, reason, None)
+                    raise
+                attempt += 1
+                delay = self.backoff(attempt)
+                if time.monotonic() + delay >= deadline:
+                    self.record_turn(route, reason, None)
+                    raise
+                time.sleep(delay)
+                models = self._retry_order(route, models, attempt)
+                continue
+            self.record_call(model, started, None)
+            self.record_turn(route, reason, model)
+            return model, first, stream
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = copy.deepcopy(self.stats)
+            breakers = dict(self.breakers)
+        stats["breakers"] = {model: {"state": breaker.state, "failures": breaker.failures, "opened": breaker.opened}
+                             for model, breaker in breakers.items()}
+        stats["routes_config"] = {route: list(models) for route, models in self.routes.items()}
+        return stats
+
+model_router = ModelRouter(LLM_ROUTES, LLM_HEDGE_AFTER_SECONDS, LLM_RETRIES, LLM_RETRY_BACKOFF_SECONDS,
+                           LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_SECONDS)
+
+async def generate_content_async(contents: List[Dict[str, Any]], route: str = "strong",
+                                 reason: str = "default") -> str:
+    """เรียกโมเดลผ่าน model_router นอก event loop พร้อม timeout"""
+    started = time.perf_counter()
+    try:
+        text = await model_router.generate(contents, route, reason)
+    except HTTPException as e:
+        MODEL_LATENCY.observe(time.perf_counter() - started, "generate", "timeout" if e.status_code == 504 else "error")
+        raise
+    except Exception:
+        MODEL_LATENCY.observe(time.perf_counter() - started, "generate", "error")
+        raise
+    MODEL_LATENCY.observe(time.perf_counter() - started, "generate", "ok")
+    RESPONSE_TOKENS.observe(estimate_tokens(text or ""))
+    return text
+
+# ==================== PROMPT CONTEXT ====================
+# ส่วนต้นของ prompt ที่เหมือนกันทุก session สร้างครั้งเดียวตอน import
+PROMPT_PREFIX = (
+    {"role": "user", "parts": [{"text": SYSTEM_PROMPT}]},
+    {"role": "model", "parts": [{"text": "เข้าใจแล้วครับ พร้อมทำหน้าที่ลูโม่แล้วครับ"}]},
+)
+
+def estimate_tokens(text: str) -> int:
+    # ประมาณแบบหยาบ (ภาษาไทยราว 3 ตัวอักษรต่อ token) ไม่ต้องเรียก count_tokens ทุกรอบ
+    return len(text) // 3 + 1
+
+PROMPT_PREFIX_TOKENS = sum(estimate_tokens(part["text"]) for msg in PROMPT_PREFIX for part in msg["parts"])
+
+context_stats = {
+    "turns": 0,
+    "prompt_tokens": 0,
+    "tokens_saved_compaction": 0,
+    "tokens_saved_cache": 0,
+    "last_turn": {},
+}
+_context_stats_lock = threading.Lock()
+
+def _record_context_stats(**turn: int) -> None:
+    with _context_stats_lock:
+        if "prompt_tokens" in turn:
+            context_stats["turns"] += 1
+            context_stats["last_turn"] = dict(turn)
+        else:
+            context_stats["last_turn"].update(turn)
+        for key, value in turn.items():
+            context_stats[key] = context_stats.get(key, 0) + value
+
+class PromptCache:
+    """Context cache ของ PROMPT_PREFIX ฝั่ง Gemini สร้างครั้งเดียวแล้วใช้ซ้ำจนหมดอายุ
+
+    ถ้าสร้างไม่ได้ (เช่น network ขัดข้อง หรือ prompt สั้นกว่าขั้นต่ำของโมเดล) ส่ง prefix ตามปกติ
+    แล้วลองใหม่หลัง retry_seconds (เพิ่มเท่าตัวทุกครั้งที่ล้มติดกัน ไม่เกิน ttl_seconds)
+    การสร้างเรียก API นอก lock: ระหว่างรอ request อื่นของโมเดลเดียวกันส่ง prefix เต็มไปก่อน ไม่ต่อคิวกัน
+    """
+
+    def __init__(self, enabled: bool, ttl_seconds: int, retry_seconds: float = 30):
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.retry_seconds = retry_seconds
+        self.failures = 0
+        # cache ของ Gemini ผูกกับโมเดล: model -> (name, expires_at)
+        self._caches: Dict[str, Tuple[str, float]] = {}
+        # model -> เวลาที่ลองสร้างใหม่ได้ (หลังล้ม) และโมเดลที่กำลังสร้างอยู่
+        self._retry_at: Dict[str, float] = {}
+        self._creating: set = set()
+        self._lock = threading.Lock()
+
+    def get(self, model: str = GEMINI_MODEL) -> Optional[str]:
+        model_client = get_client()
+        if not self.enabled or model_client is None:
+            return None
+        now = time.time()
+        with self._lock:
+            # เผื่อเวลา 60 วินาทีก่อนหมดอายุ ไม่ให้ request ที่กำลังส่งอ้าง cache ที่หายไปแล้ว
+            name, expires_at = self._caches.get(model, (None, 0.0))
+            if name and now < expires_at - 60:
+                return name
+            if model in self._creating or now < self._retry_at.get(model, 0.0):
+                return None
+            self._creating.add(model)
+        try:
+            cache = model_client.caches.create(
+                model=model,
+                config={"contents": list(PROMPT_PREFIX), "ttl": f"{self.ttl_seconds}s"},
+            )
+        except Exception as e:
+            with self._lock:
+                self._creating.discard(model)
+                self.failures += 1
+                delay = min(self.retry_seconds * 2 ** (self.failures - 1), self.ttl_seconds)
+                self._retry_at[model] = time.time() + delay
+            logger.warning("Prompt cache unavailable for %s, retrying in %gs: %s", model, delay, e)
+            return None
+        with self._lock:
+            self._creating.discard(model)
+            self.failures = 0
+            self._caches[model] = (cache.name, time.time() + self.ttl_seconds)
+        return cache.name
+
+prompt_cache = PromptCache(GEMINI_PROMPT_CACHE, GEMINI_PROMPT_CACHE_TTL_SECONDS,
+                           GEMINI_PROMPT_CACHE_RETRY_SECONDS)
+
+def model_request(contents: List[Dict[str, Any]], model: str = GEMINI_MODEL) -> Dict[str, Any]:
+    """kwargs ของ client.models.generate_content* (เรียกใน worker thread เพราะอาจสร้าง cache)"""
+    cache_name = prompt_cache.get(model)
+    if cache_name:
+        _record_context_stats(tokens_saved_cache=PROMPT_PREFIX_TOKENS)
+        return {"model": model, "contents": contents, "config": {"cached_content": cache_name}}
+    return {"model": model, "contents": [*PROMPT_PREFIX, *contents]}
+
+def compact_history(history: List[Dict[str, str]], requirements: Dict[str, Any],
+                    budget: int) -> List[Dict[str, str]]:
+    """ตัดประวัติเก่า: เมื่อ requirements เก็บข้อมูลไว้แล้วเหลือเฉพาะข้อความล่าสุด แล้วตัดต่อจนอยู่ในงบ token"""
+    kept = history
+    if requirements and len(kept) > CHAT_KEEP_MESSAGES:
+        kept = kept[-CHAT_KEEP_MESSAGES:]
+
+    sizes = [estimate_tokens(msg["content"]) for msg in kept]
+    total = sum(sizes)
+    start = 0
+    while start < len(kept) and total > budget:
+        total -= sizes[start]
+        start += 1
+    # ประวัติต้องเริ่มด้วยข้อความของผู้ใช้ (ต่อจากคำตอบรับของโมเดลใน PROMPT_PREFIX)
+    while start < len(kept) and kept[start]["role"] != "user":
+        start += 1
+    return kept[start:]
+
+def build_chat_contents(message: str, history: List[Dict[str, str]],
+                        requirements: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """ประวัติ + ข้อความใหม่ (ไม่รวม PROMPT_PREFIX ซึ่ง model_request เติมให้)"""
+    user_message = message
+    if requirements:
+        user_message += f"\n\n[ข้อมูลที่เก็บได้: {json.dumps(requirements, ensure_ascii=False)}]"
+    message_tokens = estimate_tokens(user_message)
+
+    kept = compact_history(history, requirements, CHAT_TOKEN_BUDGET - PROMPT_PREFIX_TOKENS - message_tokens)
+    contents = []
+    for msg in kept:
+        role = "user" if msg["role"] == "user" else "model"
+        contents.append({"role": role, "parts": [{"text": msg["content"]}]})
+    contents.append({"role": "user", "parts": [{"text": user_message}]})
+
+    history_tokens = sum(estimate_tokens(msg["content"]) for msg in history)
+    kept_tokens = sum(estimate_tokens(msg["content"]) for msg in kept)
+    _record_context_stats(
+        prompt_tokens=PROMPT_PREFIX_TOKENS + kept_tokens + message_tokens,
+        tokens_saved_compaction=history_tokens - kept_tokens,
+    )
+    PROMPT_TOKENS.observe(PROMPT_PREFIX_TOKENS + kept_tokens + message_tokens)
+    return contents
+
+def build_chat_response(clean_text: str, extracted_data: Dict[str, Any]) -> ChatResponse:
+    quick_replies = extracted_data.get("quick_replies", [])
+
+    result = ChatResponse(
+        response=clean_text,
+        extracted_data=extracted_data,
+        quick_replies=quick_replies,
+        current_step=extracted_data.get("current_step", 1),
+        is_checkpoint=extracted_data.get("is_checkpoint", False),
+        show_quotation=False,
+        quotation_data={}
+    )
+
+    if extracted_data.get("confirmed_design") and extracted_data.get("current_step", 0) >= 10:
+        quotation = generate_quotation(extracted_data)
+        # ตารางราคาหลายจำนวนไปพร้อมใบเสนอราคา ลูกค้าไม่ต้องถามโมเดลซ้ำทีละจำนวน
+        tiers = [*PRICE_BREAK_QUANTITIES, quotation["quantity"]]
+        try:
+            quotation["price_breaks"] = generate_price_breaks(extracted_data, tiers)
+        except ValueError:
+            pass
+        result.show_quotation = True
+        result.quotation_data = quotation
+
+    return result
+
+def _sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/api/chat", response_model=ChatResponse)
+async def chat_with_ai(request: ChatRequest):
+    started = time.perf_counter()
+    # session store (sqlite), quotation_store และ transcript เป็น I/O แบบ sync จึงทำใน threadpool
+    session_id, session = await run_in_threadpool(load_chat_session, request)
+    local = quick_reply_turn(session, request.message)
+    if local:
+        result, question = local
+        await run_in_threadpool(record_chat_turn, session_id, session, request.message, result, question)
+        record_fast_path_stats(True, time.perf_counter() - started)
+        return result
+
+    record_fast_path_stats(False, time.perf_counter() - started)
+    cache_key, cached = cached_chat_turn(session, request.message)
+    if cached:
+        await run_in_threadpool(record_chat_turn, session_id, session, request.message, cached,
+                                model_reply=as_model_reply(cached))
+        return cached
+
+    if not model_configured():
+        raise HTTPException(status_code=500, detail="GEMINI_API_KEY not configured")
+    
+    try:
+        contents = build_chat_contents(request.message, session["history"], session["requirements"])
+        response_text = await generate_content_async(contents, *choose_route(session["requirements"]))
+        
+        clean_text, extracted_data, status = parse_model_reply(response_text)
+        record_extraction_stats(status)
+        if cache_key:
+            chat_response_cache.put(cache_key, clean_text, extracted_data)
+        
+        result = build_chat_response(clean_text, extracted_data)
+        await run_in_threadpool(record_chat_turn, session_id, session, request.message, result,
+                                model_reply=response_text)
+        return result
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"AI Error: {str(e)}")
+
+@app.post("/api/chat/stream")
+def chat_with_ai_stream(request: ChatRequest):
+    """เหมือน /api/chat แต่ส่งข้อความเป็น Server-Sent Events ทีละ token
+
+    event: token  -> {"text": "..."} ข้อความที่แสดงได้ (ไม่มี <extracted_data>)
+    event: done   -> ChatResponse เต็ม (quick_replies, quotation_data ฯลฯ)
+    event: error  -> {"detail": "..."}
+    """
+    started = time.perf_counter()
+    session_id, session = load_chat_session(request)
+    local = quick_reply_turn(session, request.message)
+    if local:
+        result, question = local
+        record_chat_turn(session_id, session, request.message, result, question)
+        record_fast_path_stats(True, time.perf_counter() - started)
+        body = iter([_sse_event("token", {"text": result.response}), _sse_event("done", result.model_dump())])
+        return StreamingResponse(body, media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    record_fast_path_stats(False, time.perf_counter() - started)
+    cache_key, cached = cached_chat_turn(session, request.message)
+    if cached:
+        record_chat_turn(session_id, session, request.message, cached, model_reply=as_model_reply(cached))
+        body = iter([_sse_event("token", {"text": cached.response}), _sse_event("done", cached.model_dump())])
+        return StreamingResponse(body, media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    if not model_configured():
+        raise HTTPException(status_code=500, detail="GEMINI_API_KEY not configured")
+
+    contents = build_chat_contents(request.message, session["history"], session["requirements"])
+    route, reason = choose_route(session["requirements"])
+    if not model_router.candidates(route):
+        model_router.record_turn(route, reason, None)
+        raise model_router.unavailable()
+    acquire_llm_slot()
+
+    async def events():
+        parser = ExtractedDataFilter()
+        visible = []
+        raw = []
+        model_started = time.perf_counter()
+        deadline = time.monotonic() + LLM_TIMEOUT_SECONDS
+        outcome = "error"
+        loop = asyncio.get_running_loop()
+
+        async def before_deadline(fn, *args):
+            """เรียกโมเดล (เปิด stream หรืออ่าน chunk ถัดไป) ใน thread โดยรอไม่เกินเวลาที่เหลือของ deadline
+            โมเดลที่ค้างระหว่าง chunk จึงไม่ถือ connection และ slot ไว้เกิน LLM_TIMEOUT_SECONDS
+            (thread ที่ค้างทำงานต่อจนโมเดลตอบหรือ http timeout ของ client)"""
+            nonlocal outcome
+            try:
+                return await asyncio.wait_for(loop.run_in_executor(_llm_executor, fn, *args),
+                                              deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                outcome = "timeout"
+                raise TimeoutError(f"no complete response within {LLM_TIMEOUT_SECONDS:g}s") from None
+
+        try:
+            _, chunk, stream = await before_deadline(model_router.open_stream, contents, route, reason, deadline)
+            MODEL_FIRST_TOKEN.observe(time.perf_counter() - model_started)
+            while chunk is not None:
+                raw.append(chunk.text or "")
+                text = parser.feed(raw[-1])
+                if text:
+                    visible.append(text)
+                    yield _sse_event("token", {"text": text})
+                chunk = await before_deadline(next, stream, None)
+            outcome = "ok"
+            MODEL_LATENCY.observe(time.perf_counter() - model_started, "stream", outcome)
+            RESPONSE_TOKENS.observe(estimate_tokens("".join(raw)))
+            text = parser.close()
+            if text:
+                visible.append(text)
+                yield _sse_event("token", {"text": text})
+
+            record_extraction_stats(parser.status)
+            clean_text = "".join(visible).strip()
+            if cache_key:
+                chat_response_cache.put(cache_key, clean_text, parser.data)
+            result = build_chat_response(clean_text, parser.data)
+            await run_in_threadpool(record_chat_turn, session_id, session, request.message, result,
+                                    model_reply="".join(raw))
+            yield _sse_event("done", result.model_dump())
+        except Exception as e:
+            if outcome != "ok":
+                MODEL_LATENCY.observe(time.perf_counter() - model_started, "stream", outcome)
+            yield _sse_event("error", {"detail": f"AI Error: {str(e)}"})
+        finally:
+            release_slot()
+
+    body = events()
+    # คืน slot ครั้งเดียว: เมื่อ stream จบ หรือเมื่อ generator ถูกทิ้ง (client ตัดก่อนเริ่ม stream)
+    release_slot = weakref.finalize(body, release_llm_slot)
+
+    return StreamingResponse(
+        body,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def _calculate_price(body: bytes, tables: Dict[str, Any]) -> bytes:
+    requirements = parse_json_body(body, _REQUIREMENTS_BODY)
+    try:
+        quotation = generate_quotation(requirements, tables)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Calculation Error: {str(e)}")
+    if "quantities" in requirements:
+        try:
+            quotation = {**quotation, "price_breaks": generate_price_breaks(
+                requirements, requirements["quantities"], tables=tables)}
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return encode_json(quotation)
+
+@app.post("/api/calculate-price", openapi_extra=json_body_schema({"type": "object"}))
+async def calculate_price(request: Request):
+    """ถ้ามี "quantities": [500, 1000, ...] จะได้ตารางราคาตามจำนวน (price_breaks) มาด้วย
+
+    body ที่ตรงกันทุก byte (ภายใต้ catalog เวอร์ชันเดียวกัน) ใช้ผลคำนวณร่วมกัน ดู REQUEST COALESCING
+    """
+    body = await request.body()
+    # key และการคำนวณใช้ catalog ตัวเดียวกัน reload ระหว่างนี้จะไม่เก็บราคาใหม่ไว้ใต้เวอร์ชันเก่า
+    catalog = pricing_catalog
+    content = await coalesced_responses.run(("calculate-price", catalog.version), body,
+                                            lambda: _calculate_price(body, catalog.tables))
+    return Response(content=content, media_type="application/json")
+
+@app.post("/api/calculate-price/batch")
+def calculate_price_batch(request: BatchPriceRequest):
+    try:
+        results = generate_quotations_batch(request.items)
+        return {"count": len(results), "results": results}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Calculation Error: {str(e)}")
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match", "")
+    return if_none_match.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+@app.get("/api/pricing-info")
+def get_pricing_info(request: Request):
+    # body สร้างไว้แล้วตอนโหลด catalog ส่ง 304 ถ้า client มีเวอร์ชันนี้อยู่แล้ว
+    catalog = pricing_catalog
+    headers = {"ETag": catalog.etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request, catalog.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=catalog.body, media_type="application/json", headers=headers)
+
+@app.get("/api/pricing-kernel")
+def get_pricing_kernel(request: Request,
+                       width: float = Query(gt=0, allow_inf_nan=False),
+                       length: float = Query(gt=0, allow_inf_nan=False),
+                       height: float = Query(gt=0, allow_inf_nan=False),
+                       box_type: str = "RSC"):
+    """ตัวเลขคิดราคาของขนาด + ชนิดกล่องนี้ (ดู PRICING KERNEL) ETag คือ checksum ของ kernel"""
+    kernel = build_pricing_kernel(width, length, height, box_type)
+    headers = {"ETag": f'"{kernel["checksum"]}"', "Cache-Control": "no-cache"}
+    if _etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=json.dumps(kernel, ensure_ascii=False), media_type="application/json", headers=headers)
+
+@app.post("/api/pricing-kernel/verify")
+def verify_pricing_kernel(request: KernelVerifyRequest):
+    try:
+        return verify_kernel_quote(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Calculation Error: {str(e)}")
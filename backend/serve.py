@@ -0,0 +1,146 @@
+"""Production entry point: pre-forked uvicorn workers sharing one preloaded copy of main.
+
+Run from the backend directory, e.g.:
+
+    python serve.py --workers 4 --port 8000
+
+The master process imports ``main`` once (pricing catalog, price tables, NumPy, FastAPI app),
+freezes those objects out of the garbage collector and then forks the workers, so the
+read-only data stays in copy-on-write pages shared by every worker instead of being rebuilt
+per process. Workers share one listening socket. The genai SDK is imported lazily per worker
+(see ``main.get_client``) and warmed up in the background once the worker is serving.
+
+Needs ``os.fork`` (Linux/macOS). On Windows use ``uvicorn main:app --workers N``.
+"""
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+
+# worker ที่ตายเร็วกว่านี้หลัง fork ถือว่าเริ่มไม่ขึ้น (เช่น config ผิด) ไม่ fork ซ้ำวนไปเรื่อย ๆ
+MIN_WORKER_UPTIME_SECONDS = 1.0
+
+
+def _listen(host: str, port: int, backlog: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(sock: socket.socket, args) -> None:
+    import uvicorn
+
+    import main
+
+    config = uvicorn.Config(
+        main.app,
+        log_level=args.log_level,
+        timeout_keep_alive=args.keep_alive,
+        backlog=args.backlog,
+    )
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def _fork_worker(sock: socket.socket, args) -> int:
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        code = 0
+        try:
+            _run_worker(sock, args)
+        except BaseException:
+            import traceback
+
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def serve(args) -> int:
+    if not hasattr(os, "fork"):
+        print("serve.py needs os.fork; use `uvicorn main:app --workers N` on this platform", file=sys.stderr)
+        return 2
+
+    # หลาย worker ใช้ session ในหน่วยความจำร่วมกันไม่ได้ จึงใช้ SQLite เป็นค่าเริ่มต้น
+    if args.workers > 1:
+        os.environ.setdefault("SESSION_BACKEND", "sqlite")
+    if args.prewarm:
+        os.environ.setdefault("GEMINI_PREWARM", "1")
+
+    sock = _listen(args.host, args.port, args.backlog)
+    if args.preload:
+        import uvicorn  # noqa: F401  (ให้ worker ได้ module ที่ import แล้วไปด้วย)
+
+        import main  # noqa: F401
+
+        # ย้าย object ที่มีอยู่ทั้งหมดออกจาก GC ไม่ให้ worker เขียน header ของมันจน page ถูก copy
+        gc.collect()
+        gc.freeze()
+
+    workers = {}
+    for _ in range(args.workers):
+        workers[_fork_worker(sock, args)] = time.monotonic()
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    print(f"serving on http://{args.host}:{args.port} with {args.workers} workers "
+          f"(preload={'on' if args.preload else 'off'}, master pid {os.getpid()})", flush=True)
+
+    exit_code = 0
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = workers.pop(pid, None)
+        if started is None or stopping:
+            continue
+        if time.monotonic() - started < MIN_WORKER_UPTIME_SECONDS:
+            print(f"worker {pid} exited during startup (status {status}); shutting down", file=sys.stderr)
+            exit_code = 1
+            stop(None, None)
+            continue
+        print(f"worker {pid} exited (status {status}); starting a replacement", file=sys.stderr, flush=True)
+        workers[_fork_worker(sock, args)] = time.monotonic()
+
+    sock.close()
+    return exit_code
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--keep-alive", type=int, default=5, help="HTTP keep-alive timeout (s)")
+    parser.add_argument("--log-level", default="info")
+    parser.add_argument("--no-preload", dest="preload", action="store_false",
+                        help="import main in every worker instead of once in the master")
+    parser.add_argument("--no-prewarm", dest="prewarm", action="store_false",
+                        help="do not open the Gemini connection until the first chat call")
+    sys.exit(serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main_cli()
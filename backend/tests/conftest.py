@@ -0,0 +1,93 @@
+"""fixture ร่วมของ test: โมเดลปลอมแทน genai client และ state ของ main ที่เริ่มใหม่ทุก test"""
+import json
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+# ไฟล์ที่ main เขียน (session, ใบเสนอราคา, bulk job) อยู่ใน temp dir ไม่ปนกับของจริง และไม่เรียก Gemini จริง
+_WORKDIR = tempfile.mkdtemp(prefix="lumopack-tests-")
+os.environ.update({
+    "GEMINI_API_KEY": "",
+    "SESSION_BACKEND": "memory",
+    "QUOTATION_DB_PATH": os.path.join(_WORKDIR, "quotations.db"),
+    "BULK_JOB_DIR": os.path.join(_WORKDIR, "bulk_jobs"),
+    "CHAT_TRANSCRIPT_DIR": "",
+    "GEMINI_PROMPT_CACHE": "",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+EXTRACTED = {
+    "product_type": None,
+    "box_type": None,
+    "current_step": 2,
+    "is_checkpoint": False,
+    "quick_replies": ["สินค้าทั่วไป", "Non-food", "Food-grade", "เครื่องสำอาง"],
+}
+REPLY = (
+    "สวัสดีครับ ผมลูโม่ ผู้ช่วยออกแบบบรรจุภัณฑ์ของ LumoPack 😊 "
+    "ขอทราบก่อนว่าสินค้าของคุณเป็นประเภทไหนครับ?\n\n"
+    f"<extracted_data>\n{json.dumps(EXTRACTED, ensure_ascii=False, indent=2)}\n</extracted_data>"
+)
+
+
+class FakeModels:
+    """แทน client.models: ตอบ reply เดิมทุกครั้ง (stream ทีละ chunk_size ตัวอักษร) และจำ request ที่ได้รับ"""
+
+    def __init__(self, reply: str = REPLY, chunk_size: int = 4):
+        self.reply = reply
+        self.chunk_size = chunk_size
+        self.requests = []
+
+    def generate_content(self, model, contents, config=None):
+        self.requests.append({"model": model, "contents": contents, "config": config})
+        return SimpleNamespace(text=self.reply)
+
+    def generate_content_stream(self, model, contents, config=None):
+        self.requests.append({"model": model, "contents": contents, "config": config})
+        for i in range(0, len(self.reply), self.chunk_size):
+            yield SimpleNamespace(text=self.reply[i:i + self.chunk_size])
+
+
+class FakeCaches:
+    def __init__(self):
+        self.created = []
+
+    def create(self, model, config):
+        cache = SimpleNamespace(name=f"cachedContents/fake-{len(self.created)}", model=model, config=config)
+        self.created.append(cache)
+        return cache
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(main, "session_store", main.MemorySessionStore())
+    monkeypatch.setattr(main, "model_router", main.ModelRouter(
+        main.LLM_ROUTES, main.LLM_HEDGE_AFTER_SECONDS, main.LLM_RETRIES, main.LLM_RETRY_BACKOFF_SECONDS,
+        main.LLM_BREAKER_FAILURES, main.LLM_BREAKER_RESET_SECONDS))
+    monkeypatch.setattr(main, "prompt_cache", main.PromptCache(False, main.GEMINI_PROMPT_CACHE_TTL_SECONDS))
+    monkeypatch.setattr(main, "context_stats", {"turns": 0, "prompt_tokens": 0, "tokens_saved_compaction": 0,
+                                                "tokens_saved_cache": 0, "last_turn": {}})
+    main.chat_response_cache.clear()
+    yield
+    main.chat_response_cache.clear()
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    """genai client ปลอม: get_client() และ main.client ชี้มาที่ตัวนี้"""
+    client = SimpleNamespace(models=FakeModels(), caches=FakeCaches())
+    monkeypatch.setattr(main, "client", client)
+    monkeypatch.setattr(main, "get_client", lambda: client)
+    return client
+
+
+@pytest.fixture
+def http():
+    from fastapi.testclient import TestClient
+
+    return TestClient(main.app)
@@ -0,0 +1,50 @@
+import random
+
+import numpy as np
+import pytest
+
+import main
+
+
+def random_requirements(rng: random.Random, size: float, quantity: int) -> dict:
+    return {
+        "product_type": rng.choice(list(main.PRODUCT_TYPE_MATERIALS)),
+        "box_type": rng.choice(["RSC", "Die-cut"]),
+        "dimensions": {
+            "width": rng.choice([rng.randint(5, 60), round(rng.uniform(1, size), 1)]),
+            "length": round(rng.uniform(1, size), 2),
+            "height": rng.uniform(1, size),
+        },
+        "quantity": rng.randint(1, quantity),
+        "inner": {
+            "cushioning": rng.choice([None, *main.INNER_PRICES]),
+            "moisture_coating": rng.choice([None, *main.MOISTURE_COATING_PRICES]),
+            "food_coating": rng.choice([None, *main.FOOD_COATING_PRICES]),
+        },
+        "special_features": {
+            "gloss_coating": rng.choice([None, *main.GLOSS_COATING_PRICES]),
+            "matte_coating": rng.choice([None, *main.MATTE_COATING_PRICES]),
+            "emboss": {"type": rng.choice([None, "ปั๊มนูน"]), "has_block": rng.random() < 0.5},
+            "foil": {"type": rng.choice([None, "ทอง", *main.FOIL_BLOCK_PRICES]), "has_block": rng.random() < 0.5},
+        },
+    }
+
+
+@pytest.mark.parametrize("size, quantity", [(60, 10_000), (2_000, 1_000_000), (100_000, 10 ** 9)])
+def test_batch_equals_generate_quotation(size, quantity):
+    rng = random.Random(size)
+    rows = [random_requirements(rng, size, quantity) for _ in range(2000)]
+    assert main.generate_quotations_batch(rows) == [main.generate_quotation(row) for row in rows]
+
+
+def test_round_array_matches_round_at_every_magnitude():
+    rng = random.Random(1)
+    values = []
+    for exponent in range(-2, 17):
+        for _ in range(2000):
+            # ค่าที่ลงท้าย .xx5 (จุดที่ปัดต่างกันง่ายที่สุด) และผลคูณของมัน
+            half = rng.randint(0, 10 ** max(exponent, 0)) + rng.choice([0.005, 0.015, 0.125, 0.995, rng.random()])
+            values.append(half * rng.choice([1, 3, 7, 1.1, 1.5, 0.1]))
+            values.append(float(f"{rng.uniform(0, 10 ** exponent):.3f}"))
+    values += [-v for v in values[:1000]]
+    assert main._round_array(np.array(values)).tolist() == [round(v, 2) for v in values]
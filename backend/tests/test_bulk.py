@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+
+import pytest
+
+import main
+
+CSV = "product_type,box_type,width,length,height,quantity\nFood-grade,RSC,20,30,10,1000\n".encode("utf-8")
+
+
+@pytest.fixture
+def jobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "BULK_JOB_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "bulk_jobs", {})
+    return tmp_path
+
+
+def finished_job(status: str = "done", age_hours: float = 0.0) -> main.BulkQuotationJob:
+    job = main.BulkQuotationJob.create("csv")
+    with open(job.input_path, "wb") as f:
+        f.write(CSV)
+    job.state.update(status=status, input_size=len(CSV))
+    job.save()
+    stamp = time.time() - age_hours * 3600
+    for name in os.listdir(job.dir):
+        os.utime(os.path.join(job.dir, name), (stamp, stamp))
+    os.utime(job.dir, (stamp, stamp))
+    return job
+
+
+def wait_until_done(http, job_id: str) -> dict:
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        status = http.get(f"/api/calculate-price/jobs/{job_id}").json()
+        if status["status"] not in ("queued", "running"):
+            return status
+        time.sleep(0.01)
+    raise AssertionError("job did not finish")
+
+
+def test_job_prices_the_upload(jobs, http):
+    job_id = http.post("/api/calculate-price/jobs", content=CSV).json()["job_id"]
+    assert wait_until_done(http, job_id)["rows_done"] == 1
+    result = http.get(f"/api/calculate-price/jobs/{job_id}/result").content.decode("utf-8-sig")
+    assert result.splitlines()[1].startswith("Food-grade,RSC,20,30,10,1000,")
+
+
+def test_sweep_removes_only_expired_finished_jobs(jobs, monkeypatch):
+    monkeypatch.setattr(main, "BULK_JOB_RETENTION_HOURS", 24)
+    expired = [finished_job(status, age_hours=30) for status in ("done", "failed", "cancelled")]
+    recent = finished_job("done", age_hours=1)
+    # process เจ้าของยังรันอยู่ (process นี้ไม่ใช่ เพราะ load ถือว่า pid ตัวเองที่ไม่อยู่ใน bulk_jobs ตายแล้ว)
+    elsewhere = finished_job("running", age_hours=30)
+    elsewhere.state["pid"] = os.getppid()
+    elsewhere.save()
+    os.utime(os.path.join(elsewhere.dir, "job.json"), (0, 0))
+    os.utime(elsewhere.dir, (0, 0))
+    abandoned_upload = main.BulkQuotationJob.create("csv")
+    os.utime(abandoned_upload.dir, (0, 0))
+
+    usage = main.sweep_bulk_jobs()
+    remaining = set(os.listdir(jobs))
+    assert remaining == {recent.id, elsewhere.id}
+    assert not any(job.id in remaining for job in expired)
+    assert usage == sum(main._dir_usage(os.path.join(jobs, name))[0] for name in remaining)
+
+
+def test_active_jobs_are_capped(jobs, http, monkeypatch):
+    monkeypatch.setattr(main, "BULK_MAX_ACTIVE_JOBS", 1)
+    release = threading.Event()
+    monkeypatch.setattr(main, "price_bulk_rows", lambda fields, rows: release.wait(5) and [])
+    first = http.post("/api/calculate-price/jobs", content=CSV)
+    try:
+        assert first.status_code == 202
+        second = http.post("/api/calculate-price/jobs", content=CSV)
+        assert second.status_code == 429 and second.headers["retry-after"]
+        # job ที่ถูกปฏิเสธไม่ทิ้งโฟลเดอร์ไว้
+        assert os.listdir(jobs) == [first.json()["job_id"]]
+    finally:
+        release.set()
+    wait_until_done(http, first.json()["job_id"])
+    assert http.post("/api/calculate-price/jobs", content=CSV).status_code == 202
+
+
+def test_uploads_stop_at_the_disk_limit(jobs, http, monkeypatch):
+    monkeypatch.setattr(main, "BULK_MAX_DISK_MB", 1)
+    finished_job("done")
+    big = CSV + b"Food-grade,RSC,20,30,10,1000\n" * 40_000
+    response = http.post("/api/calculate-price/jobs", content=big)
+    assert response.status_code == 507
+    assert len(os.listdir(jobs)) == 1
+
+    filler = finished_job("done")
+    with open(filler.input_path, "wb") as f:
+        f.write(b"x" * 1024 * 1024)
+    assert http.post("/api/calculate-price/jobs", content=CSV).status_code == 507
+    http.delete(f"/api/calculate-price/jobs/{filler.id}")
+    assert http.post("/api/calculate-price/jobs", content=CSV).status_code == 202
@@ -0,0 +1,87 @@
+import copy
+import os
+
+import pytest
+
+import main
+
+REQUIREMENTS = {"product_type": "สินค้าทั่วไป", "box_type": "RSC",
+                "dimensions": {"width": 20, "length": 30, "height": 10}, "quantity": 1000}
+
+
+def catalog_with_base_cost(factor: float) -> main.PricingCatalog:
+    data = copy.deepcopy(main.validate_catalog(main.read_catalog_file(main.PRICING_CATALOG_PATH)))
+    for materials in data["base_box_prices"].values():
+        for spec in materials.values():
+            spec["cost"] *= factor
+    return main.PricingCatalog(data)
+
+
+@pytest.fixture
+def restore_catalog():
+    original = main.pricing_catalog
+    main.coalesced_responses.clear()
+    yield original
+    main.install_pricing_catalog(original)
+    main.coalesced_responses.clear()
+    main.quotation_cache.clear()
+
+
+def test_legacy_names_follow_the_published_catalog(restore_catalog):
+    doubled = catalog_with_base_cost(2)
+    main.install_pricing_catalog(doubled)
+    assert main.PRICE_TABLES is doubled.tables
+    assert main.BASE_BOX_PRICES is doubled.data["base_box_prices"]
+    assert main.INNER_PRICES is doubled.data["inner_prices"]
+    with pytest.raises(AttributeError):
+        main.NOT_A_TABLE
+
+
+def test_reload_during_a_request_does_not_cache_new_prices_under_the_old_version(restore_catalog, http,
+                                                                                 monkeypatch):
+    original = restore_catalog
+    doubled = catalog_with_base_cost(2)
+    calculate = main._calculate_price
+
+    def reload_then_calculate(*args):
+        # catalog เปลี่ยนหลังจาก request อ่าน key ของ coalescing ไปแล้ว
+        main.install_pricing_catalog(doubled)
+        return calculate(*args)
+
+    monkeypatch.setattr(main, "_calculate_price", reload_then_calculate)
+    first = http.post("/api/calculate-price", json=REQUIREMENTS).json()
+    assert first["catalog_version"] == original.version
+    assert first == main.generate_quotation(REQUIREMENTS, original.tables)
+
+    monkeypatch.setattr(main, "_calculate_price", calculate)
+    main.install_pricing_catalog(original)
+    assert http.post("/api/calculate-price", json=REQUIREMENTS).json() == first
+    main.install_pricing_catalog(doubled)
+    second = http.post("/api/calculate-price", json=REQUIREMENTS).json()
+    assert second["catalog_version"] == doubled.version
+    assert second["pricing"]["grand_total"] > first["pricing"]["grand_total"]
+
+
+def test_broken_catalog_file_keeps_the_current_snapshot(restore_catalog, tmp_path, monkeypatch):
+    path = tmp_path / "catalog.json"
+    path.write_text(restore_catalog.body.decode("utf-8"), encoding="utf-8")
+    current = main.load_pricing_catalog(str(path))
+    main.install_pricing_catalog(current)
+    path.write_text("{", encoding="utf-8")
+    os.utime(path, ns=(current.mtime_ns + 10 ** 9, current.mtime_ns + 10 ** 9))
+
+    reloads = []
+    reload = main.reload_pricing
+    monkeypatch.setattr(main, "reload_pricing", lambda *args: reloads.append(args) or reload(*args))
+
+    class StopAfter:
+        def __init__(self, rounds):
+            self.rounds = rounds
+
+        def wait(self, interval):
+            self.rounds -= 1
+            return self.rounds < 0
+
+    main.watch_pricing_catalog(StopAfter(3), interval=0)
+    assert len(reloads) == 1
+    assert main.pricing_catalog is current and current.mtime_ns != os.stat(path).st_mtime_ns
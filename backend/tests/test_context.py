@@ -0,0 +1,88 @@
+import threading
+import time
+
+import pytest
+
+import main
+
+
+def sent_tokens(request: dict) -> int:
+    return sum(main.estimate_tokens(part["text"]) for msg in request["contents"] for part in msg["parts"])
+
+
+def converse(http, turns: int) -> list:
+    session_id, last_turns = None, []
+    for turn in range(1, turns + 1):
+        body = {"message": f"ข้อความรอบที่ {turn} " + "ขอรายละเอียดเพิ่มเติม" * 20}
+        if session_id:
+            body["session_id"] = session_id
+        response = http.post("/api/chat", json=body)
+        assert response.status_code == 200, response.text
+        session_id = response.json()["session_id"]
+        last_turns.append(dict(main.context_stats["last_turn"]))
+    return last_turns
+
+
+@pytest.mark.parametrize("budget", [2000, 4000])
+def test_every_prompt_fits_the_token_budget(fake_client, http, monkeypatch, budget):
+    monkeypatch.setattr(main, "CHAT_TOKEN_BUDGET", budget)
+    turns = converse(http, 20)
+    assert all(turn["prompt_tokens"] <= budget for turn in turns)
+    # ประวัติยาวเกินงบแล้ว ต้องมีการตัดจริง และสิ่งที่ส่งจริงเท่ากับที่นับไว้
+    assert turns[-1]["tokens_saved_compaction"] > 0
+    assert sent_tokens(fake_client.models.requests[-1]) == turns[-1]["prompt_tokens"]
+
+
+def test_compacted_history_starts_with_a_user_turn_and_keeps_the_latest():
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"ข้อความ {i} " * 50} for i in range(40)]
+    kept = main.compact_history(history, {"product_type": "Food-grade"}, budget=600)
+    assert kept and kept[0]["role"] == "user" and kept[-1] == history[-1]
+    assert sum(main.estimate_tokens(msg["content"]) for msg in kept) <= 600
+    assert main.compact_history(history[:4], {}, budget=10 ** 6) == history[:4]
+
+
+def test_prompt_cache_replaces_the_prefix(fake_client, http, monkeypatch):
+    monkeypatch.setattr(main, "prompt_cache", main.PromptCache(True, 3600))
+    turns = converse(http, 5)
+    assert len(fake_client.caches.created) == 1
+    for turn, request in zip(turns, fake_client.models.requests):
+        assert request["config"] == {"cached_content": fake_client.caches.created[0].name}
+        assert sent_tokens(request) == turn["prompt_tokens"] - main.PROMPT_PREFIX_TOKENS
+    assert main.context_stats["tokens_saved_cache"] == main.PROMPT_PREFIX_TOKENS * 5
+
+
+def test_prompt_cache_retries_after_a_failed_create(fake_client):
+    attempts = []
+    create = fake_client.caches.create
+
+    def flaky_create(model, config):
+        attempts.append(model)
+        if len(attempts) == 1:
+            raise ConnectionError("transient network error")
+        return create(model, config)
+
+    fake_client.caches.create = flaky_create
+    cache = main.PromptCache(True, 3600, retry_seconds=0.2)
+    # ล้มแล้วส่ง prefix ตามปกติ ไม่ลองซ้ำก่อนครบ retry_seconds
+    assert cache.get("m") is None and cache.get("m") is None and len(attempts) == 1
+    time.sleep(0.2)
+    assert cache.get("m") and cache.get("m") and len(attempts) == 2
+    assert cache.enabled and cache.failures == 0
+
+
+def test_prompt_cache_does_not_block_while_creating(fake_client):
+    release = threading.Event()
+    create = fake_client.caches.create
+    fake_client.caches.create = lambda model, config: release.wait(5) and create(model, config)
+    cache = main.PromptCache(True, 3600)
+    creator = threading.Thread(target=cache.get, args=("m",))
+    creator.start()
+    try:
+        time.sleep(0.05)
+        started = time.perf_counter()
+        assert cache.get("m") is None
+        assert time.perf_counter() - started < 0.05
+    finally:
+        release.set()
+        creator.join()
+    assert cache.get("m") == "cachedContents/fake-0"
@@ -0,0 +1,122 @@
+import json
+import random
+import re
+
+import pytest
+
+import main
+
+FULL_EXTRACTED = {
+    "product_type": "Food-grade", "box_type": "Die-cut",
+    "inner": {"cushioning": "บับเบิ้ล", "moisture_coating": None, "food_coating": "PLA/Bio Coating"},
+    "dimensions": {"width": 20, "length": 30.5, "height": 10}, "quantity": 1000, "mood_tone": "มินิมอล",
+    "logo": {"has_logo": True, "position": "ด้านบน"},
+    "special_features": {
+        "gloss_coating": None, "matte_coating": "UV ด้าน",
+        "emboss": {"type": None, "has_block": False}, "foil": {"type": "ทอง", "color": None, "has_block": True},
+    },
+    "current_step": 10, "is_checkpoint": False, "confirmed_structure": True, "confirmed_design": True,
+    "confirmed_order": False, "quick_replies": ["ยืนยัน ✓", "ขอแก้ไข"],
+}
+EXPECTED = main.validate_extracted_data(FULL_EXTRACTED)[0]
+OPEN_TAG, CLOSE_TAG = main.ExtractedDataFilter.OPEN_TAG, main.ExtractedDataFilter.CLOSE_TAG
+
+
+def model_reply(rng: random.Random, prose_chars: int) -> str:
+    words = ["กล่อง", "ขนาด", "{ตัวอย่าง}", "ราคา", "ครับ", "😊", "<b>", "RSC", "\n", "}", "จำนวน"]
+    prose = []
+    while sum(map(len, prose)) < prose_chars:
+        prose.append(rng.choice(words))
+    block = json.dumps(FULL_EXTRACTED, ensure_ascii=False, indent=rng.choice([None, 2]))
+    return " ".join(prose) + "\n\n<extracted_data>\n" + block + "\n</extracted_data>"
+
+
+def mutate(text: str, rng: random.Random) -> str:
+    chars = list(text)
+    for _ in range(rng.randint(1, 4)):
+        position = rng.randrange(len(chars) + 1)
+        if rng.random() < 0.5 and chars:
+            del chars[min(position, len(chars) - 1)]
+        else:
+            chars.insert(position, rng.choice(['{', '}', '[', ']', ',', '"', ':', OPEN_TAG,
+                                               CLOSE_TAG, 'True', '\\', '\n']))
+    return "".join(chars)
+
+
+def stream_parse(text: str, rng: random.Random):
+    parser = main.ExtractedDataFilter()
+    visible, i = [], 0
+    while i < len(text):
+        size = rng.randint(1, 24)
+        visible.append(parser.feed(text[i:i + size]))
+        i += size
+    visible.append(parser.close())
+    return "".join(visible).strip(), parser.data, parser.status
+
+
+def is_prefix_of(part, whole) -> bool:
+    """ข้อมูลที่ซ่อมแล้วขาดส่วนท้ายได้ แต่ห้ามแต่งหรือเปลี่ยนค่า"""
+    if isinstance(part, dict):
+        return isinstance(whole, dict) and all(k in whole and is_prefix_of(v, whole[k]) for k, v in part.items())
+    if isinstance(part, list):
+        return isinstance(whole, list) and len(part) <= len(whole) and all(map(is_prefix_of, part, whole))
+    return part == whole
+
+
+def test_complete_reply_parses_cleanly():
+    text = model_reply(random.Random(1), 300)
+    clean, data, status = main.parse_model_reply(text)
+    assert status == "ok" and data == EXPECTED
+    assert clean == text[:text.index(OPEN_TAG)].strip()
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_fuzzed_replies_keep_the_invariants(seed):
+    rng = random.Random(seed)
+    for _ in range(500):
+        original = model_reply(rng, rng.randint(0, 400))
+        text = mutate(original, rng)
+        one_shot = main.parse_model_reply(text)
+        assert one_shot == stream_parse(text, rng), text
+        clean = one_shot[0]
+        # ยกเว้นแท็กซ้อนแบบ "<extracted_data</extracted_data>>" ที่ตัดแท็กในออกแล้วเกิดแท็กใหม่
+        stripped = re.sub(f"{OPEN_TAG}|{CLOSE_TAG}", "", text)
+        if OPEN_TAG not in stripped and CLOSE_TAG not in stripped:
+            assert OPEN_TAG not in clean and CLOSE_TAG not in clean, text
+
+
+def test_truncated_replies_only_lose_the_tail():
+    rng = random.Random(7)
+    for _ in range(500):
+        original = model_reply(rng, rng.randint(0, 200))
+        text = original[:rng.randint(0, len(original))]
+        one_shot = main.parse_model_reply(text)
+        assert one_shot == stream_parse(text, rng), text
+        clean, data, _ = one_shot
+        assert OPEN_TAG not in clean and CLOSE_TAG not in clean, text
+        assert is_prefix_of(data, EXPECTED), (text, data)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"a": 1, "b": [1, 2,', {"a": 1, "b": [1, 2]}),
+    ('{"a": True, "b": None,}', {"a": True, "b": None}),
+    ('{"a": [1, 2}', {"a": [1, 2]}),
+    ('{"a": 1} ข้อความต่อท้าย {', {"a": 1}),
+    # string/ตัวเลขที่ถูกตัดกลางคำถูกทิ้ง ไม่เดาค่า
+    ('{"a": "ab', {}),
+    ('{"a": 12', {}),
+    ('{"a": {"b": 1', {"a": {}}),
+    ("ไม่มี JSON", None),
+])
+def test_repair_json(text, expected):
+    assert main.repair_json(text) == expected
+
+
+def test_repair_json_never_invents_values():
+    rng = random.Random(3)
+    whole = json.dumps(FULL_EXTRACTED, ensure_ascii=False)
+    for _ in range(500):
+        assert is_prefix_of(main.repair_json(whole[:rng.randint(1, len(whole))]), FULL_EXTRACTED)
+        main.repair_json(mutate(whole, rng))
+    # วงเล็บซ้อนลึกต้องไม่ RecursionError
+    main.repair_json("{" * 10000)
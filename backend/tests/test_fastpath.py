@@ -0,0 +1,76 @@
+import json
+
+import main
+
+
+def model_reply(text: str, **extracted) -> str:
+    return f"{text}\n<extracted_data>{json.dumps(extracted, ensure_ascii=False)}</extracted_data>"
+
+
+DIMENSIONS_REPLY = model_reply("รับทราบครับ ต้องการผลิตกี่ชิ้นครับ?", dimensions={"width": 20, "length": 30, "height": 10},
+                               current_step=6, quick_replies=["500", "1000", "2000", "5000"])
+# ทุกปุ่มจนถึงคำถามลูกเล่นพิเศษ (เลือกฟอยล์ทองไปแล้ว) มีแค่ขนาดที่พิมพ์เองและต้องถามโมเดล
+TO_SPECIAL_FEATURES = [
+    "เริ่มต้น", "Food-grade", "Die-cut (ไดคัท)", "บับเบิ้ล", "ไม่ต้องการ", "PLA/Bio",
+    "20 x 30 x 10 ซม.", "1000", "ยืนยัน ✓", "พรีเมียม", "มีโลโก้", "ด้านบน",
+    "ปั๊มฟอยล์", "ทอง", "เคยทำแล้ว",
+]
+
+
+def chat(http, session_id, message: str) -> dict:
+    body = {"message": message, "session_id": session_id} if session_id else {"message": message}
+    response = http.post("/api/chat", json=body)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def run(http, messages: list, session_id=None) -> tuple:
+    data = None
+    for message in messages:
+        data = chat(http, session_id, message)
+        session_id = data["session_id"]
+    return session_id, data
+
+
+def test_quick_replies_are_answered_locally(fake_client, http):
+    fake_client.models.reply = DIMENSIONS_REPLY
+    session_id, data = run(http, TO_SPECIAL_FEATURES + ["เคลือบด้าน", "ลามิเนตด้าน", "ไม่ต้องการ", "ยืนยัน ✓",
+                                                        "ยืนยันคำสั่งซื้อ ✓"])
+    assert len(fake_client.models.requests) == 1
+    assert data["extracted_data"]["confirmed_order"]
+    assert main.session_store.get(session_id)["pending_question"] == "done"
+
+
+def test_emboss_block_after_foil_is_stored_by_question_id(fake_client, http):
+    fake_client.models.reply = DIMENSIONS_REPLY
+    session_id, data = run(http, TO_SPECIAL_FEATURES + ["ปั๊มนูน", "ยังไม่เคย"])
+    features = data["extracted_data"]["special_features"]
+    assert features["emboss"] == {"type": "ปั๊มนูน", "has_block": False}
+    assert features["foil"]["has_block"] is True
+    assert len(fake_client.models.requests) == 1
+
+
+def test_shared_block_replies_after_a_model_turn_go_to_the_model(fake_client, http):
+    fake_client.models.reply = DIMENSIONS_REPLY
+    session_id, _ = run(http, TO_SPECIAL_FEATURES)
+    # โมเดลถามเรื่องบล็อกปั๊มนูน ด้วยปุ่มชุดเดียวกับบล็อกฟอยล์ ทั้งที่เลือกฟอยล์ไว้แล้ว
+    fake_client.models.reply = model_reply(
+        "เคยทำบล็อกปั๊มนูนไว้แล้วหรือยังครับ?", special_features={"emboss": {"type": "ปั๊มนูน", "has_block": False}},
+        current_step=9, quick_replies=["เคยทำแล้ว", "ยังไม่เคย", "ใช้บล็อกเดิม"])
+    chat(http, session_id, "ขอปั๊มนูนโลโก้ด้วยครับ")
+    assert main.session_store.get(session_id)["pending_question"] is None
+
+    fake_client.models.reply = model_reply("รับทราบครับ", special_features={"emboss": {"has_block": True}},
+                                           current_step=9, quick_replies=[])
+    chat(http, session_id, "เคยทำแล้ว")
+    assert len(fake_client.models.requests) == 3
+
+
+def test_confirm_replies_follow_the_step():
+    confirm = ["ยืนยัน ✓", "ขอแก้ไข"]
+    assert main.question_for_replies(confirm, {"current_step": 6}) == "confirm_structure"
+    # แก้โครงสร้างหลังยืนยันไปแล้ว โมเดลถามยืนยันโครงสร้างซ้ำ
+    assert main.question_for_replies(confirm, {"confirmed_structure": True, "current_step": 6}) == "confirm_structure"
+    assert main.question_for_replies(confirm, {"confirmed_structure": True, "current_step": 9}) == "confirm_design"
+    assert main.question_for_replies(["500", "1000", "2000", "5000"], {}) == "quantity"
+    assert main.question_for_replies(["อื่น ๆ"], {}) is None
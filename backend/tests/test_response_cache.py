@@ -0,0 +1,87 @@
+import json
+import time
+
+import pytest
+
+import main
+
+DIMENSIONS_REPLY = (
+    "รับทราบครับ กล่องขนาด 20 x 30 x 10 ซม. 📏 ต้องการผลิตกี่ชิ้นครับ?\n"
+    "<extracted_data>"
+    + json.dumps({
+        "dimensions": {"width": 20, "length": 30, "height": 10},
+        "current_step": 6,
+        "quick_replies": ["500", "1000", "2000", "5000"],
+    }, ensure_ascii=False)
+    + "</extracted_data>"
+)
+# ไม่มี session_id และไม่มี pending_question จึงไม่เข้า fast path ทุก turn ไปถึง cache
+REQUIREMENTS = {"product_type": "Food-grade", "box_type": "Die-cut", "current_step": 5,
+                "quick_replies": ["บับเบิ้ล"], "inner": {"cushioning": None}}
+BODY = {"message": "บับเบิ้ล", "current_requirements": REQUIREMENTS}
+
+
+def without_session(data: dict) -> dict:
+    return {key: value for key, value in data.items() if key != "session_id"}
+
+
+@pytest.fixture
+def models(fake_client):
+    fake_client.models.reply = DIMENSIONS_REPLY
+    return fake_client.models
+
+
+def test_cached_turn_equals_the_model_turn(models, http):
+    model = http.post("/api/chat", json=BODY).json()
+    assert len(models.requests) == 1
+    # state เดียวกันที่เขียนต่างกัน (ช่องว่าง ค่าว่าง ลำดับ key) ต้องได้ key เดียวกัน
+    variant = {"message": "  บับเบิ้ล ", "current_requirements": {
+        "current_step": 5, "box_type": "Die-cut", "product_type": "Food-grade", "inner": {}, "dimensions": None}}
+    for _ in range(3):
+        assert without_session(http.post("/api/chat", json=variant).json()) == without_session(model)
+    stream = http.post("/api/chat/stream", json=BODY).text
+    assert json.loads(stream.split("data: ")[-1])["response"] == model["response"]
+    assert len(models.requests) == 1
+    assert main.chat_response_cache.summary()["hits"] == 4
+
+
+@pytest.mark.parametrize("body", [
+    {**BODY, "current_requirements": {**REQUIREMENTS, "current_step": 6}},
+    {**BODY, "message": "ขอกล่องแข็ง ๆ หน่อย"},
+])
+def test_other_steps_and_free_text_ask_the_model(models, http, body):
+    http.post("/api/chat", json=BODY)
+    http.post("/api/chat", json=body)
+    http.post("/api/chat", json=body)
+    # step อื่นเก็บเป็น key ใหม่ (ครั้งที่สองได้จาก cache) ส่วนข้อความพิมพ์เองไม่ใช้ cache เลย
+    free_text = body["message"] != BODY["message"]
+    assert len(models.requests) == (3 if free_text else 2)
+
+
+def test_cached_requirements_are_not_shared(models):
+    session = {"history": [], "requirements": dict(REQUIREMENTS)}
+    key, response = main.cached_chat_turn(session, "บับเบิ้ล")
+    assert key and response is None
+    main.chat_response_cache.put(key, "ok", {"current_step": 6, "quick_replies": ["500"]})
+    first = main.cached_chat_turn(session, "บับเบิ้ล")[1]
+    first.extracted_data["quick_replies"].append("แก้แล้ว")
+    assert main.cached_chat_turn(session, "บับเบิ้ล")[1].extracted_data["quick_replies"] == ["500"]
+
+
+def test_lru_and_ttl_eviction():
+    cache = main.ChatResponseCache(4, ttl_seconds=0.05)
+    keys = [cache.key({"current_step": i}, "ยืนยัน ✓") for i in range(6)]
+    for key in keys:
+        cache.put(key, "ok", {"current_step": 1})
+    assert cache.get(keys[0]) is None and cache.get(keys[-1]) is not None
+    time.sleep(0.06)
+    assert cache.get(keys[-1]) is None
+    assert cache.summary()["evictions"] == 2 and cache.summary()["expired"] == 1
+
+
+def test_empty_extraction_is_not_stored():
+    cache = main.ChatResponseCache(4, ttl_seconds=60)
+    key = cache.key({"current_step": 1}, "ยืนยัน ✓")
+    cache.put(key, "ok", {})
+    assert cache.get(key) is None
+    assert main.ChatResponseCache(0, ttl_seconds=60).key({}, "ยืนยัน ✓") is None
@@ -0,0 +1,173 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from conftest import REPLY, FakeModels
+
+LIGHT, STRONG = "fake-light", "fake-strong"
+ROUTES = {"light": (LIGHT, STRONG), "strong": (STRONG, LIGHT)}
+CONTENTS = [{"role": "user", "parts": [{"text": "ping"}]}]
+
+
+class FakeAPIError(Exception):
+    """error แบบ google.genai.errors.APIError (มี .code)"""
+
+    def __init__(self, code: int):
+        super().__init__(f"{code} fake model error")
+        self.code = code
+
+
+class RouterModels(FakeModels):
+    """แต่ละโมเดลมี latency และ error ของตัวเอง: profiles = model -> {"latency": s, "error": code}"""
+
+    def __init__(self):
+        super().__init__()
+        self.profiles = {}
+        self.order = []
+        self._lock = threading.Lock()
+
+    def generate_content(self, model, contents, config=None):
+        with self._lock:
+            self.order.append(model)
+        profile = self.profiles.get(model, {})
+        time.sleep(profile.get("latency", 0.0))
+        if profile.get("error"):
+            raise FakeAPIError(profile["error"])
+        return SimpleNamespace(text=self.reply)
+
+
+@pytest.fixture
+def models(fake_client):
+    fake_client.models = RouterModels()
+    return fake_client.models
+
+
+def router(**overrides) -> main.ModelRouter:
+    settings = {"hedge_after": 0.0, "retries": 2, "backoff_seconds": 0.0,
+                "failure_threshold": 5, "reset_seconds": 30.0, **overrides}
+    return main.ModelRouter(ROUTES, **settings)
+
+
+def generate(r: main.ModelRouter, route: str = "light") -> str:
+    return asyncio.run(r.generate(CONTENTS, route, "test"))
+
+
+@pytest.mark.parametrize("requirements, expected", [
+    ({}, ("light", "extraction")),
+    ({"product_type": "Food-grade", "current_step": 3}, ("light", "extraction")),
+    ({"is_checkpoint": True}, ("strong", "checkpoint")),
+    ({"product_type": "Food-grade", "box_type": "Die-cut", "quantity": 1000,
+      "dimensions": {"width": 20, "length": 30, "height": 10}}, ("strong", "structure_summary")),
+    ({"product_type": "Food-grade", "box_type": "Die-cut", "quantity": 1000, "confirmed_structure": True,
+      "dimensions": {"width": 20, "length": 30, "height": 10}, "current_step": 7}, ("light", "extraction")),
+    ({"confirmed_structure": True, "current_step": 9}, ("strong", "quotation")),
+])
+def test_choose_route(monkeypatch, requirements, expected):
+    monkeypatch.setattr(main, "LLM_ROUTING", True)
+    assert main.choose_route(requirements) == expected
+
+
+def test_choose_route_without_routing(monkeypatch):
+    monkeypatch.setattr(main, "LLM_ROUTING", False)
+    assert main.choose_route({}) == ("strong", "routing_off")
+
+
+def test_breaker_closed_open_half_open_closed():
+    breaker = main.CircuitBreaker(failure_threshold=2, reset_seconds=0.1)
+    breaker.record(False)
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open" and not breaker.allow() and not breaker.available()
+    time.sleep(0.1)
+    # half-open ปล่อย probe ได้ทีละตัว
+    assert breaker.state == "half_open" and breaker.allow()
+    assert not breaker.allow() and not breaker.available()
+    breaker.record(True)
+    assert breaker.state == "closed" and breaker.opened == 1
+
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = main.CircuitBreaker(failure_threshold=1, reset_seconds=0.0)
+    breaker.record(False)
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.opened == 2
+
+
+def test_router_breaker_cycle(models):
+    models.profiles = {LIGHT: {"error": 503}}
+    r = router(failure_threshold=2, reset_seconds=0.3, retries=1)
+    states = []
+    for _ in range(3):
+        assert generate(r) == REPLY
+        states.append(r.breaker(LIGHT).state)
+    models.profiles = {}
+    time.sleep(0.3)
+    states.append(r.breaker(LIGHT).state)
+    generate(r)
+    states.append(r.breaker(LIGHT).state)
+    assert states == ["closed", "open", "open", "half_open", "closed"]
+    assert models.order == [LIGHT, STRONG, LIGHT, STRONG, STRONG, LIGHT]
+
+
+def test_taken_probe_falls_back_instead_of_503(models):
+    r = router(failure_threshold=1, reset_seconds=0.0)
+    r.breaker(LIGHT).record(False)
+    assert r.breaker(LIGHT).state == "half_open" and r.breaker(LIGHT).allow()
+    generate(r)
+    assert models.order == [STRONG]
+
+
+def test_hedge_goes_to_the_other_model(models):
+    # light ล้มทันที retry ไป strong ที่ช้ากว่า hedge_after: hedge ต้องไป light ไม่ใช่ strong ซ้ำ
+    models.profiles = {LIGHT: {"error": 503}, STRONG: {"latency": 0.3}}
+    r = router(hedge_after=0.1)
+    assert generate(r) == REPLY
+    assert models.order == [LIGHT, STRONG, LIGHT]
+    assert r.stats["hedged"] == 1 and r.stats["hedge_wins"] == 0 and r.stats["retries"] == 1
+
+
+def test_hedge_wins_over_a_slow_primary(models):
+    models.profiles = {LIGHT: {"latency": 0.5}}
+    r = router(hedge_after=0.05)
+    started = time.perf_counter()
+    generate(r)
+    assert time.perf_counter() - started < 0.4
+    assert models.order == [LIGHT, STRONG] and r.stats["hedge_wins"] == 1
+
+
+def test_primary_outage_falls_back(models):
+    models.profiles = {LIGHT: {"error": 503}}
+    r = router(failure_threshold=3)
+    for _ in range(10):
+        assert generate(r) == REPLY
+    assert r.breaker(LIGHT).state == "open"
+    # วงจรเปิดแล้วไม่ส่งไป light อีก
+    assert models.order.count(LIGHT) == 3
+    assert r.summary()["models"] == {STRONG: 10}
+
+
+def test_everything_down_is_503(models):
+    models.profiles = {LIGHT: {"error": 503}, STRONG: {"error": 503}}
+    r = router(failure_threshold=1, retries=1)
+    with pytest.raises(FakeAPIError):
+        generate(r)
+    with pytest.raises(HTTPException) as raised:
+        generate(r)
+    assert raised.value.status_code == 503 and r.stats["short_circuited"] == 1
+
+
+def test_client_errors_are_not_retried(models):
+    models.profiles = {LIGHT: {"error": 400}}
+    r = router(failure_threshold=1)
+    with pytest.raises(FakeAPIError):
+        generate(r)
+    # 4xx แปลว่าโมเดลยังตอบได้ วงจรไม่เปิด
+    assert models.order == [LIGHT] and r.breaker(LIGHT).state == "closed"
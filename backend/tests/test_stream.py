@@ -0,0 +1,75 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from conftest import EXTRACTED, REPLY
+
+MESSAGE = {"message": "อยากได้กล่องใส่ขนมครับ"}
+
+
+def sse_events(text: str) -> list:
+    events = []
+    for block in text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def without_session(data: dict) -> dict:
+    return {key: value for key, value in data.items() if key != "session_id"}
+
+
+def test_stream_matches_blocking_reply(fake_client, http):
+    blocking = http.post("/api/chat", json=MESSAGE).json()
+    events = sse_events(http.post("/api/chat/stream", json=MESSAGE).text)
+
+    kinds = [kind for kind, _ in events]
+    assert kinds[-1] == "done" and set(kinds[:-1]) == {"token"}
+    tokens = "".join(data["text"] for kind, data in events if kind == "token")
+    assert "<extracted_data" not in tokens and "extracted_data>" not in tokens
+    assert tokens.strip() == blocking["response"]
+    assert without_session(events[-1][1]) == without_session(blocking)
+    assert events[-1][1]["extracted_data"]["quick_replies"] == EXTRACTED["quick_replies"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 17, len(REPLY)])
+def test_filter_holds_back_the_block_at_any_chunk_size(chunk_size):
+    parser = main.ExtractedDataFilter()
+    visible = [parser.feed(REPLY[i:i + chunk_size]) for i in range(0, len(REPLY), chunk_size)]
+    visible.append(parser.close())
+    # ข้อความใน REPLY ไม่มี "<" เลย ถ้าหลุดมาแปลว่าแท็กรั่วออกไปบางส่วน
+    assert "<" not in "".join(visible)
+    assert ("".join(visible).strip(), parser.data, parser.status) == main.parse_model_reply(REPLY)
+    assert parser.status == "ok" and parser.data["current_step"] == EXTRACTED["current_step"]
+
+
+def test_stream_releases_the_llm_slot(fake_client, http):
+    free = main._llm_slots._value
+    http.post("/api/chat/stream", json=MESSAGE)
+    assert main._llm_slots._value == free
+
+
+def test_stalled_stream_times_out_between_chunks(fake_client, http, monkeypatch):
+    release = threading.Event()
+
+    def stalled(model, contents, config=None):
+        yield SimpleNamespace(text="สวัสดีครับ ")
+        release.wait(10)
+        yield SimpleNamespace(text="ช้าเกินไป")
+
+    fake_client.models.generate_content_stream = stalled
+    monkeypatch.setattr(main, "LLM_TIMEOUT_SECONDS", 0.3)
+    free = main._llm_slots._value
+    started = time.perf_counter()
+    try:
+        events = sse_events(http.post("/api/chat/stream", json=MESSAGE).text)
+    finally:
+        release.set()
+    assert time.perf_counter() - started < 2
+    assert [kind for kind, _ in events] == ["token", "error"]
+    assert "0.3s" in events[-1][1]["detail"]
+    assert main._llm_slots._value == free
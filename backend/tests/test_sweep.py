@@ -0,0 +1,14 @@
+import pytest
+
+AXIS = {"start": 10, "stop": 40, "steps": 4}
+
+
+@pytest.mark.parametrize("steps", [0, -1, 10_001])
+def test_steps_out_of_range_is_rejected_by_the_schema(http, steps):
+    response = http.post("/analyze/sweep", json={"length": {**AXIS, "steps": steps}, "width": AXIS, "weight": AXIS})
+    assert response.status_code == 422
+
+
+def test_missing_axis_is_a_400(http):
+    response = http.post("/analyze/sweep", json={"length": AXIS, "width": AXIS})
+    assert response.status_code == 400 and "weight" in response.json()["detail"]
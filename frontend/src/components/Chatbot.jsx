@@ -305,6 +305,7 @@ export default function Chatbot({ onUpdateBoxDimensions, apiUrl = 'https://lumop
   const [isLoading, setIsLoading] = useState(false);
   const [requirements, setRequirements] = useState({});
   const [quotation, setQuotation] = useState(null);
+  const [sessionId, setSessionId] = useState(null);
   const messagesEndRef = useRef(null);
   
   // Scroll to bottom when new messages arrive
@@ -342,19 +343,65 @@ export default function Chatbot({ onUpdateBoxDimensions, apiUrl = 'https://lumop
     setIsLoading(true);
     
     try {
-      const response = await fetch(`${apiUrl}/api/chat`, {
+      const postChat = (body) => fetch(`${apiUrl}/api/chat/stream`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          message: messageText,
-          conversation_history: messages.map(m => ({ role: m.role, content: m.content })),
-          current_requirements: requirements
-        })
+        body: JSON.stringify(body)
       });
+      const fullContext = {
+        message: messageText,
+        conversation_history: messages.map(m => ({ role: m.role, content: m.content })),
+        current_requirements: requirements
+      };
+      // มี session แล้ว server เก็บประวัติ/requirements ไว้ให้ ส่งแค่ข้อความใหม่
+      let response = await postChat(sessionId ? { message: messageText, session_id: sessionId } : fullContext);
+      // session หมดอายุ/server restart (410): ส่งประวัติและ requirements ที่มีอยู่ไปเริ่ม session ใหม่
+      if (response.status === 410) {
+        setSessionId(null);
+        response = await postChat(fullContext);
+      }
+      
+      if (!response.ok || !response.body) throw new Error('API Error');
+      
+      // อ่าน Server-Sent Events: token = ข้อความทีละส่วน, done = ผลลัพธ์เต็ม
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let streamed = '';
+      let data = null;
+      
+      while (data === null) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) >= 0) {
+          const raw = buffer.slice(0, boundary);
+          buffer = buffer.slice(boundary + 2);
+          const event = raw.match(/^event: (.*)$/m)?.[1];
+          const payload = JSON.parse(raw.match(/^data: (.*)$/m)?.[1] || '{}');
+          
+          if (event === 'token') {
+            // แสดงข้อความทันทีที่ได้ token แรก
+            if (!streamed) {
+              setIsLoading(false);
+              setMessages(prev => [...prev, { role: 'assistant', content: '', quickReplies: [], streaming: true }]);
+            }
+            streamed += payload.text;
+            const content = streamed;
+            setMessages(prev => prev.map((m, i) => (i === prev.length - 1 && m.streaming ? { ...m, content } : m)));
+          } else if (event === 'done') {
+            data = payload;
+          } else if (event === 'error') {
+            throw new Error(payload.detail || 'API Error');
+          }
+        }
+      }
       
-      if (!response.ok) throw new Error('API Error');
+      if (!data) throw new Error('Stream ended early');
       
-      const data = await response.json();
+      if (data.session_id) setSessionId(data.session_id);
       
       // Update requirements
       if (data.extracted_data && Object.keys(data.extracted_data).length > 0) {
@@ -386,11 +433,16 @@ export default function Chatbot({ onUpdateBoxDimensions, apiUrl = 'https://lumop
         quickReplies: data.quick_replies || [] // ใช้ quick_replies จาก API
       };
       
-      setMessages(prev => [...prev, botMessage]);
+      // แทนที่ข้อความที่กำลัง stream ด้วยข้อความฉบับสมบูรณ์
+      setMessages(prev => (
+        prev.length && prev[prev.length - 1].streaming
+          ? [...prev.slice(0, -1), botMessage]
+          : [...prev, botMessage]
+      ));
       
     } catch (error) {
       console.error('Chat error:', error);
-      setMessages(prev => [...prev, {
+      setMessages(prev => [...prev.filter(m => !m.streaming), {
         role: 'assistant',
         content: 'ขออภัยครับ เกิดข้อผิดพลาดในการเชื่อมต่อ กรุณาลองใหม่อีกครั้งนะครับ 🙏',
         quickReplies: []